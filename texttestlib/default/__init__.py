@@ -437,6 +437,8 @@ class Config:
         stateSaver = self.getStateSaver()
         if stateSaver is not None:
             classes.append(stateSaver)
+        if not self.runningScript() and self.anyAppHas(allApps, lambda app: app.getConfigValue("runtime_history_database")):
+            classes.append(performance.RuntimeHistoryRecorder)
         if not self.useGUI() and not self.batchMode():
             classes.append(self.getTextResponder())
         # At the end, so we've done the processing before we proceed
@@ -629,6 +631,8 @@ class Config:
         extractors = app.getConfigValue("performance_logfile_extractor")
         if (perfType and perfType in extractors) or (not perfType and len(extractors) > 0):
             return True
+        elif app.getConfigValue("automatic_memory_stem") and perfType in ["", app.getConfigValue("automatic_memory_stem")]:
+            return True
         else:
             return app.hasAutomaticCputimeChecking()
 
@@ -1095,6 +1099,11 @@ class Config:
                 raise plugins.TextTestError("Cannot collate files to stem '" + key +
                                             "' - '.' and '/' characters are not allowed")
 
+        memoryStem = app.getConfigValue("automatic_memory_stem")
+        if memoryStem and "mem" not in memoryStem:
+            raise plugins.TextTestError("Cannot write measured memory to stem '" + memoryStem +
+                                        "' - memory files are recognised by having 'mem' in their names")
+
         definitionFileStems = app.defFileStems()
         definitionFileStems += [stem + "." + app.name for stem in definitionFileStems]
         for dataFileName in app.getDataFileNames():
@@ -1151,6 +1160,7 @@ class Config:
 
     def recomputeProgress(self, test, state, observers):
         if state.isComplete():
+            rundependent.FilterProgressRecompute.discardProgress(test)
             if state.hasResults():
                 state.recalculateStdFiles(test)
                 fileFilter = rundependent.FilterResultRecompute()
@@ -1236,6 +1246,8 @@ class Config:
                              "Password for SMTP authentication when sending mail in batch mode")
         app.setConfigDefault("batch_result_repository", {"default": ""},
                              "Directory to store historical batch results under")
+        app.setConfigDefault("batch_result_repository_format", {"default": "files"},
+                             "How to store results in batch_result_repository: 'files' for separate files per test, 'consolidated' for a single file per version and run")
         app.setConfigDefault("file_to_url", {}, "Mapping of file locations to URLS, for linking to HTML reports")
         app.setConfigDefault("historical_report_location", {"default": ""},
                              "Directory to create reports on historical batch data under")
@@ -1291,12 +1303,16 @@ class Config:
         app.setConfigDefault("cputime_include_system_time", 0, "Include system time when measuring CPU time?")
         app.setConfigDefault("default_performance_stem", "performance",
                              "Which performance statistic to use when selecting tests by performance, placing performance in Junit XML reports etc")
+        app.setConfigDefault("runtime_history_database", "",
+                             "SQLite file in which to record the time and memory used by every test run, for use in time filters and scheduling. 'personal' for one in the personal config directory")
         app.setConfigDefault("performance_logfile", {"default": []},
                              "Which result file to collect performance data from")
         app.setConfigDefault("performance_logfile_extractor", {},
                              "What string to look for when collecting performance data")
         app.setConfigDefault("performance_test_machine", {"default": [], "*mem*": ["any"]},
                              "List of machines where performance can be collected")
+        app.setConfigDefault("automatic_memory_stem", "",
+                             "File stem to write the peak memory used by the test process to, in MB, as measured by TextTest itself. Must contain 'mem', like other memory files. Empty means don't")
         app.setConfigDefault("performance_variation_%", {"default": 10.0},
                              "How much variation in performance is allowed")
         app.setConfigDefault("performance_variation_serious_%", {
@@ -1412,11 +1428,21 @@ class Config:
                              "default": 0.0}, "Which relative tolerance to apply when comparing floating point values")
         app.setConfigDefault("floating_point_split", {
                              "default": ''}, "Separator to split at when comparing floating point values")
+        app.setConfigDefault("comparison_workers", 0,
+                             "Number of workers to use for filtering and comparing the result files of a test at the same time. 0 means one file at a time")
+        app.setConfigDefault("comparison_worker_type", "thread",
+                             "Whether comparison_workers filter result files in separate 'process'es or in 'thread's within TextTest")
+        app.setConfigDefault("filtered_file_cache", "",
+                             "Where to keep filtered standard files for reuse in later runs: 'personal' or a directory. Empty means don't keep them")
+        app.setConfigDefault("filtered_file_cache_size", "1GB",
+                             "Maximum size of the filtered_file_cache. The least recently used files are removed beyond this")
 
         app.setConfigDefault("collate_file", self.getDefaultCollations(),
                              "Mapping of result file names to paths to collect them from")
         app.setConfigDefault("collate_script", self.getDefaultCollateScripts(),
                              "Mapping of result file names to scripts which turn them into suitable text")
+        app.setConfigDefault("collation_workers", 0,
+                             "Number of collate_script pipelines to run at the same time for a test. 0 means one at a time")
         trafficText = "Deprecated. Use CaptureMock."
         app.setConfigDefault("collect_traffic", {"default": [], "asynchronous": []}, trafficText)
         app.setConfigDefault("collect_traffic_environment", {"default": []}, trafficText)
@@ -1430,8 +1456,12 @@ class Config:
 
         app.setConfigDefault("unordered_text", {"default": []},
                              "Mapping of patterns to extract and sort from result files", trackFiles=True)
+        app.setConfigDefault("compile_run_dependent_text", 1,
+                             "Skip lines that no run_dependent_text/unordered_text pattern can match using a single combined expression")
         app.setConfigDefault("file_split_pattern", {}, "Pattern to use for splitting result files")
         app.setConfigDefault("create_catalogues", "false", "Do we create a listing of files created/removed by tests")
+        app.setConfigDefault("catalogue_compare_contents", 0,
+                             "When creating catalogues, check the contents of files that were rewritten with the same size, and don't report them as changed if the contents are the same. Reads all files in the sandbox before the test runs")
         app.setConfigAlias("collect_file_changes", "create_catalogues")
         app.setConfigAlias("collate_file_changes", "create_catalogues")
 
@@ -1494,6 +1524,10 @@ class Config:
     def setExternalToolDefaults(self, app, homeOS):
         app.setConfigDefault("text_diff_program", "diff",
                              "External program to use for textual comparison of files")
+        app.setConfigDefault("use_external_text_diff_program", 0,
+                             "Run text_diff_program even when it is 'diff', instead of TextTest's own equivalent")
+        app.setConfigDefault("internal_text_diff_max_lines", 2000,
+                             "How many lines after the first difference TextTest's own equivalent of 'diff' will match up. Beyond this 'diff' itself is run. -1 means no limit")
         app.setConfigDefault("lines_of_text_difference", 30,
                              "How many lines to present in textual previews of file diffs")
         app.setConfigDefault("max_width_text_difference", 500,
@@ -1666,6 +1700,12 @@ class Config:
         app.setConfigDefault("test_data_environment", {},
                              "Environment variables to be redirected for linked/copied test data")
         app.setConfigDefault("test_data_require", [], "Test data names that are required to exist for the SUT to work")
+        app.setConfigDefault("copy_test_path_methods", ["reflink", "copy"],
+                             "Ways to put copied test data in the sandbox, tried in order: 'reflink' (copy-on-write clone where the file system supports it), 'hardlink' (only for read-only files) and 'copy'")
+        app.setConfigDefault("copy_test_path_threads", 4,
+                             "Number of files to copy at the same time when copying test data directories into the sandbox")
+        app.setConfigDefault("report_sandbox_copying", 0,
+                             "Report how much test data was copied into each sandbox, how, and how long it took")
         app.setConfigDefault("filter_file_directory", [
                              "filter_files"], "Default directories for test filter files, relative to an application directory.")
         app.setConfigDefault("extra_version", [], "Versions to be run in addition to the one specified")
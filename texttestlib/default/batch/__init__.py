@@ -10,6 +10,7 @@ import re
 import tarfile
 import stat
 from texttestlib.default.batch import testoverview
+from texttestlib.default.batch.statestore import TestStateStore, getStoreFileName, getStoreTag, isStoreFile
 from texttestlib import plugins
 from .summarypages import GenerateSummaryPage, GenerateGraphs  # only so they become package level entities
 from .ci import CIPlatform
@@ -481,11 +482,13 @@ def getPreviousWriteDirs(app):
     return getPreviousWriteDirsUnder(rootDir, app) if os.path.isdir(rootDir) else []
 
 
+def getSuccessText(state):
+    text = state.briefText + " " if state.briefText else ""
+    return text + ", ".join(state.executionHosts)
+
+
 def writeSuccessLine(f, runPostfix, state):
-    f.write(runPostfix)
-    if state.briefText:
-        f.write(" " + state.briefText)
-    f.write(" " + ", ".join(state.executionHosts) + "\n")
+    f.write(runPostfix + " " + getSuccessText(state) + "\n")
 
 
 # Allow saving results to a historical repository
@@ -496,6 +499,7 @@ class SaveState(plugins.Responder):
         self.failureFileName = "teststate_" + self.runPostfix
         self.successFileName = "succeeded_runs"
         self.repositories = {}
+        self.stores = {}
         self.allApps = allApps
         self.diag = logging.getLogger("Save Repository")
         self.checkRunNameValid()
@@ -522,15 +526,43 @@ class SaveState(plugins.Responder):
                 self.diag.info("No repositories for " + repr(test.app) + " in " + repr(self.repositories))
 
     def saveToRepository(self, test):
-        testRepository = self.repositories[test.app]
-        targetDir = os.path.join(testRepository, test.app.name, getVersionName(test.app, self.allApps),
-                                 test.getRelPath())
+        versionDir = os.path.join(self.repositories[test.app], test.app.name, getVersionName(test.app, self.allApps))
+        if test.app.getBatchConfigValue("batch_result_repository_format") == "consolidated":
+            self.saveToStore(test, versionDir)
+        else:
+            self.saveToFiles(test, os.path.join(versionDir, test.getRelPath()))
+
+    def storeSuccessText(self, test):
+        # Need to store full states for succeeded tests if we have resource pages
+        return test.state.hasSucceeded() and len(test.app.getBatchConfigValue("historical_report_resources")) == 0
+
+    def saveToStore(self, test, versionDir):
+        storeFile = getStoreFileName(versionDir, self.runPostfix)
+        store = self.stores.get(storeFile)
+        if store is None:
+            try:
+                plugins.ensureDirectoryExists(versionDir)
+            except EnvironmentError:
+                plugins.printWarning("Could not create directory at " + versionDir)
+            store = self.stores[storeFile] = TestStateStore(storeFile)
+        relPath = test.getRelPath()
+        try:
+            if store.contains(relPath):
+                plugins.printWarning("Result for " + relPath + " already exists in " + storeFile + " - not overwriting!")
+            elif self.storeSuccessText(test):
+                store.addSuccess(relPath, getSuccessText(test.state))
+            else:
+                with open(test.getStateFile(), "rb") as f:
+                    store.addState(relPath, f.read())
+        except EnvironmentError:
+            plugins.printWarning("Could not write result for " + relPath + " to " + storeFile)
+
+    def saveToFiles(self, test, targetDir):
         try:
             plugins.ensureDirectoryExists(targetDir)
         except EnvironmentError:
             plugins.printWarning("Could not create directory at " + targetDir)
-        # Need to store teststate files for succeeded tests if we have resource pages
-        if test.state.hasSucceeded() and len(test.app.getBatchConfigValue("historical_report_resources")) == 0:
+        if self.storeSuccessText(test):
             targetFile = os.path.join(targetDir, self.successFileName)
             with open(targetFile, "a") as f:
                 writeSuccessLine(f, self.runPostfix, test.state)
@@ -631,6 +663,61 @@ class MigrateBatchRepository(plugins.Action):
             self.migrate(repository)
 
 
+class ConsolidateBatchRepository(plugins.Action):
+    scriptDoc = "Convert the batch result repository to the consolidated format, with a single file per version and run"
+
+    def consolidate(self, versionDir):
+        stores = {}
+        for root, dirs, files in os.walk(versionDir):
+            dirs.sort()
+            relPath = os.path.relpath(root, versionDir)
+            for fileName in sorted(files):
+                path = os.path.join(root, fileName)
+                if fileName.startswith("teststate_"):
+                    store = self.getStore(stores, versionDir, fileName.replace("teststate_", "", 1))
+                    if not store.contains(relPath):
+                        with open(path, "rb") as f:
+                            store.addState(relPath, f.read())
+                    os.remove(path)
+                elif fileName.startswith("succeeded_"):
+                    with open(path) as f:
+                        for line in f:
+                            parts = line.strip().split(" ", 1)
+                            if len(parts) == 2:
+                                store = self.getStore(stores, versionDir, parts[0])
+                                if not store.contains(relPath):
+                                    store.addSuccess(relPath, parts[1])
+                    os.remove(path)
+        self.removeEmptyDirectories(versionDir)
+        if stores:
+            plugins.log.info("Consolidated results for " + str(len(stores)) + " runs under " + versionDir)
+
+    def getStore(self, stores, versionDir, tag):
+        if tag not in stores:
+            stores[tag] = TestStateStore(getStoreFileName(versionDir, tag))
+        return stores[tag]
+
+    def removeEmptyDirectories(self, versionDir):
+        for root, dirs, files in os.walk(versionDir, topdown=False):
+            if root != versionDir and len(os.listdir(root)) == 0:
+                os.rmdir(root)
+
+    def setUpSuite(self, suite):
+        if suite.parent is None:
+            repository = getBatchRepository(suite)
+            if not os.path.isdir(repository):
+                raise plugins.TextTestError("Batch result repository " + repository + " does not exist")
+            appDir = os.path.join(repository, suite.app.name)
+            if os.path.isdir(appDir):
+                plugins.log.info("Consolidating repository at " + appDir)
+                for versionDirName in sorted(os.listdir(appDir)):
+                    versionDir = os.path.join(appDir, versionDirName)
+                    if os.path.isdir(versionDir):
+                        self.consolidate(versionDir)
+            if suite.app.getBatchConfigValue("batch_result_repository_format") != "consolidated":
+                plugins.log.info("Set 'batch_result_repository_format' to 'consolidated' to keep writing this format")
+
+
 class ArchiveScript(plugins.ScriptWithArgs):
     def __init__(self, argDict):
         self.descriptors = []
@@ -821,6 +908,8 @@ class ArchiveRepository(ArchiveScript):
 
         if file.startswith("succeeded_"):
             return True
+        if isStoreFile(file):
+            return self.shouldArchiveGivenTag(getStoreTag(file), weekdays)
         if not file.startswith("teststate"):
             return False
 
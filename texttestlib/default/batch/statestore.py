@@ -0,0 +1,150 @@
+
+""" Consolidated batch repository format: the results of every test in one run, for one application version,
+appended to a single file rather than spread over a file per test """
+
+import os
+import struct
+import logging
+from threading import Lock
+try:
+    import fcntl
+except ImportError:  # Windows: only threads in this process are kept apart
+    fcntl = None
+from texttestlib import plugins
+
+filePrefix = "teststates_"
+
+
+def getStoreFileName(versionDir, tag):
+    return os.path.join(versionDir, filePrefix + tag)
+
+
+def isStoreFile(fileName):
+    return os.path.basename(fileName).startswith(filePrefix)
+
+
+def getStoreTag(fileName):
+    return os.path.basename(fileName).replace(filePrefix, "", 1)
+
+
+class TestStateStore:
+    # Each record is a fixed header (kind, path length, payload length) followed by the test's path and the payload,
+    # so the headers alone form an index: a reader can find any test by seeking from one header to the next
+    magic = b"TEXTTEST-STATES 1\n"
+    header = struct.Struct(">BHI")
+    stateRecord = 0  # payload is a pickled TestState, as in a teststate file
+    successRecord = 1  # payload is the text that would appear in a succeeded_runs file
+    readBlockSize = 1024 * 1024
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.lock = Lock()
+        self.index = None
+        self.dataEnd = None  # end of the last complete record read, so we can catch up with what others have written
+        self.diag = logging.getLogger("Test State Store")
+
+    def contains(self, relPath):
+        with self.lock:
+            if not os.path.isfile(self.fileName):
+                return False
+            with self.openLocked("rb", exclusive=False) as f:
+                self.updateIndex(f)
+            return self.makeKey(relPath) in self.index
+
+    def addState(self, relPath, pickledState):
+        self.add(relPath, self.stateRecord, pickledState)
+
+    def addSuccess(self, relPath, text):
+        self.add(relPath, self.successRecord, text.encode("utf-8"))
+
+    def add(self, relPath, kind, payload):
+        key = self.makeKey(relPath)
+        encodedKey = key.encode("utf-8")
+        record = self.header.pack(kind, len(encodedKey), len(payload)) + encodedKey + payload
+        # Several processes may be writing the same run, e.g. slaves of a grid engine
+        with self.lock, self.openLocked("a+b", exclusive=True) as f:
+            if self.updateIndex(f):
+                # Nobody can be writing it now we have the lock, so a writer crashed. Everything after it would be unreadable
+                plugins.printWarning("Test state store at " + self.fileName + " ends with an incomplete record, removing it")
+                os.ftruncate(f.fileno(), self.dataEnd)
+            f.seek(0, os.SEEK_END)
+            if f.tell() == 0:
+                f.write(self.magic)
+                self.dataEnd = f.tell()
+            elif self.dataEnd is None:
+                raise OSError("Not a TextTest test state store: " + self.fileName)
+            # One write per record, so that a crash can only leave the last one incomplete
+            f.write(record)
+            self.index.setdefault(key, (kind, self.dataEnd))
+            self.dataEnd = f.tell()
+        self.diag.info("Added " + repr(relPath) + " to " + self.fileName)
+
+    def openLocked(self, mode, exclusive):
+        f = open(self.fileName, mode)
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        return f  # closing it releases the lock
+
+    @staticmethod
+    def makeKey(relPath):
+        return relPath.replace(os.sep, "/")
+
+    def updateIndex(self, f):
+        # Read any records added since we last looked, by us or anyone else. Returns True if the file ends
+        # with an incomplete record
+        fileSize = os.fstat(f.fileno()).st_size
+        if self.index is None or self.dataEnd is None or fileSize < self.dataEnd:
+            self.index, self.dataEnd = {}, None
+            f.seek(0)
+            if fileSize == 0 or not self.readMagic(f):
+                return False
+            self.dataEnd = f.tell()
+        f.seek(self.dataEnd)
+        while True:
+            data = f.read(self.header.size)
+            if len(data) < self.header.size:
+                return len(data) > 0
+            kind, keyLength, payloadLength = self.header.unpack(data)
+            key = f.read(keyLength)
+            recordEnd = self.dataEnd + self.header.size + keyLength + payloadLength
+            if len(key) < keyLength or recordEnd > fileSize:
+                return True
+            self.index.setdefault(key.decode("utf-8"), (kind, self.dataEnd))
+            f.seek(recordEnd)
+            self.dataEnd = recordEnd
+
+    def readMagic(self, f):
+        if f.read(len(self.magic)) == self.magic:
+            return True
+        plugins.printWarning("File at " + self.fileName + " is not a TextTest test state store, ignoring it")
+        return False
+
+    def readHeader(self, f):
+        data = f.read(self.header.size)
+        if len(data) == self.header.size:
+            return self.header.unpack(data)
+        elif data:
+            self.warnTruncated()
+
+    def warnTruncated(self):
+        plugins.printWarning("Test state store at " + self.fileName + " ends with an incomplete record, ignoring it")
+
+    def readRecords(self):
+        # One sequential pass, yielding (test path, record kind, payload) in the order they were written
+        with open(self.fileName, "rb", buffering=self.readBlockSize) as f:
+            if not self.readMagic(f):
+                return
+            while True:
+                headerInfo = self.readHeader(f)
+                if headerInfo is None:
+                    return
+                kind, keyLength, payloadLength = headerInfo
+                data = f.read(keyLength + payloadLength)
+                if len(data) < keyLength + payloadLength:
+                    self.warnTruncated()
+                    return
+                relPath = data[:keyLength].decode("utf-8").replace("/", os.sep)
+                payload = data[keyLength:]
+                if kind == self.successRecord:
+                    payload = payload.decode("utf-8")
+                yield relPath, kind, payload
@@ -7,13 +7,17 @@ import html
 import sys
 import logging
 import locale
+import pickle
+import hashlib
 from texttestlib.default.batch import HTMLgen, HTMLcolors
 from texttestlib.default.batch.ci import CIPlatform
 from texttestlib import plugins
 from collections import OrderedDict
 from glob import glob
+from io import BytesIO
 from datetime import datetime, timedelta
 from .batchutils import convertToUrl, getEnvironmentFromRunFiles
+from .statestore import TestStateStore, getStoreTag, isStoreFile
 HTMLgen.PRINTECHO = 0
 
 
@@ -74,6 +78,133 @@ class TitleWithDateStamp:
         return self.title + plugins.localtime(format="%d%b%H:%M") + ")"
 
 
+def getResultCategory(result):
+    # result is either a TestState or the text from a succeeded_runs file
+    return "success" if isinstance(result, str) else result.category
+
+
+def hashEntry(*entry):
+    # Digests are sums of these, so they don't depend on the order results are found in
+    return int(hashlib.md5(repr(entry).encode()).hexdigest(), 16)
+
+
+def getSignature(path):
+    try:
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+    except OSError:
+        pass
+
+
+class VersionResults:
+    # Everything read from the repository for one version, as the tables and detail pages need it
+    def __init__(self):
+        self.loggedTests = OrderedDict()
+        self.categoryHandlers = {}
+
+    def register(self, extraVersion, testId, tag, result):
+        self.loggedTests.setdefault(extraVersion, OrderedDict()).setdefault(testId, OrderedDict())[tag] = result
+        self.categoryHandlers.setdefault(tag, CategoryHandler()).registerInCategory(
+            testId, getResultCategory(result), extraVersion, result)
+
+
+class TagSummary:
+    # What the model remembers about one run: enough to tell whether the pages showing it have changed
+    digestModulus = 2 ** 128
+
+    def __init__(self):
+        self.fileCount = 0
+        self.fileDigest = 0
+        self.categoryCounts = {}
+        self.successCount = 0
+        self.successDigest = 0
+
+    def setFiles(self, fileCount, fileDigest, categoryCounts):
+        self.fileCount = fileCount
+        self.fileDigest = fileDigest
+        self.categoryCounts = categoryCounts
+
+    def addSuccess(self, entryHash):
+        self.successCount += 1
+        self.successDigest = (self.successDigest + entryHash) % self.digestModulus
+
+    def resetSuccesses(self):
+        self.successCount = 0
+        self.successDigest = 0
+
+    def isEmpty(self):
+        return self.fileCount == 0 and self.successCount == 0
+
+    def getCategoryCounts(self):
+        counts = dict(self.categoryCounts)
+        if self.successCount:
+            counts["success"] = counts.get("success", 0) + self.successCount
+        return counts
+
+    def getDigest(self):
+        return "%032x" % ((self.fileDigest + self.successDigest) % self.digestModulus)
+
+
+class ResultModel:
+    # Summaries of each run found in the repository, per version, so that each night only the new
+    # run's files need reading and only the pages that show it need writing. teststate and
+    # consolidated files are identified by tag from their names. succeeded_runs files only ever
+    # grow, so the model remembers how much of each it has read.
+    formatVersion = 2
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.tagSummaries = {}
+        self.successSignatures = {}
+        self.pages = {}
+        self.diag = logging.getLogger("GenerateWebPages")
+        self.load()
+
+    def load(self):
+        if not os.path.isfile(self.fileName):
+            return
+        try:
+            with open(self.fileName, "rb") as f:
+                formatVersion, self.tagSummaries, self.successSignatures, self.pages = pickle.load(f)
+            if formatVersion != self.formatVersion:
+                self.tagSummaries, self.successSignatures, self.pages = {}, {}, {}
+        except Exception as e:
+            # It's only a cache, so just start again
+            self.diag.info("Could not read model at " + self.fileName + " : " + str(e))
+            self.tagSummaries, self.successSignatures, self.pages = {}, {}, {}
+        self.diag.info("Read model with " + str(len(self.tagSummaries)) + " versions and " + str(len(self.pages)) + " pages")
+
+    def getTagSummaries(self, version):
+        return self.tagSummaries.setdefault(version, {})
+
+    def getSuccessSignatures(self, version):
+        return self.successSignatures.setdefault(version, {})
+
+    def updatePage(self, pageFile, inputs):
+        # Returns True if the page needs writing
+        digest = hashlib.md5(repr(inputs).encode()).hexdigest()
+        if self.pages.get(pageFile) == digest and os.path.isfile(pageFile):
+            return False
+        self.pages[pageFile] = digest
+        return True
+
+    def save(self, versions):
+        # Forget versions that are no longer in the repository
+        for version in list(self.tagSummaries.keys()):
+            if version not in versions:
+                del self.tagSummaries[version]
+                self.successSignatures.pop(version, None)
+        tmpFileName = self.fileName + ".tmp"
+        try:
+            plugins.ensureDirectoryExists(os.path.dirname(self.fileName))
+            with open(tmpFileName, "wb") as f:
+                pickle.dump((self.formatVersion, self.tagSummaries, self.successSignatures, self.pages),
+                            f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpFileName, self.fileName)
+        except EnvironmentError as e:
+            plugins.printWarning("Could not save historical report model at " + self.fileName + " : " + str(e))
+
+
 class GenerateWebPages(object):
     def __init__(self, getConfigValue, pageDir, resourceNames,
                  pageTitle, pageSubTitles, pageVersion, extraVersions, descriptionInfo):
@@ -100,36 +231,35 @@ class GenerateWebPages(object):
             allSelectors.append(Selector(subPageName, suffix, self.getConfigValue, tags))
         return allSelectors
 
-    def removeUnused(self, unused, tagData):
-        successTags = {}
+    def removeUnused(self, unused, tagData, successFiles, model, version):
+        summaries = model.getTagSummaries(version)
         for tag in unused:
-            for fn in tagData.get(tag):
-                if os.path.basename(fn).startswith("teststate_"):
-                    os.remove(fn)
-                else:
-                    successTags.setdefault(fn, []).append(tag)
-        for fn, tagsToRemove in list(successTags.items()):
-            linesToKeep = []
+            for fn, _ in tagData.get(tag, []):
+                os.remove(fn)
+            summaries.pop(tag, None)
+        successSignatures = model.getSuccessSignatures(version)
+        for fn, _ in successFiles:
             with open(fn) as readFile:
-                for line in readFile:
-                    tag = line.strip().split()[0]
-                    if tag not in tagsToRemove:
-                        linesToKeep.append(line)
-
-            with open(fn, "w") as writeFile:
-                for line in linesToKeep:
-                    writeFile.write(line)
+                lines = readFile.readlines()
+            linesToKeep = [line for line in lines if line.split(" ", 1)[0].strip() not in unused]
+            if len(linesToKeep) < len(lines):
+                with open(fn, "w") as writeFile:
+                    for line in linesToKeep:
+                        writeFile.write(line)
+                # The lines removed are for tags the model has just forgotten
+                successSignatures[fn] = getSignature(fn)
 
     def generate(self, repositoryDirs, subPageNames, archiveUnused):
-        minorVersionHeader = HTMLgen.Container()
+        model = ResultModel(self.getModelFile())
         allMonthSelectors = set()
         latestMonth = None
-        pageToGraphs = {}
+        versionData = []
         for version, repositoryDirInfo in list(repositoryDirs.items()):
             self.diag.info("Generating " + version)
-            tagData, stateFiles, successFiles = self.findTestStateFilesAndTags(repositoryDirInfo)
-            if len(stateFiles) > 0 or len(successFiles) > 0:
-                tags = list(tagData.keys())
+            tagData, stateFiles, successFiles, storeFiles = self.findTestStateFilesAndTags(repositoryDirInfo)
+            summaries = self.updateModel(model, version, tagData, successFiles)
+            if len(summaries) > 0:
+                tags = list(summaries.keys())
                 tags.sort(key=self.tagSortKey)
                 selectors = self.makeSelectors(subPageNames, tags)
                 monthSelectors = SelectorByMonth.makeInstances(tags)
@@ -158,78 +288,10 @@ class GenerateWebPages(object):
                             plugins.log.info("- " + tag)
                         plugins.log.info(
                             "(To disable automatic repository cleaning in future, please run with the --manualarchive flag when collating the HTML report.)")
-                        self.removeUnused(unusedTags, tagData)
-
-                loggedTests = OrderedDict()
-                categoryHandlers = {}
-                self.diag.info("Processing " + str(len(stateFiles)) + " teststate files")
-                relevantFiles = 0
-                for stateFile, repository in stateFiles:
-                    tag = self.getTagFromFile(stateFile)
-                    if len(tags) == 0 or tag in tags:
-                        relevantFiles += 1
-                        testId, state, extraVersion = self.processTestStateFile(stateFile, repository)
-                        loggedTests.setdefault(extraVersion, OrderedDict()).setdefault(
-                            testId, OrderedDict())[tag] = state
-                        categoryHandlers.setdefault(tag, CategoryHandler()).registerInCategory(
-                            testId, state.category, extraVersion, state)
-                        if relevantFiles % 100 == 0:
-                            self.diag.info("- Processed " + str(relevantFiles) + " files with matching tags so far")
-                self.diag.info("Processed " + str(relevantFiles) + " relevant teststate files")
-                self.diag.info("Processing " + str(len(successFiles)) + " success files")
-                for successFile, repository in successFiles:
-                    testId = self.getTestIdentifier(successFile, repository)
-                    extraVersion = self.findExtraVersion(repository)
-                    with open(successFile) as f:
-                        fileTags = set()
-                        for line in f:
-                            parts = line.strip().split(" ", 1)
-                            if len(parts) != 2:
-                                continue
-                            tag, text = parts
-                            if tag in fileTags:
-                                sys.stderr.write("WARNING: more than one result present for tag '" +
-                                                 tag + "' in file " + successFile + "!\n")
-                                sys.stderr.write("Ignoring later ones\n")
-                                continue
-
-                            fileTags.add(tag)
-                            if len(tags) == 0 or tag in tags:
-                                loggedTests.setdefault(extraVersion, OrderedDict()).setdefault(
-                                    testId, OrderedDict())[tag] = text
-                                categoryHandlers.setdefault(tag, CategoryHandler()).registerInCategory(
-                                    testId, "success", extraVersion, text)
-                self.diag.info("Processed " + str(len(successFiles)) + " success files")
-                versionToShow = self.removePageVersion(version)
-                hasData = False
-                for sel in selectors:
-                    filePath = self.getPageFilePath(sel)
-                    if filePath in self.pagesOverview:
-                        page, pageColours = self.pagesOverview[filePath]
-                    else:
-                        page = self.createPage()
-                        pageColours = {"last_column": set(), "all_columns": set()}
-                        self.pagesOverview[filePath] = page, pageColours
-
-                    tableHeader = self.getTableHeader(version, repositoryDirs)
-                    heading = self.getHeading(versionToShow)
-                    hasNewData, graphLink, tableColours = self.addTable(page, self.resourceNames, categoryHandlers, version,
-                                                                        loggedTests, sel, tableHeader, filePath, heading, repositoryDirInfo)
-                    hasData |= hasNewData
-                    for colourGroupKey in tableColours:
-                        pageColours[colourGroupKey].update(tableColours[colourGroupKey])
-                    if graphLink:
-                        pageToGraphs.setdefault(page, []).append(graphLink)
-
-                if hasData and versionToShow:
-                    link = HTMLgen.Href("#" + version, versionToShow)
-                    minorVersionHeader.append(link)
-
-                # put them in reverse order, most relevant first
-                linkFromDetailsToOverview = [sel.getLinkInfo(self.pageVersion) for sel in allSelectors]
-                for tag in tags:
-                    details = self.pagesDetails.setdefault(tag, TestDetails(tag, self.pageTitle, self.pageSubTitles))
-                    details.addVersionSection(version, categoryHandlers[tag], linkFromDetailsToOverview)
+                        self.removeUnused(unusedTags, tagData, successFiles, model, version)
+
+                resultFiles = stateFiles, successFiles, storeFiles
+                versionData.append((version, repositoryDirInfo, tags, selectors, allSelectors, summaries, resultFiles))
 
         selContainer = HTMLgen.Container()
         selectors = self.makeSelectors(subPageNames)
@@ -247,6 +309,48 @@ class GenerateWebPages(object):
             target, linkName = sel.getLinkInfo(self.pageVersion)
             monthContainer.append(HTMLgen.Href(target, linkName))
 
+        minorVersionHeader = HTMLgen.Container()
+        for version, _, _, selectors, _, summaries, _ in versionData:
+            versionToShow = self.removePageVersion(version)
+            if versionToShow and any((self.hasResults(summaries, sel.selectedTags) for sel in selectors)):
+                minorVersionHeader.append(HTMLgen.Href("#" + version, versionToShow))
+
+        pagesToWrite, detailsToWrite = self.findChangedPages(model, versionData, repositoryDirs,
+                                                             [selContainer, monthContainer, minorVersionHeader])
+        pageToGraphs = {}
+        for version, repositoryDirInfo, tags, selectors, allSelectors, summaries, resultFiles in versionData:
+            versionToShow = self.removePageVersion(version)
+            selectorsToWrite = [sel for sel in selectors if self.getPageFilePath(sel) in pagesToWrite]
+            # Only the runs shown on pages being written need reading
+            tagsToRead = set((tag for tag in tags if tag in detailsToWrite))
+            for sel in selectorsToWrite:
+                tagsToRead.update(sel.selectedTags)
+            results = self.collectResults(tagsToRead, *resultFiles)
+            for sel in selectorsToWrite:
+                filePath = self.getPageFilePath(sel)
+                if filePath in self.pagesOverview:
+                    page, pageColours = self.pagesOverview[filePath]
+                else:
+                    page = self.createPage()
+                    pageColours = {"last_column": set(), "all_columns": set()}
+                    self.pagesOverview[filePath] = page, pageColours
+
+                tableHeader = self.getTableHeader(version, repositoryDirs)
+                heading = self.getHeading(versionToShow)
+                _, graphLink, tableColours = self.addTable(page, self.resourceNames, results.categoryHandlers, version,
+                                                           results.loggedTests, sel, tableHeader, filePath, heading, repositoryDirInfo)
+                for colourGroupKey in tableColours:
+                    pageColours[colourGroupKey].update(tableColours[colourGroupKey])
+                if graphLink:
+                    pageToGraphs.setdefault(page, []).append(graphLink)
+
+            # put them in reverse order, most relevant first
+            linkFromDetailsToOverview = [sel.getLinkInfo(self.pageVersion) for sel in allSelectors]
+            for tag in tags:
+                if tag in detailsToWrite:
+                    details = self.pagesDetails.setdefault(tag, TestDetails(tag, self.pageTitle, self.pageSubTitles))
+                    details.addVersionSection(version, results.categoryHandlers[tag], linkFromDetailsToOverview)
+
         for page, pageColours in list(self.pagesOverview.values()):
             if len(monthContainer.contents) > 0:
                 page.prepend(HTMLgen.Heading(2, monthContainer, align='center'))
@@ -265,6 +369,154 @@ class GenerateWebPages(object):
                 page.script = self.getFilterScripts(pageColours)
 
         self.writePages()
+        model.save(repositoryDirs)
+
+    def getModelFile(self):
+        # Not in pageDir, which is published
+        pagePrefix = os.path.join(os.path.abspath(self.pageDir), "test_" + self.pageVersion)
+        return os.path.join(plugins.getPersonalDir("historical_report"), hashlib.md5(pagePrefix.encode()).hexdigest() + ".pickle")
+
+    def hasResults(self, summaries, tags):
+        return any((sum(summaries[tag].getCategoryCounts().values()) > 0 for tag in tags if tag in summaries))
+
+    def updateModel(self, model, version, tagData, successFiles):
+        summaries = model.getTagSummaries(version)
+        self.updateSuccessSummaries(model.getSuccessSignatures(version), summaries, successFiles)
+        self.updateFileSummaries(summaries, tagData)
+        for tag in [tag for tag, summary in summaries.items() if summary.isEmpty()]:
+            del summaries[tag]
+        return summaries
+
+    def updateFileSummaries(self, summaries, tagData):
+        # The newest run may have been collated again under the same tag, so only its files are checked for changes
+        knownTags = [tag for tag, summary in summaries.items() if summary.fileCount > 0]
+        newestTag = max(knownTags, key=self.tagSortKey) if knownTags else None
+        for tag, summary in summaries.items():
+            if tag not in tagData:
+                summary.setFiles(0, 0, {})
+        tagsRead = 0
+        for tag, entries in tagData.items():
+            summary = summaries.setdefault(tag, TagSummary())
+            if summary.fileCount == len(entries) and tag != newestTag:
+                continue
+            fileDigest = sum((hashEntry(path, getSignature(path)) for path, _ in entries)) % TagSummary.digestModulus
+            if summary.fileCount == len(entries) and summary.fileDigest == fileDigest:
+                continue
+            categoryCounts = {}
+            for path, repository in entries:
+                for _, _, result in self.processResultFile(path, repository):
+                    category = getResultCategory(result)
+                    categoryCounts[category] = categoryCounts.get(category, 0) + 1
+            summary.setFiles(len(entries), fileDigest, categoryCounts)
+            tagsRead += 1
+        self.diag.info("Read teststate and consolidated files for " + str(tagsRead) + " runs not in the model")
+
+    def updateSuccessSummaries(self, successSignatures, summaries, successFiles):
+        # Signatures are the modification time and how much has been read: anything else means a rewrite
+        offsets = []
+        currentPaths = set((path for path, _ in successFiles))
+        rebuild = any((path not in currentPaths for path in successSignatures))
+        for path, repository in successFiles:
+            oldSignature = successSignatures.get(path)
+            signature = getSignature(path)
+            if oldSignature is None:
+                offsets.append((path, repository, 0))
+            elif signature is None or signature[1] < oldSignature[1] or \
+                    (signature[1] == oldSignature[1] and signature[0] != oldSignature[0]):
+                rebuild = True
+            elif signature[1] > oldSignature[1]:
+                offsets.append((path, repository, oldSignature[1]))
+        if rebuild:
+            self.diag.info("succeeded_runs files have been rewritten, reading them all again")
+            for summary in summaries.values():
+                summary.resetSuccesses()
+            successSignatures.clear()
+            offsets = [(path, repository, 0) for path, repository in successFiles]
+        for path, repository, offset in offsets:
+            testId = self.getTestIdentifier(path, repository)
+            extraVersion = self.findExtraVersion(repository)
+            with open(path, "rb") as f:
+                mtime = os.fstat(f.fileno()).st_mtime_ns
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break  # still being written, read it next time
+                    offset += len(line)
+                    parts = line.decode(errors="replace").strip().split(" ", 1)
+                    if len(parts) == 2:
+                        tag, text = parts
+                        summaries.setdefault(tag, TagSummary()).addSuccess(hashEntry(extraVersion, testId, text))
+            successSignatures[path] = mtime, offset
+        self.diag.info("Read new results from " + str(len(offsets)) + " succeeded_runs files")
+
+    def collectResults(self, tags, stateFiles, successFiles, storeFiles):
+        results = VersionResults()
+        if len(tags) == 0:
+            return results
+        self.diag.info("Processing " + str(len(stateFiles)) + " teststate files")
+        relevantFiles = 0
+        for stateFile, repository in stateFiles:
+            tag = self.getTagFromFile(stateFile)
+            if tag in tags:
+                relevantFiles += 1
+                extraVersion = self.findExtraVersion(repository)
+                for testId, _, state in self.processTestStateFile(stateFile, repository):
+                    results.register(extraVersion, testId, tag, state)
+                if relevantFiles % 100 == 0:
+                    self.diag.info("- Processed " + str(relevantFiles) + " files with matching tags so far")
+        self.diag.info("Processed " + str(relevantFiles) + " relevant teststate files")
+        self.diag.info("Processing " + str(len(successFiles)) + " success files")
+        for successFile, repository in successFiles:
+            extraVersion = self.findExtraVersion(repository)
+            for testId, tag, text in self.processSuccessFile(successFile, repository):
+                if tag in tags:
+                    results.register(extraVersion, testId, tag, text)
+        self.diag.info("Processed " + str(len(successFiles)) + " success files")
+        self.diag.info("Processing " + str(len(storeFiles)) + " consolidated files")
+        for storeFile, repository in storeFiles:
+            tag = getStoreTag(storeFile)
+            if tag in tags:
+                extraVersion = self.findExtraVersion(repository)
+                for testId, _, result in self.processStoreFile(storeFile, repository):
+                    results.register(extraVersion, testId, tag, result)
+        self.diag.info("Processed " + str(len(storeFiles)) + " consolidated files")
+        return results
+
+    def findChangedPages(self, model, versionData, repositoryDirs, navigation):
+        # Pages are only rendered again if something they show has changed since the model was last saved
+        settings = self.getRenderSettings(navigation)
+        pageInputs, detailInputs = OrderedDict(), OrderedDict()
+        for version, _, tags, selectors, allSelectors, summaries, _ in versionData:
+            for sel in selectors:
+                digests = [summaries[tag].getDigest() for tag in sel.selectedTags]
+                pageInputs.setdefault(self.getPageFilePath(sel), []).append(
+                    (version, self.getTableHeader(version, repositoryDirs), sel.selectedTags, digests))
+            linkFromDetailsToOverview = [sel.getLinkInfo(self.pageVersion) for sel in allSelectors]
+            for tag in tags:
+                detailInputs.setdefault(tag, []).append((version, summaries[tag].getDigest(), linkFromDetailsToOverview))
+
+        # Changes fetched from the CI system can't be tracked, so always ask it again
+        alwaysWrite = bool(CIPlatform.getInstance().getCiUrl())
+        pagesToWrite = set()
+        for filePath, inputs in pageInputs.items():
+            if model.updatePage(filePath, (settings, inputs)) or alwaysWrite:
+                pagesToWrite.add(filePath)
+        detailsToWrite = set()
+        for tag, inputs in detailInputs.items():
+            # Not the subtitles: the reconnect command changes every run, and only makes sense for the latest one
+            filePath = os.path.join(self.pageDir, getDetailPageName(self.pageVersion, tag))
+            if model.updatePage(filePath, (self.pageTitle, inputs)):
+                detailsToWrite.add(tag)
+        unchanged = len(pageInputs) + len(detailInputs) - len(pagesToWrite) - len(detailsToWrite)
+        if unchanged:
+            plugins.log.info("Not rewriting " + str(unchanged) + " pages, their results have not changed")
+        return pagesToWrite, detailsToWrite
+
+    def getRenderSettings(self, navigation):
+        links = [[(link.url, link.text) for link in container.contents] for container in navigation]
+        config = [self.getConfigValue(key, allSubKeys=True) for key in
+                  ["historical_report_colours", "performance_variation_serious_%", "batch_include_comment_plugin"]]
+        return links, config, self.resourceNames, sorted(self.descriptionInfo.items())
 
     def getFilterScripts(self, pageColours):
         finder = ColourFinder(self.getConfigValue)
@@ -306,35 +558,71 @@ class GenerateWebPages(object):
     def getTagFromFile(self, fileName):
         return os.path.basename(fileName).replace("teststate_", "")
 
+    def processStoreFile(self, storeFile, repository):
+        storeDir = os.path.dirname(storeFile)
+        fileResults = []
+        testIds = set()
+        for relPath, kind, payload in TestStateStore(storeFile).readRecords():
+            testId = self.getTestIdentifier(os.path.join(storeDir, relPath, os.path.basename(storeFile)), repository)
+            if testId in testIds:
+                continue  # only written again by accident, keep the first like the success files do
+            testIds.add(testId)
+            if kind == TestStateStore.stateRecord:
+                result = self.loadState(BytesIO(payload))
+            else:
+                result = payload
+            fileResults.append((testId, None, result))
+        return fileResults
+
+    def processSuccessFile(self, successFile, repository):
+        testId = self.getTestIdentifier(successFile, repository)
+        fileResults = []
+        with open(successFile) as f:
+            fileTags = set()
+            for line in f:
+                parts = line.strip().split(" ", 1)
+                if len(parts) != 2:
+                    continue
+                tag, text = parts
+                if tag in fileTags:
+                    sys.stderr.write("WARNING: more than one result present for tag '" +
+                                     tag + "' in file " + successFile + "!\n")
+                    sys.stderr.write("Ignoring later ones\n")
+                    continue
+
+                fileTags.add(tag)
+                fileResults.append((testId, tag, text))
+        return fileResults
+
     def findTestStateFilesAndTags(self, repositoryDirs):
-        tagData, stateFiles, successFiles = {}, [], []
+        # Only lists directories: the model knows which tags it has seen, and succeeded_runs files are read by updateModel
+        tagData, stateFiles, successFiles, storeFiles = {}, [], [], []
         for _, dir in repositoryDirs:
             self.diag.info("Looking for teststate files in " + dir)
             for root, _, files in sorted(os.walk(dir)):
                 for file in files:
                     path = os.path.join(root, file)
                     if file.startswith("teststate_"):
-                        tag = self.getTagFromFile(file)
                         stateFiles.append((path, dir))
-                        tagData.setdefault(tag, []).append(path)
+                        tagData.setdefault(self.getTagFromFile(file), []).append((path, dir))
+                    elif isStoreFile(file):
+                        storeFiles.append((path, dir))
+                        tagData.setdefault(getStoreTag(file), []).append((path, dir))
                     elif file.startswith("succeeded_"):
                         successFiles.append((path, dir))
-                        with open(path) as f:
-                            for line in f:
-                                parts = line.split()
-                                if parts:
-                                    tag = parts[0]
-                                    tagData.setdefault(tag, []).append(path)
 
-            self.diag.info("Found " + str(len(stateFiles)) + " teststate files and " +
-                           str(len(successFiles)) + " success files in " + dir)
-        return tagData, stateFiles, successFiles
+            self.diag.info("Found " + str(len(stateFiles)) + " teststate files, " + str(len(successFiles)) +
+                           " success files and " + str(len(storeFiles)) + " consolidated files in " + dir)
+        return tagData, stateFiles, successFiles, storeFiles
+
+    def processResultFile(self, path, repository):
+        if isStoreFile(path):
+            return self.processStoreFile(path, repository)
+        else:
+            return self.processTestStateFile(path, repository)
 
     def processTestStateFile(self, stateFile, repository):
-        state = self.readState(stateFile)
-        testId = self.getTestIdentifier(stateFile, repository)
-        extraVersion = self.findExtraVersion(repository)
-        return testId, state, extraVersion
+        return [(self.getTestIdentifier(stateFile, repository), None, self.readState(stateFile))]
 
     def findExtraVersion(self, repository):
         versions = os.path.basename(repository).split(".")
@@ -346,7 +634,11 @@ class GenerateWebPages(object):
 
     @classmethod
     def readState(cls, stateFile):
-        file = open(stateFile, "rb")
+        with open(stateFile, "rb") as file:
+            return cls.loadState(file)
+
+    @classmethod
+    def loadState(cls, file):
         try:
             state = plugins.getNewTestStateFromFile(file)
             if isinstance(state, plugins.TestState):
@@ -354,7 +646,8 @@ class GenerateWebPages(object):
             else:
                 return cls.readErrorState("Incorrect type for state object.")
         except Exception as e:
-            if os.path.getsize(stateFile) > 0:
+            file.seek(0, os.SEEK_END)
+            if file.tell() > 0:
                 return cls.readErrorState("Stack info follows:\n" + str(e))
             else:
                 return plugins.Unrunnable("Results file was empty, probably the disk it resides on is full.", "Disk full?")
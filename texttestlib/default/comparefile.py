@@ -1,5 +1,6 @@
 
 import os
+import sys
 import filecmp
 import time
 import subprocess
@@ -7,24 +8,115 @@ import logging
 import re
 from texttestlib import plugins
 from shutil import copyfile
+from difflib import SequenceMatcher
+from itertools import zip_longest, islice
+from locale import getpreferredencoding
 
 from fnmatch import fnmatch
 
 
+class TextDiff:
+    """ In-process equivalent of running 'diff' on two files, producing the same 'normal' output format.
+    Compares the files in a single pass while they agree, and only matches up lines from the first difference.
+    Matching takes time proportional to the square of the lines left, so beyond maxLines it gives up """
+    def __init__(self, stdFile, tmpFile, maxLines=-1):
+        self.stdFile = stdFile
+        self.tmpFile = tmpFile
+        self.maxLines = maxLines
+        self.encoding = getpreferredencoding()
+
+    def findDifferences(self):
+        # Returns None if the files are identical. Otherwise the line number of the first difference, and the
+        # lines from there, or None for the lines if there are too many to match up here
+        binary = False
+        with open(self.stdFile, "rb") as stdF, open(self.tmpFile, "rb") as tmpF:
+            lineNumber = 0
+            for stdLine, tmpLine in zip_longest(stdF, tmpF):
+                if stdLine != tmpLine:
+                    if binary:
+                        return lineNumber, True, None, None
+                    stdLines, tmpLines = self.readRemainder(stdF, stdLine), self.readRemainder(tmpF, tmpLine)
+                    if stdLines is None or tmpLines is None:
+                        return lineNumber, False, None, None
+                    binary = any(b"\0" in line for line in stdLines + tmpLines)
+                    return lineNumber, binary, stdLines, tmpLines
+                if b"\0" in stdLine:
+                    binary = True
+                lineNumber += 1
+
+    def readRemainder(self, f, firstLine):
+        if firstLine is None:
+            return []
+        if self.maxLines < 0:
+            return [firstLine] + f.readlines()
+        lines = [firstLine] + list(islice(f, self.maxLines))
+        if len(lines) <= self.maxLines:
+            return lines
+
+    @staticmethod
+    def canMatch(differences):
+        return differences[1] or differences[2] is not None
+
+    def getOutputLines(self, differences):
+        offset, binary, stdLines, tmpLines = differences
+        if binary:
+            yield "Binary files " + self.stdFile + " and " + self.tmpFile + " differ\n"
+            return
+        matcher = SequenceMatcher(None, stdLines, tmpLines, autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == "equal":
+                continue
+            if tag == "replace":
+                yield self.getRange(i1, i2, offset) + "c" + self.getRange(j1, j2, offset) + "\n"
+            elif tag == "delete":
+                yield self.getRange(i1, i2, offset) + "d" + str(j1 + offset) + "\n"
+            else:
+                yield str(i1 + offset) + "a" + self.getRange(j1, j2, offset) + "\n"
+            for line in stdLines[i1:i2]:
+                yield from self.formatLine("< ", line)
+            if tag == "replace":
+                yield "---\n"
+            for line in tmpLines[j1:j2]:
+                yield from self.formatLine("> ", line)
+
+    @staticmethod
+    def getRange(start, end, offset):
+        first, last = start + offset + 1, end + offset
+        return str(first) if first == last else str(first) + "," + str(last)
+
+    def formatLine(self, prefix, line):
+        text = line.decode(self.encoding, "replace")
+        if text.endswith("\r\n"):
+            yield prefix + text[:-2] + "\n"
+        elif text.endswith("\n"):
+            yield prefix + text
+        else:
+            yield prefix + text + "\n"
+            yield "\\ No newline at end of file\n"
+
+
 class FileComparison:
     SAME = 0
     DIFFERENT = 1
     APPROVED = 2
+    # There is one of these for every file of every test, so keep them small.
+    # The filtered file names are derived from cmpFileBase rather than stored in full
+    __slots__ = ("stdFile", "tmpFile", "cmpFileBase", "stdCmpPostfix", "tmpCmpPostfix", "stem", "differenceCache",
+                 "recalculationTime", "severity", "displayPriority", "binaryFile", "previewGenerator",
+                 "textDiffTool", "textDiffToolMaxSize", "useInternalDiff", "internalDiffMaxLines", "freeTextBody")
+    cmpPostfixes = ["origcmp", "partcmp", "cmp"]
+    previewGenerators = {}
+    diag = logging.getLogger("FileComparison")
 
     def __init__(self, test, stem, standardFile, tmpFile, testInProgress=False, **kw):
         self.stdFile = standardFile
-        self.stdCmpFile = self.stdFile
         self.tmpFile = tmpFile
-        self.tmpCmpFile = tmpFile
+        self.cmpFileBase = None
+        self.stdCmpPostfix = None
+        self.tmpCmpPostfix = None
         self.stem = stem
         self.differenceCache = self.SAME
         self.recalculationTime = None
-        self.diag = logging.getLogger("FileComparison")
         stemForConfig = self.stemForConfig()
         self.severity = test.getCompositeConfigValue("failure_severity", stemForConfig)
         self.displayPriority = test.getCompositeConfigValue("failure_display_priority", stemForConfig)
@@ -34,21 +126,36 @@ class FileComparison:
         # mechanism, such as the *nix 'file' command, but as the first implementation I've
         # chosen to use a manually created list instead.
         self.binaryFile = test.configValueMatches("binary_file", stemForConfig)
-        self.previewGenerator = plugins.PreviewGenerator(maxWidth, maxLength)
+        self.previewGenerator = self.getPreviewGenerator(maxWidth, maxLength)
         self.textDiffTool = test.getConfigValue("text_diff_program")
         self.textDiffToolMaxSize = plugins.parseBytes(test.getCompositeConfigValue("max_file_size", self.textDiffTool))
+        self.useInternalDiff = self.textDiffTool == "diff" and not test.getConfigValue("use_external_text_diff_program")
+        self.internalDiffMaxLines = test.getConfigValue("internal_text_diff_max_lines")
         self.freeTextBody = None
         # subclasses may override if they don't want to store in this way
         self.cacheDifferences(test, testInProgress)
         self.diag.info("Created file comparison std: " + repr(self.stdFile) + " tmp: " +
                        repr(self.tmpFile) + " diff: " + repr(self.differenceCache))
 
+    @classmethod
+    def getPreviewGenerator(cls, maxWidth, maxLength):
+        # Shared by all comparisons with the same settings
+        return cls.previewGenerators.setdefault((maxWidth, maxLength), plugins.PreviewGenerator(maxWidth, maxLength))
+
+    @property
+    def stdCmpFile(self):
+        return self.stdFile if self.stdCmpPostfix is None else self.cmpFileBase + self.stdCmpPostfix
+
+    @property
+    def tmpCmpFile(self):
+        return self.tmpFile if self.tmpCmpPostfix is None else self.cmpFileBase + self.tmpCmpPostfix
+
     def stemForConfig(self):
         return self.stem
 
     def setStandardFile(self, standardFile):
         self.stdFile = standardFile
-        self.stdCmpFile = self.stdFile
+        self.stdCmpPostfix = None
         self.diag.info("Setting standard file for " + self.stem + " to " + repr(standardFile))
 
     def recompute(self, test):
@@ -61,7 +168,7 @@ class FileComparison:
             elif self.differenceCache == self.DIFFERENT:
                 # File has been removed
                 self.tmpFile = None
-                self.tmpCmpFile = None
+                self.tmpCmpPostfix = None
                 self.differenceCache = self.SAME
 
     def split(self, test, separators):
@@ -130,17 +237,39 @@ class FileComparison:
         return dirs
 
     def __getstate__(self):
-        # don't pickle the diagnostics
-        state = {}
-        for var, value in list(self.__dict__.items()):
-            if var != "diag" and var != "recalculationTime":
-                state[var] = value
+        state = {var: getattr(self, var) for var in FileComparison.__slots__ if hasattr(self, var)}
+        state.update(getattr(self, "__dict__", {}))  # from subclasses
+        state.pop("recalculationTime", None)
         return state
 
     def __setstate__(self, state):
-        self.__dict__ = state
-        self.diag = logging.getLogger("TestComparison")
+        state = dict(state)
+        state.pop("diag", None)
         self.recalculationTime = None
+        # Not present in files pickled by older versions
+        state.setdefault("useInternalDiff", False)
+        self.cmpFileBase, self.stdCmpPostfix, self.tmpCmpPostfix = None, None, None
+        if "stdCmpFile" in state:
+            # Older versions stored the full names of the filtered files
+            self.setCmpFilesFromNames(state.pop("stdCmpFile"), state.pop("tmpCmpFile", None),
+                                      state.get("stdFile"), state.get("tmpFile"))
+        for var, value in state.items():
+            setattr(self, var, value)
+        # Every test has its own copy of these once unpickled, unless we share them
+        self.stem = sys.intern(self.stem)
+        if isinstance(self.textDiffTool, str):
+            self.textDiffTool = sys.intern(self.textDiffTool)
+        if self.previewGenerator is not None:
+            self.previewGenerator = self.getPreviewGenerator(self.previewGenerator.maxWidth, self.previewGenerator.maxLength)
+
+    def setCmpFilesFromNames(self, stdCmpFile, tmpCmpFile, stdFile, tmpFile):
+        for cmpFile, origFile, postfixVar in [(stdCmpFile, stdFile, "stdCmpPostfix"), (tmpCmpFile, tmpFile, "tmpCmpPostfix")]:
+            if cmpFile and cmpFile != origFile:
+                postfix = next((p for p in self.cmpPostfixes if cmpFile.endswith(p)), "")
+                base = cmpFile[:len(cmpFile) - len(postfix)]
+                if self.cmpFileBase is None or base == self.cmpFileBase:
+                    self.cmpFileBase = base
+                    setattr(self, postfixVar, postfix)
 
     def __repr__(self):
         return self.stem
@@ -233,19 +362,16 @@ class FileComparison:
             return self.getTmpFile(*args)
 
     def setCmpFiles(self, test, testInProgress):
-        filterFileBase = test.makeTmpFileName(self.stem + "." + test.app.name, forFramework=1)
-        origCmp = filterFileBase + "origcmp"
-        if os.path.isfile(origCmp):
-            self.stdCmpFile = origCmp
-        tmpCmpFileName = filterFileBase + "cmp"
-        if testInProgress:
-            tmpCmpFileName = filterFileBase + "partcmp"
-        if os.path.isfile(tmpCmpFileName):
-            self.tmpCmpFile = tmpCmpFileName
+        self.cmpFileBase = test.makeTmpFileName(self.stem + "." + test.app.name, forFramework=1)
+        if os.path.isfile(self.cmpFileBase + "origcmp"):
+            self.stdCmpPostfix = "origcmp"
+        tmpCmpPostfix = "partcmp" if testInProgress else "cmp"
+        if os.path.isfile(self.cmpFileBase + tmpCmpPostfix):
+            self.tmpCmpPostfix = tmpCmpPostfix
 
     def updateDifferenceCache(self, valueForEqual):
         if self.stdCmpFile and self.tmpCmpFile:
-            if filecmp.cmp(self.stdCmpFile, self.tmpCmpFile, 0):
+            if self.filesEqual():
                 if self.differenceCache != self.APPROVED:
                     self.differenceCache = valueForEqual
             else:
@@ -253,9 +379,42 @@ class FileComparison:
             self.diag.info("Caching differences " + repr(self.stdCmpFile) + " " +
                            repr(self.tmpCmpFile) + " = " + repr(self.differenceCache))
 
+    def filesEqual(self):
+        if self.useInternalDiff and not self.filesTooLarge(*self.getCmpFileSizes()):
+            # Find the differences straight away, rather than reading the files again for the preview
+            differences = self.makeTextDiff().findDifferences()
+            if differences is None:
+                return True
+            if TextDiff.canMatch(differences):
+                self.freeTextBody = self.getInternalDiffPreview(differences)
+            return False
+        else:
+            return filecmp.cmp(self.stdCmpFile, self.tmpCmpFile, 0)
+
+    def getCmpFileSizes(self):
+        try:
+            return os.path.getsize(self.stdCmpFile), os.path.getsize(self.tmpCmpFile)
+        except OSError:
+            return 0, 0
+
+    def filesTooLarge(self, stdFileSize, tmpFileSize):
+        return self.textDiffToolMaxSize >= 0 and \
+            (stdFileSize > self.textDiffToolMaxSize or tmpFileSize > self.textDiffToolMaxSize)
+
+    def makeTextDiff(self):
+        return TextDiff(self.stdCmpFile, self.tmpCmpFile, self.internalDiffMaxLines)
+
+    def getInternalDiffPreview(self, differences):
+        textDiff = self.makeTextDiff()
+        # Only as much output as the preview will show
+        lines = list(islice(textDiff.getOutputLines(differences), self.previewGenerator.maxLength))
+        return self.previewGenerator.getPreviewFromLines(lines)
+
     def cacheDifferences(self, test, testInProgress):
         self.setCmpFiles(test, testInProgress)
-        self.updateDifferenceCache(self.SAME)
+        # Progress is reckoned from file sizes alone, so comparing the partial files would be wasted
+        if not testInProgress:
+            self.updateDifferenceCache(self.SAME)
 
     def getSummary(self, includeNumbers=True):
         if self.newResult():
@@ -300,20 +459,30 @@ class FileComparison:
         try:
             stdFileSize = os.path.getsize(self.stdCmpFile)
             tmpFileSize = os.path.getsize(self.tmpCmpFile)
-            if self.textDiffToolMaxSize >= 0 and \
-                (stdFileSize > self.textDiffToolMaxSize or
-                    tmpFileSize > self.textDiffToolMaxSize):
+            if self.filesTooLarge(stdFileSize, tmpFileSize):
                 message = "The result files were too large to compare - " + str(stdFileSize) + " and " + \
                           str(tmpFileSize) + " bytes, compared to the limit of " + str(self.textDiffToolMaxSize) + \
                           " bytes. Adjust the configuration entry 'max_file_size' for the tool '" + self.textDiffTool + \
                           "' and re-run to see the difference in this text view.\n"
                 return self.previewGenerator.getWrappedLine(message)
 
+            if self.useInternalDiff:
+                differences = self.makeTextDiff().findDifferences()
+                if differences is None:
+                    return ""
+                elif TextDiff.canMatch(differences):
+                    return self.getInternalDiffPreview(differences)
+                # Too much to match up here, 'diff' itself is much faster
+
             cmdArgs = plugins.splitcmd(self.textDiffTool) + [self.stdCmpFile, self.tmpCmpFile]
             proc = subprocess.Popen(cmdArgs, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
             return self.previewGenerator.getPreview(proc.stdout)
         except OSError as e:
             self.diag.info("No diff report: full exception printout\n" + plugins.getExceptionString())
+            if self.useInternalDiff:  # no 'diff' installed, so take as long as it takes
+                textDiff = TextDiff(self.stdCmpFile, self.tmpCmpFile)
+                lines = islice(textDiff.getOutputLines(textDiff.findDifferences()), self.previewGenerator.maxLength)
+                return self.previewGenerator.getPreviewFromLines(list(lines))
             return "No difference report could be created: could not find textual difference tool '" + self.textDiffTool + "'\n" + \
                    "(" + str(e) + ")"
 
@@ -321,10 +490,10 @@ class FileComparison:
         for oldPath, newPath in changedPaths:
             if self.stdFile:
                 self.stdFile = self.stdFile.replace(oldPath, newPath)
-                self.stdCmpFile = self.stdCmpFile.replace(oldPath, newPath)
             if self.tmpFile:
-                self.tmpCmpFile = self.tmpCmpFile.replace(oldPath, newPath)
                 self.tmpFile = self.tmpFile.replace(oldPath, newPath)
+            if self.cmpFileBase:
+                self.cmpFileBase = self.cmpFileBase.replace(oldPath, newPath)
 
     def versionise(self, fileName, versionString):
         if versionString:
@@ -375,7 +544,7 @@ class FileComparison:
         with open(self.stdFile, "w") as f:
             for splitComp in splitComps:
                 f.write(open(splitComp.stdFile).read())
-        self.stdCmpFile = self.stdFile
+        self.stdCmpPostfix = None
         self.updateDifferenceCache(self.APPROVED)
 
     def saveNew(self, test, versionString):
@@ -424,7 +593,7 @@ class FileComparison:
             newFile.write(autoGenText)
             newFile.close()
         self.stdFile = None
-        self.stdCmpFile = None
+        self.stdCmpPostfix = None
 
     def saveResults(self, tmpFile, destFile):
         copyfile(tmpFile, destFile)
@@ -1,4 +1,5 @@
 import os
+import sys
 import filecmp
 import shutil
 import logging
@@ -112,23 +113,31 @@ class BaseTestComparison(plugins.TestState):
         test.refreshFiles()
         tmpFiles = self.makeStemDict(test.listTmpFiles())
         stdFiles = self.makeStandardStemDict(test, tmpFiles, ignoreMissing)
+        argLists = []
         for tmpStem, tmpFile in list(tmpFiles.items()):
             self.notifyIfMainThread("ActionProgress")
             stdFile = stdFiles.get(tmpStem)
             self.diag.info("Comparing " + repr(stdFile) + "\nwith " + tmpFile)
-            comparison = self.createFileComparison(test, tmpStem, stdFile, tmpFile)
-            if comparison:
-                self.addComparison(comparison)
+            argLists.append((test, tmpStem, stdFile, tmpFile))
+        self.addFileComparisons(test, argLists)
         if not ignoreMissing:
             self.makeMissingComparisons(test, stdFiles, tmpFiles)
 
     def makeMissingComparisons(self, test, stdFiles, tmpFiles):
+        argLists = []
         for stdStem, stdFile in list(stdFiles.items()):
             self.notifyIfMainThread("ActionProgress")
             if stdStem not in tmpFiles:
-                comparison = self.createFileComparison(test, stdStem, stdFile, None)
-                if comparison:
-                    self.addComparison(comparison)
+                argLists.append((test, stdStem, stdFile, None))
+        self.addFileComparisons(test, argLists)
+
+    def addFileComparisons(self, test, argLists):
+        # Comparing is mostly reading files, so threads are enough. The comparisons are added
+        # in the order given whenever they finish, so the state is the same as comparing one at a time
+        workerCount = test.getConfigValue("comparison_workers")
+        for comparison in plugins.WorkerPool.callAll(self.createFileComparison, argLists, workerCount):
+            if comparison:
+                self.addComparison(comparison)
 
     def addComparison(self, comparison):
         info = "Making comparison for " + comparison.stem + " "
@@ -185,7 +194,10 @@ class TestComparison(BaseTestComparison):
         return state
 
     def __setstate__(self, state):
-        self.__dict__ = state
+        for var in ["appAbsPath", "appWriteDir"]:
+            if isinstance(state.get(var), str):
+                state[var] = sys.intern(state[var])
+        plugins.TestState.__setstate__(self, state)
         self.diag = logging.getLogger("TestComparison")
 
     def updateAfterLoad(self, app=None, updatePaths=False, newTmpPath=None):
@@ -320,7 +332,7 @@ class TestComparison(BaseTestComparison):
         return ",".join(baseNames)
 
     def getPerformanceStems(self, test):
-        return ["performance"] + list(test.getConfigValue("performance_logfile_extractor").keys())
+        return performance.getPerformanceStems(test)
 
     def createFileComparison(self, test, stem, standardFile, tmpFile):
         if stem in self.getPerformanceStems(test):
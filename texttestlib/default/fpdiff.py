@@ -1,6 +1,17 @@
 import sys
+import re
 import difflib
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Runs of the characters _getNumberAt treats as part of a number
+_numberRunRegex = re.compile("([0-9.eE+-]+)")
+# Below this, setting up NumPy arrays costs more than it saves
+_minValuesForNumpy = 64
+
 
 def _getNumberAt(l, pos):
     start = pos
@@ -65,39 +76,113 @@ def _fpequal(l1, l2, tolerance, relTolerance):
     return equal and l1 == "" and l2 == ""
 
 
+def _findNumberPairs(fromText, toText):
+    """ If the texts differ only in numbers, return the pairs of differing values. Otherwise return None """
+    fromTokens = _numberRunRegex.split(fromText)
+    toTokens = _numberRunRegex.split(toText)
+    if len(fromTokens) != len(toTokens) or fromTokens[::2] != toTokens[::2]:
+        return
+    pairs = []
+    for fromToken, toToken in zip(fromTokens[1::2], toTokens[1::2]):
+        if fromToken != toToken:
+            try:
+                pairs.append((float(fromToken), float(toToken)))
+            except ValueError:
+                return
+    return pairs
+
+
+def _findLinePairs(fromline, toline, tolerance, relTolerance, split):
+    """ Return the pairs of differing values that decide whether the lines are equal, or None if they can't be """
+    if split != '':
+        fromSplit = fromline.split(split)
+        toSplit = toline.split(split)
+        if len(fromSplit) != len(toSplit):
+            return
+        fields = [(f.strip(), t.strip()) for f, t in zip(fromSplit, toSplit)]
+    else:
+        fields = [(fromline, toline)]
+    linePairs = []
+    for f, t in fields:
+        if f != t:
+            pairs = _findNumberPairs(f, t)
+            if pairs is not None:
+                linePairs += pairs
+            elif not _fpequal(f, t, tolerance, relTolerance):
+                # Scan character by character when they differ in more than numbers
+                return
+    return linePairs
+
+
+def _withinTolerance(fromValues, toValues, tolerance, relTolerance):
+    if numpy is None or len(fromValues) < _minValuesForNumpy:
+        return [_valuesEqual(f, t, tolerance, relTolerance) for f, t in zip(fromValues, toValues)]
+    fromArray = numpy.array(fromValues)
+    with numpy.errstate(all="ignore"):
+        deviation = numpy.abs(fromArray - numpy.array(toValues))
+        equal = numpy.zeros(len(fromValues), dtype=bool)
+        if tolerance != None:
+            equal |= deviation <= tolerance
+        if relTolerance != None:
+            referenceValue = numpy.abs(fromArray)
+            equal |= numpy.where(referenceValue == 0, deviation == 0, deviation / referenceValue <= relTolerance)
+    return equal.tolist()
+
+
+def _valuesEqual(value1, value2, tolerance, relTolerance):
+    deviation = abs(value1 - value2)
+    if tolerance != None and deviation <= tolerance:
+        return True
+    elif relTolerance != None:
+        referenceValue = abs(value1)
+        if referenceValue == 0:
+            return deviation == 0
+        return deviation / referenceValue <= relTolerance
+    return False
+
+
 def _cmpLines(fromlines, tolines, outlines, tolerance, relTolerance, split):
+    # Find all the differing numbers first, so they can be compared in one go
+    lineValueRanges = []
+    fromValues, toValues = [], []
     for fromline, toline in zip(fromlines, tolines):
-        equal = True
-        if fromline != toline:
-            if split != '':
-                fromSplit = fromline.split(split)
-                toSplit = toline.split(split)
-                if len(fromSplit) == len(toSplit):
-                    for f, t in zip(fromSplit, toSplit):
-                        f, t = f.strip(), t.strip()
-                        if f != t and not _fpequal(f, t, tolerance, relTolerance):
-                            equal = False
-                            break
-                else:
-                    equal = False
-            elif not _fpequal(fromline, toline, tolerance, relTolerance):
-                equal = False
-        if equal:
+        if fromline == toline:
+            lineValueRanges.append((0, 0))
+            continue
+        pairs = _findLinePairs(fromline, toline, tolerance, relTolerance, split)
+        if pairs is None:
+            lineValueRanges.append(None)
+        else:
+            lineValueRanges.append((len(fromValues), len(fromValues) + len(pairs)))
+            fromValues += [f for f, _ in pairs]
+            toValues += [t for _, t in pairs]
+
+    equalValues = _withinTolerance(fromValues, toValues, tolerance, relTolerance)
+    for fromline, toline, valueRange in zip(fromlines, tolines, lineValueRanges):
+        if valueRange is not None and all(equalValues[valueRange[0]:valueRange[1]]):
             outlines.write(fromline)
         else:
             outlines.write(toline)
+    return sum(equalValues), len(equalValues)
 
 
 def fpfilter(fromlines, tolines, outlines, tolerance, relTolerance=None, useDifflib=False, split=''):
+    """ Write tolines to outlines, replacing lines by the corresponding ones in fromlines where they differ
+    only by numbers within tolerance. Returns how many differing values were within tolerance, and how many
+    were compared """
     if split == 'None':
         split = None
     if not useDifflib:
-        _cmpLines(fromlines, tolines, outlines, tolerance, relTolerance, split)
+        counts = _cmpLines(fromlines, tolines, outlines, tolerance, relTolerance, split)
         outlines.writelines(tolines[len(fromlines):])
-        return
+        return counts
+    withinTolerance, compared = 0, 0
     s = difflib.SequenceMatcher(None, fromlines, tolines)
     for tag, i1, i2, j1, j2 in s.get_opcodes():
         if tag == "replace" and i2 - i1 == j2 - j1:
-            _cmpLines(fromlines[i1:i2], tolines[j1:j2], outlines, tolerance, relTolerance, split)
+            counts = _cmpLines(fromlines[i1:i2], tolines[j1:j2], outlines, tolerance, relTolerance, split)
+            withinTolerance += counts[0]
+            compared += counts[1]
         else:
             outlines.writelines(tolines[j1:j2])
+    return withinTolerance, compared
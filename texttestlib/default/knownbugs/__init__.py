@@ -9,6 +9,7 @@ from texttestlib import plugins
 from configparser import ConfigParser, NoOptionError
 from copy import copy
 from collections import OrderedDict
+from threading import Lock
 
 plugins.addCategory("bug", "known bugs", "had known bugs")
 plugins.addCategory("badPredict", "internal errors", "had internal errors")
@@ -144,33 +145,41 @@ class BugTrigger:
     def matchesText(self, line):
         return self.textTrigger.matches(line)
 
+    def getLineTriggers(self):
+        # The TextTriggers for each line of the search string, which unlike the whole don't keep state
+        return self.textTrigger.triggers
+
     def exactMatch(self, lines, **kw):
-        updatedLines = [line for i, line in enumerate(lines) if i < len(lines) - 1] if lines[-1] == '' else lines
-        if len(updatedLines) == len(self.textTrigger.triggers):
-            for index, line in enumerate(updatedLines, start=1):
-                # We must check that every line match because MultilineTextTrigger.matches method
-                # returns True only when the match is complete
-                if index < len(updatedLines):
-                    if not self.textTrigger._matches(line)[1]:
-                        return False
-                else:
-                    return self.hasBug(line, **kw)
-        return False
+        updatedLines = lines[:-1] if lines and lines[-1] == '' else lines
+        lineTriggers = self.getLineTriggers()
+        if len(lineTriggers) == 0 or len(updatedLines) != len(lineTriggers) or not self.isRelevant(**kw):
+            return False
+        for lineTrigger, line in zip(lineTriggers, updatedLines):
+            if not lineTrigger.matches(line):
+                return False
+        return self.contextMatches(**kw)
 
     def customTriggerMatches(self, *args):
         module, method = self.customTrigger.split(".", 1)
         return plugins.importAndCall(module, method, *args)
 
-    def hasBug(self, line, execHosts=[], isChanged=True, multipleDiffs=False, tmpDir=None):
+    def hasBug(self, line, **kw):
+        if not self.isRelevant(**kw):
+            return False
+        if line is not None and not self.textTrigger.matches(line):
+            return False
+        return self.contextMatches(**kw)
+
+    def isRelevant(self, isChanged=True, multipleDiffs=False, **kw):
         if not self.checkUnchanged and not isChanged:
             self.diag.info("File not changed, ignoring")
             return False
         if multipleDiffs and not self.ignoreOtherErrors:
             self.diag.info("Multiple differences present, allowing others through")
             return False
-        if line is not None and not self.textTrigger.matches(line):
-            return False
+        return True
 
+    def contextMatches(self, execHosts=[], tmpDir=None, **kw):
         if self.customTrigger and not self.customTriggerMatches(execHosts, tmpDir):
             return False
 
@@ -209,12 +218,42 @@ class BugTrigger:
         return True
 
 
+class TriggerPrefilter:
+    # Most lines match no trigger at all: one search with all the patterns combined rules them out
+    def __init__(self, bugTriggers):
+        patterns = []
+        self.otherTriggers = []
+        for bugTrigger in bugTriggers:
+            for lineTrigger in bugTrigger.getLineTriggers():
+                pattern = lineTrigger.regex.pattern if lineTrigger.regex else re.escape(lineTrigger.text)
+                if self.canCombine(pattern):
+                    patterns.append("(?:" + pattern + ")")
+                else:
+                    self.otherTriggers.append(lineTrigger)
+        self.regex = re.compile("|".join(patterns)) if patterns else None
+
+    @staticmethod
+    def canCombine(pattern):
+        # Groups would be renumbered, breaking back references, and inline flags must come first
+        try:
+            return re.compile("(?:" + pattern + ")").groups == 0
+        except re.error:
+            return False
+
+    def mightMatch(self, line):
+        if self.regex and self.regex.search(line):
+            return True
+        return any((lineTrigger.matches(line) for lineTrigger in self.otherTriggers))
+
+
 class FileBugData:
     def __init__(self):
         self.presentList = []
         self.absentList = []
         self.identicalList = []
         self.checkUnchanged = False
+        self.parts = []  # when combined from several files, what each one contained
+        self.prefilter = None
         self.diag = logging.getLogger("Check For Bugs")
 
     def addBugTrigger(self, getOption):
@@ -227,6 +266,25 @@ class FileBugData:
             self.identicalList.append(bugTrigger)
         else:
             self.presentList.append(bugTrigger)
+        self.prefilter = None
+
+    def addFileBugData(self, fileBugData):
+        self.presentList += fileBugData.presentList
+        self.absentList += fileBugData.absentList
+        self.identicalList += fileBugData.identicalList
+        self.checkUnchanged |= fileBugData.checkUnchanged
+        self.parts.append(fileBugData)
+
+    def getPrefilters(self):
+        if self.parts:
+            return [part.getPrefilter() for part in self.parts]
+        else:
+            return [self.getPrefilter()]
+
+    def getPrefilter(self):
+        if self.prefilter is None:
+            self.prefilter = TriggerPrefilter(self.presentList + self.absentList)
+        return self.prefilter
 
     def findBugs(self, fileName, execHosts, isChanged, multipleDiffs):
         if not self.checkUnchanged and not isChanged:
@@ -241,31 +299,60 @@ class FileBugData:
 
         self.diag.info("Looking for bugs in " + fileName)
         dirname = os.path.dirname(fileName)
-        return self.findBugsInText(open(fileName).readlines(), execHosts=execHosts, isChanged=isChanged, multipleDiffs=multipleDiffs, tmpDir=dirname)
+        with open(fileName) as f:
+            return self.findBugsInText(f, execHosts=execHosts, isChanged=isChanged, multipleDiffs=multipleDiffs, tmpDir=dirname)
 
     def findBugsInText(self, lines, **kw):
-        currAbsent = copy(self.absentList)
+        # A single pass over the lines, advancing all the triggers together. Triggers are shared between tests,
+        # so how far each has got through a multi-line search string is kept here rather than in them
+        debug = self.diag.isEnabledFor(logging.INFO)
+        prefilters = self.getPrefilters()
+        present = [[bugTrigger, 0] for bugTrigger in self.presentList if bugTrigger.isRelevant(**kw)]
+        absent = [[bugTrigger, 0] for bugTrigger in self.absentList]
+        identicalLineCount = max((len(bugTrigger.getLineTriggers()) for bugTrigger in self.identicalList), default=-1) + 1
+        firstLines = []
         bugs = []
-        for bugTrigger in self.identicalList:
-            if bugTrigger not in bugs and bugTrigger.exactMatch(lines, **kw):
-                bugs.append(bugTrigger)
         for line in lines:
-            self.diag.info("Checking " + repr(line))
-            for bugTrigger in self.presentList:
-                self.diag.info("Checking for existence of " + repr(bugTrigger))
-                if bugTrigger not in bugs and bugTrigger.hasBug(line, **kw):
-                    self.diag.info("FOUND!")
-                    bugs.append(bugTrigger)
-            toRemove = []
-            for bugTrigger in currAbsent:
-                self.diag.info("Checking for absence of " + repr(bugTrigger))
-                if bugTrigger.matchesText(line):
-                    self.diag.info("PRESENT!")
-                    toRemove.append(bugTrigger)
-            for bugTrigger in toRemove:
-                currAbsent.remove(bugTrigger)
-
-        return bugs + self.findAbsenceBugs(currAbsent, **kw)
+            if len(firstLines) <= identicalLineCount:
+                firstLines.append(line)
+            if not any((prefilter.mightMatch(line) for prefilter in prefilters)):
+                continue
+            if debug:
+                self.diag.info("Checking " + repr(line))
+            foundTriggers = [bugTrigger for bugTrigger in self.advanceAll(present, line) if bugTrigger.contextMatches(**kw)]
+            if foundTriggers:
+                if debug:
+                    self.diag.info("FOUND " + repr(foundTriggers))
+                bugs += foundTriggers
+                present = [progress for progress in present if progress[0] not in foundTriggers]
+            presentTriggers = self.advanceAll(absent, line)
+            if presentTriggers:
+                if debug:
+                    self.diag.info("PRESENT " + repr(presentTriggers))
+                absent = [progress for progress in absent if progress[0] not in presentTriggers]
+
+        identicalBugs = []
+        if len(firstLines) <= identicalLineCount:
+            for bugTrigger in self.identicalList:
+                if bugTrigger.exactMatch(firstLines, **kw):
+                    identicalBugs.append(bugTrigger)
+        return identicalBugs + bugs + self.findAbsenceBugs([bugTrigger for bugTrigger, _ in absent], **kw)
+
+    def advanceAll(self, progressList, line):
+        # Returns the triggers whose whole search string has now been found
+        return [progress[0] for progress in progressList if self.advance(progress, line)]
+
+    @staticmethod
+    def advance(progress, line):
+        # Returns True when the last line of the search string has matched. As in MultilineTextTrigger,
+        # the lines need not follow each other directly
+        lineTriggers = progress[0].getLineTriggers()
+        if lineTriggers and lineTriggers[progress[1]].matches(line):
+            progress[1] += 1
+            if progress[1] == len(lineTriggers):
+                progress[1] = 0
+                return True
+        return False
 
     def findAbsenceBugs(self, absentList, **kw):
         bugs = []
@@ -288,6 +375,35 @@ class ParseMethod:
 
 
 class BugMap(OrderedDict):
+    fileCache = {}  # file name -> (modification time and size, BugMap)
+    cacheLock = Lock()
+
+    @classmethod
+    def forFiles(cls, fileNames):
+        # Each file is parsed once and shared by all the tests that use it, until it changes
+        bugMap = cls()
+        for fileName in fileNames:
+            for fileStem, fileBugData in cls.readCachedFile(fileName).items():
+                bugMap.setdefault(fileStem, FileBugData()).addFileBugData(fileBugData)
+        return bugMap
+
+    @classmethod
+    def readCachedFile(cls, fileName):
+        try:
+            stat = os.stat(fileName)
+            signature = stat.st_mtime_ns, stat.st_size
+        except OSError:
+            signature = None
+        with cls.cacheLock:
+            cached = cls.fileCache.get(fileName)
+            if cached is not None and cached[0] == signature:
+                return cached[1]
+        bugMap = cls()
+        bugMap.readFromFile(fileName)
+        with cls.cacheLock:
+            cls.fileCache[fileName] = signature, bugMap
+        return bugMap
+
     def checkUnchanged(self):
         for bugData in list(self.values()):
             if bugData.checkUnchanged:
@@ -482,13 +598,11 @@ class CheckForBugs(plugins.Action):
         return diffCount > 1
 
     def readBugs(self, test):
-        bugMap = BugMap()
         # Mostly for backwards compatibility, reverse the list so that more specific bugs
         # get checked first.
-        for bugFile in reversed(test.getAllPathNames("knownbugs")):
-            self.diag.info("Reading bugs from file " + bugFile)
-            bugMap.readFromFile(bugFile)
-        return bugMap
+        bugFiles = list(reversed(test.getAllPathNames("knownbugs")))
+        self.diag.info("Reading bugs from files " + repr(bugFiles))
+        return BugMap.forFiles(bugFiles)
 
     def fixBackupMessage(self, newState):
         newFreeText = ""
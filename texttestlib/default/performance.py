@@ -4,6 +4,8 @@ import sys
 import time
 from texttestlib import plugins
 from .comparefile import FileComparison
+from .runtimehistory import RuntimeHistory
+from threading import Lock
 
 from functools import cmp_to_key
 
@@ -41,6 +43,40 @@ def getTestPerformance(test, version=None):
         return getTestPerformance(test, version)
 
 
+def getExpectedRuntime(test):
+    # Approved performance if there is any, otherwise what previous runs recorded. Negative if unknown
+    testPerformance = getTestPerformance(test)
+    if testPerformance < 0:
+        history = RuntimeHistory.forConfig(test.app)
+        if history:
+            return history.getExpectedRuntime(test.app.name, test.app.getFullVersion(), test.getRelPath())
+    return testPerformance
+
+
+def getPerformanceStems(test):
+    stems = ["performance"] + list(test.getConfigValue("performance_logfile_extractor").keys())
+    memoryStem = test.getConfigValue("automatic_memory_stem")
+    if memoryStem and memoryStem not in stems:
+        stems.append(memoryStem)
+    return stems
+
+
+def getMemoryStems(test):
+    return [stem for stem in getPerformanceStems(test) if "mem" in stem]
+
+
+def getExpectedMemory(test):
+    # Approved memory if there is any, otherwise the most previous runs recorded, in MB. Negative if unknown
+    for stem in getMemoryStems(test):
+        fileName = test.getFileName(stem)
+        if fileName:
+            return getPerformance(fileName)
+    history = RuntimeHistory.forConfig(test.app)
+    if history:
+        return history.getExpectedMemory(test.app.name, test.app.getFullVersion(), test.getRelPath())
+    return -1.0
+
+
 def describePerformance(fileName):
     line = open(fileName).readline().strip()
     if "mem" in os.path.basename(fileName):
@@ -150,7 +186,7 @@ class PerformanceFileComparison(FileComparison):
                 os.remove(self.stdFile)
                 test.refreshFiles()
                 self.stdFile = test.getFileName(self.stem)
-                self.stdCmpFile = self.stdFile
+                self.stdCmpPostfix = None
                 if not self.stdFile:
                     return
 
@@ -297,7 +333,7 @@ class TimeFilter(plugins.Filter):
             self.maxTime = newMaxTime
 
     def acceptsTestCase(self, test):
-        testPerformance = getTestPerformance(test)
+        testPerformance = getExpectedRuntime(test)
         if testPerformance < 0:
             return True
         return testPerformance >= self.minTime and testPerformance <= self.maxTime
@@ -308,7 +344,7 @@ class TimeGroupFilter(plugins.Filter):
         self.testCount = testCount
 
     def makePerformanceDictionary(self, tests):
-        return {test: getTestPerformance(test) for test in tests}
+        return {test: getExpectedRuntime(test) for test in tests}
 
     def refine(self, tests):
         if self.testCount <= 0 or self.testCount >= len(tests):
@@ -413,3 +449,135 @@ class PerformanceStatistics(plugins.ScriptWithArgs):
 
     def setUpApplication(self, app):
         self.app = app
+
+
+class RuntimeHistoryRecorder(plugins.Responder):
+    timedChanges = ["become pending", "start", "start final filtering and comparison"]
+    batchSize = 100
+
+    def __init__(self, *args):
+        plugins.Responder.__init__(self)
+        self.changeTimes = {}
+        self.unrecordedRows = {}
+        self.lock = Lock()
+
+    def notifyLifecycleChange(self, test, state, changeDesc):
+        if changeDesc in self.timedChanges:
+            with self.lock:
+                self.changeTimes.setdefault(test, {}).setdefault(changeDesc, time.time())
+
+    def notifyComplete(self, test):
+        if not test.state.isComplete():  # this notification also comes in scripts etc.
+            return
+        with self.lock:
+            changeTimes = self.changeTimes.pop(test, {})
+        history = RuntimeHistory.forConfig(test.app)
+        # Killed tests would make tests look faster than they are
+        if history is None or "start" not in changeTimes or test.state.category in ["killed", "cancelled"]:
+            return
+        row = self.makeRow(test, changeTimes)
+        with self.lock:
+            rows = self.unrecordedRows.setdefault(history, [])
+            rows.append(row)
+            if len(rows) < self.batchSize:
+                return
+            self.unrecordedRows[history] = []
+        history.record(rows)
+
+    def notifyAllComplete(self):
+        for history, rows in list(self.unrecordedRows.items()):
+            if rows:
+                history.record(rows)
+        self.unrecordedRows = {}
+
+    def makeRow(self, test, changeTimes):
+        finished = time.time()
+        started = changeTimes["start"]
+        evaluationStarted = changeTimes.get("start final filtering and comparison")
+        row = {"app": test.app.name, "version": test.app.getFullVersion(), "test": test.getRelPath(),
+               "finished": finished, "host": ",".join(test.state.executionHosts)}
+        cpuTime, realTime = self.readTimes(test.makeTmpFileName(test.getConfigValue("default_performance_stem")))
+        row["cputime"] = cpuTime
+        # Without filtering states, the evaluation time can't be separated from the run itself
+        row["wallclock"] = realTime if realTime is not None else (evaluationStarted or finished) - started
+        if evaluationStarted is not None:
+            row["evaluation"] = finished - evaluationStarted
+        if "become pending" in changeTimes:
+            row["queuewait"] = started - changeTimes["become pending"]
+        row["memory"] = self.readMemory(test)
+        return row
+
+    def readTimes(self, fileName):
+        cpuTime, realTime = None, None
+        if os.path.isfile(fileName):
+            with open(fileName) as f:
+                for i, line in enumerate(f):
+                    value = getPerformanceFromLine(line)
+                    if i == 0 and value >= 0:
+                        cpuTime = value
+                    elif line.startswith("Real time") and value >= 0:
+                        realTime = value
+        return cpuTime, realTime
+
+    def readMemory(self, test):
+        for stem in getMemoryStems(test):
+            fileName = test.makeTmpFileName(stem)
+            if os.path.isfile(fileName):
+                memory = getPerformance(fileName)
+                if memory >= 0:
+                    return memory
+
+
+class RuntimeHistoryStatistics(plugins.ScriptWithArgs):
+    scriptDoc = "Prints percentiles of what tests used in previous runs, from the runtime_history_database. Can show recent values as a trend"
+
+    def __init__(self, args=[]):
+        optDict = self.parseArguments(args, ["field", "percentiles", "trend"])
+        self.field = optDict.get("field", "wallclock")
+        self.percentiles = [float(p) for p in plugins.commasplit(optDict.get("percentiles", "50,90"))]
+        self.trendLength = int(optDict.get("trend", "0"))
+        self.history = None
+        self.summaries = {}
+        self.trends = {}
+
+    def setUpApplication(self, app):
+        self.history = RuntimeHistory.forConfig(app)
+        if self.history is None:
+            print("No runtime_history_database is configured for", app.description())
+            return
+        version = app.getFullVersion()
+        self.summaries = self.history.getPercentiles(app.name, version, self.field, self.percentiles)
+        if self.trendLength:
+            self.trends = self.history.getValues(app.name, version, self.field, limit=self.trendLength)
+        entries = [app.description(), "Runs"] + [self.formatPercentile(p) for p in self.percentiles]
+        print(self.getPaddedLine(entries))
+        print("-" * len(self.getPaddedLine(entries)))
+
+    def formatPercentile(self, percentile):
+        return "p" + ("%g" % percentile)
+
+    def getPaddedLine(self, entries):
+        line = entries[0].ljust(40)
+        for entry in entries[1:]:
+            line += entry.rjust(12)
+        return line
+
+    def setUpSuite(self, suite):
+        if self.history and suite.parent:
+            print(suite.getIndent() + suite.name)
+
+    def __call__(self, test):
+        if self.history is None:
+            return
+        runCount, values = self.summaries.get(test.getRelPath(), (0, [None] * len(self.percentiles)))
+        entries = [test.getIndent() + test.name, str(runCount)] + [self.format(value) for value in values]
+        line = self.getPaddedLine(entries)
+        trend = self.trends.get(test.getRelPath())
+        if trend:
+            line += "   " + " ".join((self.format(value) for _, value in reversed(trend)))
+        print(line)
+
+    def format(self, value):
+        if value is None:
+            return "N/A"
+        return ("%.2f" % value)
@@ -1,9 +1,14 @@
 #!/usr/bin/env python
 
 
+import io
 import os
+import re
 import logging
 import shutil
+import hashlib
+from threading import Lock
+from weakref import WeakKeyDictionary
 from texttestlib.default import fpdiff
 from texttestlib import plugins
 from optparse import OptionParser
@@ -14,6 +19,146 @@ class Filtering(plugins.TestState):
     def __init__(self, name, **kw):
         plugins.TestState.__init__(self, name, briefText="", **kw)
 
+
+def applyFilters(filters, fileName, newFileName):
+    # Module-level, so it can be run in a worker process
+    diag = logging.getLogger("Filter Actions")
+    currFileName = fileName
+    for fileFilter in filters:
+        writeFileName = newFileName + "." + fileFilter.postfix
+        diag.info("Applying " + fileFilter.__class__.__name__ +
+                  " to make\n" + writeFileName + " from\n " + currFileName)
+        if os.path.isfile(writeFileName):
+            diag.info("Removing previous file at " + writeFileName)
+            os.remove(writeFileName)
+        currFile = open(currFileName, errors="ignore")
+        writeFile = plugins.openForWrite(writeFileName)
+        fileFilter.filterFile(currFile, writeFile)
+        writeFile.close()
+        currFileName = writeFileName
+    if len(filters) > 0 and currFileName != newFileName:
+        shutil.move(currFileName, newFileName)
+
+
+class FilteredFileCache:
+    """ Filtered standard files from previous runs, stored under a hash of the file contents and the filters
+    applied. Files not used recently are removed once the cache grows beyond its maximum size """
+    formatVersion = "1"
+    lock = Lock()
+    instances = {}
+
+    @classmethod
+    def forConfig(cls, configObj):
+        location = configObj.getConfigValue("filtered_file_cache")
+        if not location:
+            return
+        if location == "personal":
+            location = plugins.getPersonalDir("filter_cache")
+        maxSize = plugins.parseBytes(configObj.getConfigValue("filtered_file_cache_size"))
+        with cls.lock:
+            key = os.path.abspath(location), maxSize
+            if key not in cls.instances:
+                cls.instances[key] = cls(*key)
+            return cls.instances[key]
+
+    def __init__(self, directory, maxSize):
+        self.directory = directory
+        self.maxSize = maxSize
+        self.totalSize = None
+        self.diag = logging.getLogger("Filtered File Cache")
+
+    def makeKey(self, fileName, filters):
+        cacheTexts = [getattr(fileFilter, "getCacheText", lambda: None)() for fileFilter in filters]
+        if len(filters) == 0 or None in cacheTexts:
+            return
+        # Line endings written depend on the platform
+        keyHash = hashlib.sha1((self.formatVersion + os.name + "\n").encode())
+        for cacheText in cacheTexts:
+            keyHash.update(cacheText.encode() + b"\0")
+        with open(fileName, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                keyHash.update(block)
+        return keyHash.hexdigest()
+
+    def getPath(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def fetch(self, key, newFileName):
+        path = self.getPath(key)
+        if not os.path.isfile(path):
+            self.diag.info("No cached filtered file for " + newFileName)
+            return False
+        try:
+            # Record that it's been used, so it's not the next to go
+            os.utime(path)
+            if os.path.isfile(newFileName):
+                os.remove(newFileName)
+            self.linkOrCopy(path, newFileName)
+            self.diag.info("Reused " + path + " as " + newFileName)
+            return True
+        except OSError as e:
+            # Pruned by someone else in the meantime, perhaps. Just filter it again
+            self.diag.info("Failed to reuse " + path + " : " + str(e))
+            return False
+
+    def linkOrCopy(self, srcPath, dstPath):
+        # Filtered files are always replaced rather than rewritten, so sharing them is safe
+        try:
+            os.link(srcPath, dstPath)
+        except OSError:
+            shutil.copyfile(srcPath, dstPath)
+
+    def store(self, key, newFileName):
+        if not os.path.isfile(newFileName):
+            return
+        path = self.getPath(key)
+        tmpPath = path + "." + str(os.getpid()) + ".tmp"
+        try:
+            plugins.ensureDirectoryExists(os.path.dirname(path))
+            self.linkOrCopy(newFileName, tmpPath)
+            os.replace(tmpPath, path)
+        except OSError as e:
+            self.diag.info("Failed to store " + newFileName + " in cache : " + str(e))
+            return
+        self.diag.info("Stored " + newFileName + " as " + path)
+        with self.lock:
+            if self.totalSize is None:
+                self.totalSize = sum(size for _, size, _ in self.findEntries())
+            else:
+                self.totalSize += os.path.getsize(path)
+            if self.totalSize > self.maxSize:
+                self.totalSize -= self.prune(self.maxSize)[1]
+
+    def findEntries(self):
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+        for subDir in os.scandir(self.directory):
+            if subDir.is_dir():
+                for entry in os.scandir(subDir.path):
+                    if entry.is_file() and not entry.name.endswith(".tmp"):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def prune(self, maxSize):
+        """ Removes least recently used files until the cache is no larger than maxSize.
+        Returns how many files and bytes were removed """
+        entries = sorted(self.findEntries())
+        totalSize = sum(size for _, size, _ in entries)
+        removedCount, removedSize = 0, 0
+        for _, size, path in entries:
+            if totalSize - removedSize <= maxSize:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            removedCount += 1
+            removedSize += size
+        self.diag.info("Removed " + str(removedCount) + " files, " + str(removedSize) + " bytes from " + self.directory)
+        return removedCount, removedSize
+
 # Generic base class for filtering standard and temporary files
 
 
@@ -26,11 +171,32 @@ class FilterAction(plugins.Action):
         if self.useFilteringStates:
             self.changeToFilteringState(test)
 
+        cache = self.getFilteredFileCache(test)
+        argLists, cacheKeys = [], []
         for fileName, postfix in self.filesToFilter(test):
             self.diag.info("Considering for filtering : " + fileName)
             stem = self.getStem(fileName)
             newFileName = test.makeTmpFileName(stem + "." + test.app.name + postfix, forFramework=1)
-            self.performAllFilterings(test, stem, fileName, newFileName)
+            if self.filterIncrementally(test, stem, fileName, newFileName):
+                continue
+            filters = self.makeAllFilters(test, stem, test.app)
+            cacheKey = cache.makeKey(fileName, filters) if cache else None
+            if cacheKey is None or not cache.fetch(cacheKey, newFileName):
+                argLists.append((filters, fileName, newFileName))
+                cacheKeys.append(cacheKey)
+        # Files are independent of each other, so they can be filtered at the same time
+        workerCount = test.getConfigValue("comparison_workers")
+        useProcesses = test.getConfigValue("comparison_worker_type") == "process"
+        plugins.WorkerPool.callAll(applyFilters, argLists, workerCount, useProcesses)
+        for cacheKey, (_, _, newFileName) in zip(cacheKeys, argLists):
+            if cacheKey is not None:
+                cache.store(cacheKey, newFileName)
+
+    def getFilteredFileCache(self, test):
+        pass
+
+    def filterIncrementally(self, *args):
+        return False
 
     def getStem(self, fileName):
         return os.path.basename(fileName).split(".")[0]
@@ -39,22 +205,7 @@ class FilterAction(plugins.Action):
         pass
 
     def performAllFilterings(self, test, stem, fileName, newFileName):
-        currFileName = fileName
-        filters = self.makeAllFilters(test, stem, test.app)
-        for fileFilter in filters:
-            writeFileName = newFileName + "." + fileFilter.postfix
-            self.diag.info("Applying " + fileFilter.__class__.__name__ +
-                           " to make\n" + writeFileName + " from\n " + currFileName)
-            if os.path.isfile(writeFileName):
-                self.diag.info("Removing previous file at " + writeFileName)
-                os.remove(writeFileName)
-            currFile = open(currFileName, errors="ignore")
-            writeFile = plugins.openForWrite(writeFileName)
-            fileFilter.filterFile(currFile, writeFile)
-            writeFile.close()
-            currFileName = writeFileName
-        if len(filters) > 0 and currFileName != newFileName:
-            shutil.move(currFileName, newFileName)
+        applyFilters(self.makeAllFilters(test, stem, test.app), fileName, newFileName)
 
     def getAllFilters(self, test, fileName, app):
         stem = self.getStem(fileName)
@@ -92,10 +243,11 @@ class FilterAction(plugins.Action):
         if test.app is not app:  # happens when testing filtering in the static GUI
             configObj = app
 
+        compiled = configObj.getConfigValue("compile_run_dependent_text")
         for filterClass in [RunDependentTextFilter, UnorderedTextFilter]:
             texts = configObj.getCompositeConfigValue(filterClass.configKey, stem)
             if texts:
-                filters.append(filterClass(texts, test.getRelPath()))
+                filters.append(filterClass(texts, test.getRelPath(), compiled))
 
         return filters
 
@@ -112,6 +264,10 @@ class FilterOriginal(FilterAction):
         resultFiles, defFiles = test.listApprovedFiles(allVersions=False, defFileCategory="regenerate")
         return self.constantPostfix(resultFiles + defFiles, "origcmp")
 
+    def getFilteredFileCache(self, test):
+        # Standard files rarely change between runs, unlike the temporary ones
+        return FilteredFileCache.forConfig(test)
+
     def changeToFilteringState(self, test):
         # Notifications of current status are only useful when doing normal filtering in the GUI
         execMachines = test.state.executionHosts
@@ -158,13 +314,103 @@ class FilterOriginalForScript(FilterOriginal):
 class FilterErrorText(FilterAction):
     def _makeAllFilters(self, test, stem, app):
         texts = app.getConfigValue("suppress_stderr_text")
-        return [RunDependentTextFilter(texts)]
+        return [RunDependentTextFilter(texts, compiled=app.getConfigValue("compile_run_dependent_text"))]
 
 
 class FilterProgressRecompute(FilterOnTempFile):
+    # Progress is recomputed repeatedly while tests run. Keep filtering each file from where we got to last time
+    progressLock = Lock()
+    # Weak, so that tests killed, rerun or removed before they complete don't keep their filters forever
+    incrementalFilters = WeakKeyDictionary()
+
+    @classmethod
+    def discardProgress(cls, test):
+        with cls.progressLock:
+            cls.incrementalFilters.pop(test, None)
+
     def filesToFilter(self, test):
         return self.constantPostfix(test.listTmpFiles(), "partcmp")
 
+    def filterIncrementally(self, test, stem, fileName, newFileName):
+        with self.progressLock:
+            testFilters = self.incrementalFilters.setdefault(test, {})
+            incrementalFilter = testFilters.get(newFileName)
+            if incrementalFilter is None:
+                filters = self.makeAllFilters(test, stem, test.app)
+                if not IncrementalFilter.canFilter(filters):
+                    return False
+                incrementalFilter = testFilters[newFileName] = IncrementalFilter(filters, fileName, newFileName)
+        # Recomputes can overlap, but only one of them may filter a given file at a time
+        with incrementalFilter.lock:
+            incrementalFilter.update()
+        return True
+
+
+class IncrementalFilter:
+    """ Filters a file that is still being written. Remembers how far it has read and the state of the filter,
+    so each update only reads and filters complete lines appended since the last one """
+    blockSize = 1024 * 1024
+
+    def __init__(self, filters, fileName, newFileName):
+        self.filters = filters
+        self.fileName = fileName
+        self.newFileName = newFileName
+        self.fileId = None
+        self.offset = 0
+        self.lock = Lock()
+        # Only this many lines can be removed after they're written
+        self.maxRemoveCount = max((lineFilter.prevLinesToRemove for f in filters for lineFilter in f.lineFilters),
+                                  default=0)
+        self.diag = logging.getLogger("Filter Actions")
+
+    @classmethod
+    def canFilter(cls, filters):
+        # Section filters look ahead through the whole file, and other filters write things at the end
+        return len(filters) <= 1 and all(type(f) is RunDependentTextFilter and not f.hasSectionFilters() for f in filters)
+
+    def restart(self, fileId):
+        self.diag.info("Filtering " + self.fileName + " from the beginning")
+        self.fileId = fileId
+        self.offset = 0
+        for fileFilter in self.filters:
+            fileFilter.startFiltering(fileFilter.findRelevantFilters(None))
+        plugins.openForWrite(self.newFileName).close()
+
+    def update(self):
+        try:
+            stat = os.stat(self.fileName)
+        except OSError:
+            return
+        fileId = stat.st_dev, stat.st_ino
+        # Rewritten rather than appended to, or someone removed what we wrote
+        if fileId != self.fileId or stat.st_size < self.offset or not os.path.isfile(self.newFileName):
+            self.restart(fileId)
+        if stat.st_size == self.offset:
+            return
+
+        with open(self.fileName, "rb") as inFile, open(self.newFileName, "r+") as newFile:
+            inFile.seek(self.offset)
+            newFile.seek(0, os.SEEK_END)
+            remainder = b""
+            for block in iter(lambda: inFile.read(self.blockSize), b""):
+                data = remainder + block
+                lineEnd = data.rfind(b"\n") + 1
+                remainder = data[lineEnd:]
+                if lineEnd:
+                    self.filterLines(data[:lineEnd], newFile)
+                    self.offset += lineEnd
+        self.diag.info("Filtered " + self.fileName + " up to " + str(self.offset) + " bytes")
+
+    def filterLines(self, data, newFile):
+        # Decoded as when filtering whole files. The last line is left until it is complete
+        lines = io.TextIOWrapper(io.BytesIO(data), errors="ignore")
+        if len(self.filters) == 0:
+            newFile.write(lines.read())
+            return
+        fileFilter = self.filters[0]
+        fileFilter.filterLines(lines, newFile)
+        fileFilter.seekPoints = fileFilter.seekPoints[-self.maxRemoveCount - 1:]
+
 
 class FilterResultRecompute(FilterOnTempFile):
     def filesToFilter(self, test):
@@ -186,21 +432,31 @@ class FloatingPointFilter:
         self.tolerance = tolerance if tolerance else None
         self.relative = relative if relative else None
         self.split = split
+        self.diag = logging.getLogger("Floating Point Filter")
 
     def filterFile(self, inFile, writeFile):
         fromlines = open(self.origFileName, errors="ignore").readlines()
         tolines = inFile.readlines()
-        fpdiff.fpfilter(fromlines, tolines, writeFile, self.tolerance, self.relative, split=self.split)
+        withinTolerance, compared = fpdiff.fpfilter(fromlines, tolines, writeFile, self.tolerance, self.relative, split=self.split)
+        self.diag.info(str(withinTolerance) + " of " + str(compared) + " differing values were within tolerance of those in " +
+                       self.origFileName)
 
 
 class RunDependentTextFilter(plugins.Observable):
     configKey = "run_dependent_text"
     postfix = "normal"
 
-    def __init__(self, filterTexts, testId=""):
+    def __init__(self, filterTexts, testId="", compiled=False):
         plugins.Observable.__init__(self)
         self.diag = logging.getLogger("Run Dependent Text")
         self.lineFilters = [LineFilter(text, testId, self.diag) for text in filterTexts]
+        # In compiled mode, lines that no filter can affect are written out without consulting the filters
+        self.compiled = compiled
+        self.testId = testId
+
+    def getCacheText(self):
+        # Everything the filtered text depends on apart from the file itself
+        return "\n".join([self.__class__.__name__, self.testId] + [f.originalText for f in self.lineFilters])
 
     def findRelevantFilters(self, file):
         relevantFilters, sectionFilters = [], []
@@ -232,8 +488,11 @@ class RunDependentTextFilter(plugins.Observable):
     def findRelevantSectionFilters(self, sectionFilters, file):
         lineNumber = 0
         matchedFirst, relevantFilters = [], []
+        prefilter = self.makePrefilter(sectionFilters, includeUntriggers=True)
         for line in file:
             lineNumber += 1
+            if prefilter and not prefilter.mayMatch(line, lineNumber):
+                continue
             for sectionFilter in matchedFirst:
                 if sectionFilter not in relevantFilters and sectionFilter.untrigger.matches(line, lineNumber):
                     relevantFilters.append((sectionFilter, lineNumber))
@@ -247,15 +506,47 @@ class RunDependentTextFilter(plugins.Observable):
         file.seek(0)
         return relevantFilters
 
+    def makePrefilter(self, lineFilters, includeUntriggers=False):
+        if self.compiled:
+            triggers = [f.trigger for f in lineFilters]
+            if includeUntriggers:
+                triggers += [f.untrigger for f in lineFilters]
+            return TriggerPrefilter(triggers)
+
     def filterFile(self, file, newFile, filteredAway=None):
-        lineNumber = 0
-        seekPoints = []
-        lineFilters = self.findRelevantFilters(file)
-        for line in file:
+        self.startFiltering(self.findRelevantFilters(file))
+        self.filterLines(file, newFile, filteredAway)
+
+    def hasSectionFilters(self):
+        return any(lineFilter.untrigger is not None for lineFilter in self.lineFilters)
+
+    def startFiltering(self, lineFilters):
+        # Filtering can then continue over several calls to filterLines, if the lines arrive gradually
+        self.relevantFilters = lineFilters
+        self.prefilter = self.makePrefilter([f for f, _ in lineFilters])
+        self.dispatchState = self.getDispatchState(lineFilters)
+        self.lineNumber = 0
+        self.seekPoints = []
+
+    def filterLines(self, lines, newFile, filteredAway=None):
+        lineNumber = self.lineNumber
+        seekPoints = self.seekPoints
+        lineFilters = self.relevantFilters
+        prefilter = self.prefilter
+        dispatchState = self.dispatchState
+        notifyProgress = not prefilter or (len(self.observers) > 0 and self.inMainThread())
+        for line in lines:
             # We don't want to stack up ActionProgreess calls in ThreaderNotificationHandler ...
-            self.notifyIfMainThread("ActionProgress")
+            if notifyProgress:
+                self.notifyIfMainThread("ActionProgress")
             lineNumber += 1
+            if prefilter and self.canSkipLine(line, lineNumber, prefilter, dispatchState):
+                newFile.write(line)
+                seekPoints.append(newFile.tell())
+                continue
             lineFilter, filteredLine, removeCount = self.getFilteredLine(line, lineNumber, lineFilters)
+            if prefilter:
+                dispatchState = self.getDispatchState(lineFilters)
             if removeCount:
                 seekPoint = seekPoints[-removeCount - 1] if removeCount < len(seekPoints) else 0
                 self.diag.info("Removing " + repr(removeCount) + " lines")
@@ -268,6 +559,22 @@ class RunDependentTextFilter(plugins.Observable):
                 if filteredAway is not None and lineFilter is not None:
                     filteredAway.setdefault(lineFilter, []).append(line)
             seekPoints.append(newFile.tell())
+        self.lineNumber = lineNumber
+        self.seekPoints = seekPoints
+        self.dispatchState = dispatchState
+
+    def getDispatchState(self, lineFilters):
+        # Filters in the middle of removing lines must see every line, as must section filters
+        # that are due to be dropped
+        anyActive = any(f.autoRemove for f, _ in lineFilters)
+        lastLines = [lastLine for _, lastLine in lineFilters if lastLine is not None]
+        return anyActive, min(lastLines) if lastLines else None
+
+    def canSkipLine(self, line, lineNumber, prefilter, dispatchState):
+        anyActive, nextLastLine = dispatchState
+        if anyActive or (nextLastLine is not None and lineNumber >= nextLastLine):
+            return False
+        return not prefilter.mayMatch(line, lineNumber)
 
     def getFilteredLine(self, line, lineNumber, lineFilters):
         appliedLineFilter = None
@@ -316,6 +623,59 @@ class UnorderedTextFilter(RunDependentTextFilter):
             newFile.write("\n")
 
 
+class TriggerPrefilter:
+    """ Combines the triggers of several LineFilters into one regular expression, to quickly rule out
+    lines that none of them can match. It may claim matches that none of them make, but never the reverse """
+    inlineFlagRegex = re.compile(r"\(\?[aiLmsux]+\)")
+    backReferenceRegex = re.compile(r"\\[1-9]|\(\?P=|\(\?\(")
+    # The combined expression is only quicker than the separate ones when each alternative can be ruled out
+    # on its first character. Patterns starting with e.g. a character class are cheaper to check alone
+    literalStartRegex = re.compile(r"\^?[\w \-:=/<>,;'\"#@%&!~]")
+
+    def __init__(self, triggers):
+        self.lineNumbers = set()
+        self.separateRegexes = []
+        self.matchesAll = False
+        patterns = []
+        for trigger in triggers:
+            if isinstance(trigger, LineNumberTrigger):
+                self.lineNumbers.add(trigger.lineNumber)
+            elif type(trigger) in (plugins.TextTrigger, MatchNumberTrigger) and trigger.matchEmptyString:
+                if trigger.regex is None:
+                    if trigger.text:
+                        patterns.append(re.escape(trigger.text))
+                    else:
+                        self.matchesAll = True
+                elif self.canCombine(trigger.text):
+                    patterns.append(trigger.text)
+                else:
+                    self.separateRegexes.append(trigger.regex)
+            else:
+                self.matchesAll = True
+        self.combinedRegex = self.combine(patterns)
+
+    def canCombine(self, pattern):
+        # Flags would apply to all patterns, and back references would refer to the wrong groups
+        return self.literalStartRegex.match(pattern) is not None and \
+            not self.inlineFlagRegex.search(pattern) and not self.backReferenceRegex.search(pattern)
+
+    def combine(self, patterns):
+        if len(patterns) == 0:
+            return
+        try:
+            return re.compile("|".join("(?:" + pattern + ")" for pattern in patterns))
+        except re.error:
+            # e.g. repeated group names. Just check them one at a time
+            self.separateRegexes += [re.compile(pattern) for pattern in patterns]
+
+    def mayMatch(self, line, lineNumber):
+        if self.matchesAll or lineNumber in self.lineNumbers:
+            return True
+        if self.combinedRegex is not None and self.combinedRegex.search(line):
+            return True
+        return any(regex.search(line) for regex in self.separateRegexes)
+
+
 class LineNumberTrigger:
     def __init__(self, lineNumber):
         self.lineNumber = lineNumber
@@ -7,12 +7,18 @@ import subprocess
 import sys
 import signal
 import pipes
+import time
 from texttestlib import plugins
 from texttestlib.jobprocess import killProcessAndChildren
 from time import sleep
 from threading import Lock, Timer
 from locale import getpreferredencoding
 
+try:
+    import resource
+except ImportError:  # Windows, where we don't measure natively anyway
+    resource = None
+
 plugins.addCategory("killed", "killed", "were terminated before completion")
 
 
@@ -42,6 +48,8 @@ class Killed(plugins.TestState):
 
 
 class RunTest(plugins.Action):
+    usageFields = [("user", "ru_utime"), ("sys", "ru_stime"), ("inblock", "ru_inblock"), ("oublock", "ru_oublock")]
+
     def __init__(self):
         self.diag = logging.getLogger("run test")
         self.killDiag = logging.getLogger("kill processes")
@@ -96,11 +104,15 @@ class RunTest(plugins.Action):
         self.describe(test)
         machine = test.app.getRunMachine()
         killTimeout = test.getConfigValue("kill_timeout")
+        usage = self.getUsageToMeasure(test)
         for postfix in self.getTestRunPostfixes(test):
             if postfix:
                 # Checks for support processes like virtual displays, restarts if needed
                 test.notify("TestProcessComplete")
 
+            startTime = time.time()
+            if usage.get("memory"):
+                usage["launcherPeakRss"] = self.getLauncherPeakRss()
             process = self.getTestProcess(test, machine, postfix)
             self.registerProcess(test, process)
             if not postfix:
@@ -109,14 +121,16 @@ class RunTest(plugins.Action):
 
             if killTimeout and not test.app.isRecording() and not test.app.isActionReplay():
                 self.runMultiTimer(killTimeout, self.kill, (test, "timeout"))
-                self.wait(process)
+                self.wait(process, usage, startTime)
                 self.currentTimer.cancel()
                 self.currentTimer = None
             else:
-                self.wait(process)
+                self.wait(process, usage, startTime)
             self.checkAndClear(test, postfix)
             if self.killSignal is not None:
                 break  # Don't start other processes
+        if usage:
+            self.writeUsage(test, usage)
 
     def getTestRunPostfixes(self, test):
         postfixes = [""]
@@ -213,12 +227,78 @@ class RunTest(plugins.Action):
         remoteScript = os.path.join(tmpDir, "kill_test.sh")
         test.app.runCommandOn(machine, ["sh", plugins.quote(remoteScript)])
 
-    def wait(self, process):
+    def wait(self, process, usage=None, startTime=None):
+        if usage:
+            return self.waitAndMeasure(process, usage, startTime)
         try:
             plugins.retryOnInterrupt(process.wait)
         except OSError:  # pragma: no cover - workaround for Python bugs only
             pass  # safest, as there are python bugs in this area
 
+    def waitAndMeasure(self, process, usage, startTime):
+        # Reap the process ourselves, which tells us what it and all the processes it waited for used,
+        # as 'time' would have done
+        try:
+            _, status, rusage = plugins.retryOnInterrupt(os.wait4, process.pid, 0)
+        except OSError:  # pragma: no cover - someone else reaped it
+            return self.wait(process)
+        process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        # Sum over the test's processes, if there are several
+        usage["real"] = usage.get("real", 0.0) + time.time() - startTime
+        for field, rusageField in self.usageFields:
+            usage[field] = usage.get(field, 0) + getattr(rusage, rusageField)
+        maxRss = self.getMaxRssKb(rusage)
+        launcherPeakRss = usage.pop("launcherPeakRss", 0)
+        if maxRss > launcherPeakRss:
+            usage["maxrss_kb"] = max(usage.get("maxrss_kb", 0), maxRss)
+        else:
+            usage["maxrss_floor_kb"] = max(usage.get("maxrss_floor_kb", 0), launcherPeakRss)
+
+    def getMaxRssKb(self, rusage):
+        return rusage.ru_maxrss if sys.platform != "darwin" else rusage.ru_maxrss // 1024  # Mac reports bytes
+
+    def getLauncherPeakRss(self):
+        # The kernel carries the peak memory of our process over into the test through fork and exec,
+        # so the test's own peak is only visible when it is higher than anything we have ever used
+        return self.getMaxRssKb(resource.getrusage(resource.RUSAGE_SELF))
+
+    def getUsageToMeasure(self, test):
+        # Empty if we shouldn't, or can't, in which case getTimingArgs uses 'time' instead
+        if not self.measuresNatively(test):
+            return {}
+        usage = {}
+        if self.measuresCputime(test):
+            usage["cputime"] = True
+        memoryStem = test.getConfigValue("automatic_memory_stem")
+        if memoryStem and test.app.executingOnPerformanceMachine(test, memoryStem):
+            usage["memory"] = True
+        return usage
+
+    def measuresNatively(self, test):
+        # Remote processes are not our children, so we only see what ssh uses
+        return hasattr(os, "wait4") and test.app.getRunMachine() == "localhost"
+
+    def measuresCputime(self, test):
+        return test.app.hasAutomaticCputimeChecking() and test.app.executingOnPerformanceMachine(test)
+
+    def writeUsage(self, test, usage):
+        # Same format as 'time -p', plus peak memory and I/O, so that the same code reads both
+        if "real" not in usage:  # the process was reaped elsewhere, so we know nothing
+            return
+        fileName = test.makeTmpFileName("unixperf", forFramework=1)
+        self.diag.info("Writing resource usage " + repr(usage) + " to " + fileName)
+        with open(fileName, "w") as f:
+            if usage.pop("cputime", False):
+                for field in ["real", "user", "sys"]:
+                    f.write(field + " " + "%.2f" % usage[field] + "\n")
+            if usage.pop("memory", False):
+                if usage.get("maxrss_kb", 0) > usage.get("maxrss_floor_kb", 0):
+                    f.write("maxrss_kb " + str(usage["maxrss_kb"]) + "\n")
+                else:
+                    self.diag.info("Memory used is not measurable, it is no more than TextTest itself was using")
+            f.write("inblock " + str(usage["inblock"]) + "\n")
+            f.write("oublock " + str(usage["oublock"]) + "\n")
+
     def getRunDescription(self, test):
         commandArgs = self.getLocalExecuteCmdArgs(test, makeDirs=False)
         text = "Command Line   : " + plugins.commandLineString(commandArgs) + "\n"
@@ -386,7 +466,7 @@ class RunTest(plugins.Action):
 
     def getLocalExecuteCmdArgs(self, test, postfix="", makeDirs=True, forLinux=False):
         args = []
-        if test.app.hasAutomaticCputimeChecking() and test.app.executingOnPerformanceMachine(test):
+        if self.measuresCputime(test) and not self.measuresNatively(test):
             args += self.getTimingArgs(test, makeDirs)
 
         # Don't expand environment if we're running on a different file system
@@ -0,0 +1,117 @@
+
+""" Record of the time and memory tests use in each run, kept in a local SQLite database """
+
+import os
+import sqlite3
+import logging
+from threading import Lock
+from texttestlib import plugins
+
+
+def getPercentile(sortedValues, percentile):
+    # Linear interpolation between closest ranks
+    if not sortedValues:
+        return
+    position = (len(sortedValues) - 1) * percentile / 100.0
+    lower = int(position)
+    upper = min(lower + 1, len(sortedValues) - 1)
+    return sortedValues[lower] + (sortedValues[upper] - sortedValues[lower]) * (position - lower)
+
+
+class RuntimeHistory:
+    fields = ["wallclock", "cputime", "memory", "queuewait", "evaluation"]
+    recentRunCount = 10  # number of runs to consider when estimating the next one
+    formatVersion = 1
+    lock = Lock()
+    instances = {}
+
+    @classmethod
+    def forConfig(cls, configObj):
+        location = configObj.getConfigValue("runtime_history_database")
+        if not location:
+            return
+        if location == "personal":
+            location = os.path.join(plugins.getPersonalDir("runtime_history"), "runtimes.db")
+        with cls.lock:
+            fileName = os.path.abspath(location)
+            if fileName not in cls.instances:
+                cls.instances[fileName] = cls(fileName)
+            return cls.instances[fileName]
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.connection = None
+        self.connectionLock = Lock()
+        self.estimates = {}
+        self.diag = logging.getLogger("Runtime History")
+
+    def connect(self):
+        if self.connection is None:
+            plugins.ensureDirectoryExists(os.path.dirname(self.fileName))
+            # Accessed from several threads, and other TextTest runs may write at the same time
+            self.connection = sqlite3.connect(self.fileName, timeout=60, check_same_thread=False)
+            columns = ", ".join((field + " REAL" for field in self.fields))
+            with self.connection:
+                self.connection.execute("CREATE TABLE IF NOT EXISTS runs (app TEXT, version TEXT, test TEXT, " +
+                                        "finished REAL, host TEXT, " + columns + ")")
+                self.connection.execute("CREATE INDEX IF NOT EXISTS runs_by_test ON runs (app, version, test, finished)")
+                self.connection.execute("PRAGMA user_version = " + str(self.formatVersion))
+        return self.connection
+
+    def checkField(self, field):
+        if field not in self.fields:
+            raise plugins.TextTestError("Unknown runtime history field '" + field + "', expected one of " +
+                                        ", ".join(self.fields))
+
+    def record(self, rows):
+        # Each row is a dictionary with app, version, test, finished, host and any of the fields
+        columns = ["app", "version", "test", "finished", "host"] + self.fields
+        sql = "INSERT INTO runs (" + ", ".join(columns) + ") VALUES (" + ", ".join("?" * len(columns)) + ")"
+        with self.connectionLock:
+            connection = self.connect()
+            with connection:
+                connection.executemany(sql, [[row.get(column) for column in columns] for row in rows])
+        self.diag.info("Recorded " + str(len(rows)) + " runs in " + self.fileName)
+
+    def getValues(self, app, version, field, testPath=None, limit=None):
+        # Returns test path -> list of (finish time, value), most recent first
+        self.checkField(field)
+        sql = "SELECT test, finished, " + field + " FROM runs WHERE app = ? AND version = ? AND " + \
+              field + " IS NOT NULL"
+        args = [app, version]
+        if testPath is not None:
+            sql += " AND test = ?"
+            args.append(testPath)
+        sql += " ORDER BY test, finished DESC"
+        values = {}
+        with self.connectionLock:
+            for test, finished, value in self.connect().execute(sql, args):
+                testValues = values.setdefault(test, [])
+                if limit is None or len(testValues) < limit:
+                    testValues.append((finished, value))
+        return values
+
+    def getPercentiles(self, app, version, field, percentiles, testPath=None, limit=None):
+        # Returns test path -> (run count, list of values at the given percentiles)
+        summaries = {}
+        for test, testValues in self.getValues(app, version, field, testPath, limit).items():
+            sortedValues = sorted((value for _, value in testValues))
+            summaries[test] = len(sortedValues), [getPercentile(sortedValues, p) for p in percentiles]
+        return summaries
+
+    def getExpectedRuntime(self, app, version, testPath):
+        # Median of recent wall-clock times
+        return self.getRecentEstimate(app, version, testPath, "wallclock", 50)
+
+    def getExpectedMemory(self, app, version, testPath):
+        # Tests need room for their peak, so take the most any recent run used
+        return self.getRecentEstimate(app, version, testPath, "memory", 100)
+
+    def getRecentEstimate(self, app, version, testPath, field, percentile):
+        # Read for all tests at once, as it's usually needed for all of them
+        key = app, version, field, percentile
+        with self.lock:
+            if key not in self.estimates:
+                summaries = self.getPercentiles(app, version, field, [percentile], limit=self.recentRunCount)
+                self.estimates[key] = {test: values[0] for test, (_, values) in summaries.items()}
+            return self.estimates[key].get(testPath, -1.0)
@@ -1,17 +1,21 @@
 import os
+import errno
 import shutil
 import re
 import stat
 import subprocess
 import glob
+import fnmatch
 import logging
 import difflib
+import hashlib
 import time
 import sys
 from texttestlib import plugins
 from texttestlib.jobprocess import killProcessAndChildren
 from .runtest import Killed
 from collections import OrderedDict
+from threading import Lock
 from string import Template
 
 
@@ -33,6 +37,133 @@ class MakeWriteDirectory(plugins.Action):
         app.makeWriteDirectory()
 
 
+class SandboxCopier:
+    """ Copies test data into a sandbox as cheaply as the file systems involved allow,
+    keeping count of what it did so that it can be reported """
+    cloneRequest = 0x40049409  # FICLONE, for copy-on-write clones of whole files on Linux
+    blockSize = 1024 * 1024
+    methodDescriptions = OrderedDict([("copy", "copied"), ("reflink", "cloned"), ("hardlink", "hard linked")])
+    cannotClone = set()  # (source device, target device) pairs found not to support cloning
+    # Errors meaning the file systems can't clone at all, rather than a problem with one file
+    cloneUnsupportedErrors = {errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY}
+
+    def __init__(self, methods, workerCount):
+        self.methods = [method for method in methods if method != "copy"] + ["copy"]  # copying always works
+        self.workerCount = workerCount
+        self.lock = Lock()
+        self.counts = OrderedDict()  # method -> [files, bytes]
+        self.startTime = time.time()
+        self.diag = logging.getLogger("Prepare Writedir")
+
+    def copyfile(self, srcname, dstname):
+        for method in self.methods:
+            size = getattr(self, "copyBy" + method.capitalize())(srcname, dstname)
+            if size is not None:
+                self.diag.info("Used " + method + " for " + dstname)
+                with self.lock:
+                    counts = self.counts.setdefault(method, [0, 0])
+                    counts[0] += 1
+                    counts[1] += size
+                return
+
+    def copyByHardlink(self, srcname, dstname):
+        # Only safe if nobody can write to it, and then the sandbox file is read-only too
+        if os.stat(srcname).st_mode & 0o222 == 0:
+            try:
+                os.link(srcname, dstname)
+                return os.path.getsize(srcname)
+            except OSError:
+                pass
+
+    def copyByReflink(self, srcname, dstname):
+        if not hasattr(os, "copy_file_range"):  # Linux only, as is the clone request
+            return
+        devices = os.stat(srcname).st_dev, os.stat(os.path.dirname(dstname)).st_dev
+        if devices in self.cannotClone:
+            return
+        import fcntl
+        with open(srcname, "rb") as fsrc, open(dstname, "wb") as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), self.cloneRequest, fsrc.fileno())
+                cloneError = None
+            except OSError as e:
+                cloneError = e
+        if cloneError is None:
+            self.copyMetadata(srcname, dstname)
+            return os.path.getsize(srcname)
+        else:
+            os.remove(dstname)
+            self.diag.info("Could not clone " + srcname + " : " + str(cloneError))
+            if cloneError.errno in self.cloneUnsupportedErrors:
+                # Support is all or nothing for a pair of file systems, so don't keep asking
+                self.cannotClone.add(devices)
+
+    def copyByCopy(self, srcname, dstname):
+        with open(srcname, "rb") as fsrc, open(dstname, "wb") as fdst:
+            self.copyData(fsrc, fdst)
+        self.copyMetadata(srcname, dstname)
+        return os.path.getsize(srcname)
+
+    def copyData(self, fsrc, fdst):
+        # Let the kernel copy without passing through here, or the file system do it on the server
+        if hasattr(os, "copy_file_range"):
+            try:
+                copied = 0
+                while True:
+                    size = os.copy_file_range(fsrc.fileno(), fdst.fileno(), self.blockSize * 64)
+                    if size == 0:
+                        break
+                    copied += size
+                # Some file systems (e.g. /proc) report nothing to copy rather than failing, as shutil knows
+                if copied > 0:
+                    return
+            except OSError:
+                # e.g. across file systems on older kernels. Start again from where it got to
+                fsrc.seek(os.lseek(fsrc.fileno(), 0, os.SEEK_CUR))
+                fdst.seek(os.lseek(fdst.fileno(), 0, os.SEEK_CUR))
+        shutil.copyfileobj(fsrc, fdst, self.blockSize)
+
+    def copyMetadata(self, srcname, dstname):
+        # Basic aim is to keep the permission bits and times where possible, but ensure it is writeable
+        shutil.copystat(srcname, dstname)
+        plugins.makeWriteable(dstname)
+
+    def appendfile(self, srcname, dstname):
+        with open(srcname, "rb") as fsrc, open(dstname, "ab") as fdst:
+            shutil.copyfileobj(fsrc, fdst, self.blockSize)
+        with self.lock:
+            counts = self.counts.setdefault("copy", [0, 0])
+            counts[0] += 1
+            counts[1] += os.path.getsize(srcname)
+
+    def copyfiles(self, filePairs):
+        # Large trees are mostly waiting for the disk, so several files can usefully be copied at once
+        plugins.WorkerPool.callAll(self.tryCopyFile, filePairs, self.workerCount)
+
+    def tryCopyFile(self, srcname, dstname):
+        try:
+            self.copyfile(srcname, dstname)
+        except (IOError, os.error) as why:
+            print("Can't copy", srcname, "to", dstname, ":", why)
+
+    def describe(self):
+        parts = []
+        for method, description in self.methodDescriptions.items():
+            if method in self.counts:
+                fileCount, size = self.counts[method]
+                parts.append(description + " " + plugins.pluralise(fileCount, "file") + " (" + self.describeSize(size) + ")")
+        if parts:
+            return ", ".join(parts) + " in " + str(round(time.time() - self.startTime, 2)) + " seconds"
+
+    @staticmethod
+    def describeSize(size):
+        for unit in ["bytes", "KB", "MB"]:
+            if size < 1024:
+                return str(round(size, 1)) + " " + unit
+            size /= 1024.0
+        return str(round(size, 1)) + " GB"
+
+
 class PrepareWriteDirectory(plugins.Action):
     storytextDirsCopied = set()
 
@@ -40,6 +171,8 @@ class PrepareWriteDirectory(plugins.Action):
         self.diag = logging.getLogger("Prepare Writedir")
         self.ignoreCatalogues = ignoreCatalogues
         self.handledRequiredPaths = set()
+        self.copier = None
+        self.catalogueEntries = {}
         if self.ignoreCatalogues:
             self.diag.info("Ignoring all information in catalogue files")
 
@@ -52,9 +185,20 @@ class PrepareWriteDirectory(plugins.Action):
         else:
             remoteCopy = None
 
+        self.copier = SandboxCopier(test.getConfigValue("copy_test_path_methods"),
+                                    test.getConfigValue("copy_test_path_threads"))
         self.collateAllPaths(test, remoteCopy)
+        self.reportCopying(test)
         test.createPropertiesFiles()
 
+    def reportCopying(self, test):
+        description = self.copier.describe()
+        if description:
+            message = "Test data for " + repr(test) + " : " + description
+            self.diag.info(message)
+            if test.getConfigValue("report_sandbox_copying"):
+                plugins.log.info(message)
+
     def collateAllPaths(self, test, remoteCopy):
         self.collatePaths(test, "copy_test_path", self.copyTestPath, remoteCopy)
         self.collatePaths(test, "copy_test_path_merge", self.copyTestPath, remoteCopy, mergeData=True)
@@ -185,8 +329,7 @@ class PrepareWriteDirectory(plugins.Action):
 
         if os.path.isfile(fullPath):
             if os.path.isfile(target):
-                with open(target, "a") as f:
-                    f.write(open(fullPath).read())
+                self.copier.appendfile(fullPath, target)
             else:
                 self.copyfile(fullPath, target)
         if os.path.isdir(fullPath):
@@ -202,11 +345,21 @@ class PrepareWriteDirectory(plugins.Action):
             os.utime(dst, (st[stat.ST_ATIME], st[stat.ST_MTIME]))
 
     def copytree(self, src, dst):
-        # Code is a copy of shutil.copytree, with copying modification times
-        # so that we can tell when things change...
+        # Like shutil.copytree, but copying modification times so that we can tell when things change,
+        # and not overwriting anything already there when merging. The directories and links are made
+        # first, so that the files can then be copied several at once
+        filePairs, dirPairs = [], []
+        self.makeTree(src, dst, filePairs, dirPairs)
+        self.copier.copyfiles(filePairs)
+        # Last of all, keep the modification times as they were, deepest first
+        for srcname, dstname in reversed(dirPairs):
+            self.copytimes(srcname, dstname)
+
+    def makeTree(self, src, dst, filePairs, dirPairs):
         names = os.listdir(src)
         if not os.path.exists(dst):
             os.mkdir(dst)
+        dirPairs.append((src, dst))
         for name in names:
             srcname = os.path.join(src, name)
             dstname = os.path.join(dst, name)
@@ -216,13 +369,11 @@ class PrepareWriteDirectory(plugins.Action):
                 if os.path.islink(srcname):
                     self.copylink(srcname, dstname)
                 elif os.path.isdir(srcname):
-                    self.copytree(srcname, dstname)
+                    self.makeTree(srcname, dstname, filePairs, dirPairs)
                 else:
-                    self.copyfile(srcname, dstname)
+                    filePairs.append((srcname, dstname))
             except (IOError, os.error) as why:
                 print("Can't copy", srcname, "to", dstname, ":", why)
-        # Last of all, keep the modification time as it was
-        self.copytimes(src, dst)
 
     def copylink(self, srcname, dstname):
         linkto = srcname
@@ -231,9 +382,7 @@ class PrepareWriteDirectory(plugins.Action):
         os.symlink(linkto, dstname)
 
     def copyfile(self, srcname, dstname):
-        # Basic aim is to keep the permission bits and times where possible, but ensure it is writeable
-        shutil.copy2(srcname, dstname)
-        plugins.makeWriteable(dstname)
+        self.copier.copyfile(srcname, dstname)
 
     def linkTestPath(self, test, fullPath, target):
         # Linking doesn't exist on windows!
@@ -309,12 +458,9 @@ class PrepareWriteDirectory(plugins.Action):
         # Catalogue file is actually relative to temporary directory, need to take one level above...
         rootDir = os.path.split(sourcePath)[0]
         fullPaths = {rootDir: []}
+        pathsFound = set()
         currentPaths = [rootDir]
-        for line in open(catFile).readlines():
-            fileName, indent = self.parseCatalogue(line)
-            if not fileName:
-                continue
-
+        for fileName, indent in self.getCatalogueEntries(catFile):
             if fileName == sourceNameInCatalogue and indent == 1:
                 fileName = os.path.basename(sourcePath)
 
@@ -326,11 +472,28 @@ class PrepareWriteDirectory(plugins.Action):
                 currentPaths[indent] = fullPath
             if fullPath not in fullPaths:
                 fullPaths[fullPath] = []
-            if not fullPath in fullPaths[prevPath]:
+            if (prevPath, fullPath) not in pathsFound:
+                pathsFound.add((prevPath, fullPath))
                 fullPaths[prevPath].append(fullPath)
         del fullPaths[rootDir]
         return fullPaths
 
+    def getCatalogueEntries(self, catFile):
+        # Each partial_copy_test_path in each test reads the same catalogue, so parse it once
+        statInfo = os.stat(catFile)
+        signature = statInfo.st_mtime_ns, statInfo.st_size
+        cached = self.catalogueEntries.get(catFile)
+        if cached is None or cached[0] != signature:
+            entries = []
+            with open(catFile) as f:
+                for line in f:
+                    fileName, indent = self.parseCatalogue(line)
+                    if fileName:
+                        entries.append((fileName, indent))
+            cached = signature, entries
+            self.catalogueEntries[catFile] = cached
+        return cached[1]
+
     def parseCatalogue(self, line):
         pos = line.rfind("----")
         if pos == -1:
@@ -622,13 +785,126 @@ class TestEnvironmentCreator:
         return pathVars
 
 
+class CollationSnapshot:
+    """ The files matching a test's collation patterns, and when they were modified, found with one pass over its
+    sandbox. Matches as glob would, but relative to the sandbox rather than the working directory, which is shared
+    by all threads """
+    separators = re.compile("[/" + re.escape(os.sep) + "]")
+
+    def __init__(self, test, patterns):
+        # Test name may contain glob meta-characters, so we must never glob the absolute path
+        self.localTestDir = test.getDirectory(temporary=1, local=1)
+        self.logDir = test.getDirectory(temporary=1)
+        self.found = {}  # pattern -> (directory found in, sorted paths of files)
+        self.modTimes = {}
+        self.diag = logging.getLogger("Collate Files")
+        self.addPatterns(patterns)
+
+    def addPatterns(self, patterns):
+        newPatterns = [pattern for pattern in OrderedDict.fromkeys(patterns) if pattern not in self.found]
+        localMatches = self.scan(self.localTestDir, newPatterns)
+        logDirMatches = {}
+        if self.logDir != self.localTestDir:
+            logDirMatches = self.scan(self.logDir, [pattern for pattern in newPatterns if not localMatches[pattern]])
+        for pattern in newPatterns:
+            if logDirMatches.get(pattern):
+                self.found[pattern] = self.logDir, self.filterFiles(logDirMatches[pattern])
+            else:
+                self.found[pattern] = self.localTestDir, self.filterFiles(localMatches[pattern])
+
+    def rescan(self, patterns):
+        # For patterns that may match files written since, by other collations
+        for pattern in patterns:
+            self.found.pop(pattern, None)
+        self.addPatterns(patterns)
+
+    def couldMatch(self, pattern, path):
+        # Whether findPaths(pattern) would include path, if it existed
+        rootDirs = [""] if os.path.isabs(pattern) else [self.localTestDir, self.logDir]
+        patternParts = self.separators.split(pattern)
+        for rootDir in rootDirs:
+            pathParts = self.separators.split(os.path.relpath(path, rootDir) if rootDir else path)
+            if len(pathParts) == len(patternParts) and \
+                    all((fnmatch.fnmatch(name, part) for name, part in zip(pathParts, patternParts))):
+                return True
+        return False
+
+    def findPaths(self, pattern):
+        if pattern not in self.found:
+            self.addPatterns([pattern])
+        testDir, paths = self.found[pattern]
+        return testDir, list(paths)
+
+    def getModifiedTime(self, path):
+        return self.modTimes.get(path)
+
+    def filterFiles(self, paths):
+        files = []
+        for path in sorted(paths):
+            try:
+                statInfo = os.stat(path)
+            except OSError:
+                continue
+            if stat.S_ISREG(statInfo.st_mode):
+                files.append(path)
+                self.modTimes[path] = statInfo.st_mtime
+        return files
+
+    def scan(self, rootDir, patterns):
+        matches = OrderedDict((pattern, []) for pattern in patterns)
+        pending = []
+        for pattern in patterns:
+            if os.path.isabs(pattern):
+                matches[pattern] = glob.glob(pattern)
+            else:
+                pending.append((pattern, self.separators.split(pattern)))
+        if pending:
+            self.scanDirectory(rootDir, pending, matches)
+        return matches
+
+    def scanDirectory(self, dirPath, pending, matches):
+        # Each entry in pending is a pattern and its path components still to match below dirPath
+        entries = None
+        subdirPending = OrderedDict()
+        for pattern, parts in pending:
+            part, isLast = parts[0], len(parts) == 1
+            if glob.has_magic(part):
+                if entries is None:
+                    entries = self.listDirectory(dirPath)
+                # glob hides files starting with "." unless the pattern does too
+                names = [name for name in entries if part.startswith(".") or not name.startswith(".")]
+                for name in fnmatch.filter(names, part):
+                    if isLast:
+                        matches[pattern].append(os.path.join(dirPath, name))
+                    elif entries[name].is_dir():
+                        subdirPending.setdefault(name, []).append((pattern, parts[1:]))
+            else:
+                path = os.path.join(dirPath, part)
+                if isLast:
+                    if os.path.lexists(path):
+                        matches[pattern].append(path)
+                elif os.path.isdir(path):
+                    subdirPending.setdefault(part, []).append((pattern, parts[1:]))
+        for name, subPending in subdirPending.items():
+            self.scanDirectory(os.path.join(dirPath, name), subPending, matches)
+
+    def listDirectory(self, dirPath):
+        self.diag.info("Listing " + dirPath)
+        try:
+            with os.scandir(dirPath) as it:
+                return OrderedDict((entry.name, entry) for entry in it)
+        except OSError:
+            return OrderedDict()
+
+
 class CollateFiles(plugins.Action):
     def __init__(self):
         self.filesPresentBefore = {}
-        self.collationProc = None
+        self.collationProcs = {}  # test -> the processes currently running its collate_script pipelines
+        self.lock = Lock()
         self.diag = logging.getLogger("Collate Files")
 
-    def expandCollations(self, test):
+    def expandCollations(self, test, snapshot):
         newColl = OrderedDict()
         coll = test.getConfigValue("collate_file")
         self.diag.info("coll initial:" + str(coll))
@@ -640,7 +916,7 @@ class CollateFiles(plugins.Action):
 
             # add each file to newColl by transferring wildcards across
             for sourcePattern in sourcePatterns:
-                testDir, sourcePaths = self.findPaths(test, sourcePattern)
+                testDir, sourcePaths = self.findPaths(test, sourcePattern, snapshot)
                 for sourcePath in sourcePaths:
                     # Use relative paths: easier to debug and SequenceMatcher breaks down if strings are longer than 200 chars
                     relativeSourcePath = plugins.relpath(sourcePath, testDir)
@@ -727,24 +1003,61 @@ class CollateFiles(plugins.Action):
                 if self.containsRegexps(filePath, regexps):
                     self.removeUnwantedFile(filePath)
 
-    def findEditedFiles(self, test, patterns):
+    def findEditedFiles(self, test, patterns, snapshot):
         editedFiles = []
         for pattern in patterns:
-            for fullpath in self.findPaths(test, pattern)[1]:
-                if self.testEdited(test, fullpath):
+            for fullpath in self.findPaths(test, pattern, snapshot)[1]:
+                if self.testEdited(test, fullpath, snapshot):
                     editedFiles.append(fullpath)
                 else:
                     self.diag.info("Found " + fullpath + " but it wasn't edited")
         return editedFiles
 
     def collate(self, test):
-        for targetStem, sourcePatterns in self.expandCollations(test):
-            sourceFiles = self.findEditedFiles(test, sourcePatterns)
-            if sourceFiles:
-                targetFile = test.makeTmpFileName(targetStem)
-                collationErrFile = test.makeTmpFileName(targetStem + ".collate_errs", forFramework=1)
-                self.diag.info("Extracting " + ",".join(sourceFiles) + " to " + targetFile)
-                self.extract(test, sourceFiles, targetFile, collationErrFile)
+        snapshot = self.makeSnapshot(test)
+        collations = self.expandCollations(test, snapshot)
+        independent, dependent = self.findDependentCollations(test, collations, snapshot)
+        extractions = []
+        for targetStem, sourcePatterns in independent:
+            extraction = self.makeExtraction(test, targetStem, sourcePatterns, snapshot)
+            if extraction:
+                extractions.append(extraction)
+        # Each extraction writes its own files, so the collate_script pipelines can run at the same time
+        plugins.WorkerPool.callAll(self.extract, extractions, test.getConfigValue("collation_workers"))
+        # Those that read what other collations write go afterwards, one at a time, looking again each time
+        for targetStem, sourcePatterns in dependent:
+            snapshot.rescan(sourcePatterns)
+            extraction = self.makeExtraction(test, targetStem, sourcePatterns, snapshot)
+            if extraction:
+                self.extract(*extraction)
+
+    def findDependentCollations(self, test, collations, snapshot):
+        targetFiles = [test.makeTmpFileName(targetStem) for targetStem, _ in collations]
+        independent, dependent = [], []
+        for (targetStem, sourcePatterns), targetFile in zip(collations, targetFiles):
+            otherTargets = [f for f in targetFiles if f != targetFile]
+            # '*' never picks up collated files, see alreadyCollated
+            if any((snapshot.couldMatch(sourcePattern, otherTarget) for sourcePattern in sourcePatterns
+                    if sourcePattern != "*" for otherTarget in otherTargets)):
+                self.diag.info("Collation to " + targetStem + " reads the output of other collations")
+                dependent.append((targetStem, sourcePatterns))
+            else:
+                independent.append((targetStem, sourcePatterns))
+        return independent, dependent
+
+    def makeExtraction(self, test, targetStem, sourcePatterns, snapshot):
+        sourceFiles = self.findEditedFiles(test, sourcePatterns, snapshot)
+        if sourceFiles:
+            targetFile = test.makeTmpFileName(targetStem)
+            collationErrFile = test.makeTmpFileName(targetStem + ".collate_errs", forFramework=1)
+            self.diag.info("Extracting " + ",".join(sourceFiles) + " to " + targetFile)
+            return test, sourceFiles, targetFile, collationErrFile
+
+    def makeSnapshot(self, test):
+        patterns = []
+        for sourcePatterns in test.getConfigValue("collate_file").values():
+            patterns += sourcePatterns
+        return CollationSnapshot(test, patterns)
 
     def tryFetchRemoteFiles(self, test):
         machine, remoteTmpDir = test.app.getRemoteTestTmpDir(test)
@@ -757,18 +1070,19 @@ class CollateFiles(plugins.Action):
 
     def getFilesPresent(self, test):
         files = OrderedDict()
+        snapshot = self.makeSnapshot(test)
         for sourcePatterns in list(test.getConfigValue("collate_file").values()):
             for sourcePattern in sourcePatterns:
-                for fullPath in self.findPaths(test, sourcePattern)[1]:
+                for fullPath in self.findPaths(test, sourcePattern, snapshot)[1]:
                     self.diag.info("Pre-existing file found " + fullPath)
-                    files[fullPath] = plugins.modifiedTime(fullPath)
+                    files[fullPath] = snapshot.getModifiedTime(fullPath)
         return files
 
-    def testEdited(self, test, fullPath):
+    def testEdited(self, test, fullPath, snapshot):
         filesBefore = self.filesPresentBefore[test]
         if fullPath not in filesBefore:
             return True
-        return filesBefore[fullPath] != plugins.modifiedTime(fullPath)
+        return filesBefore[fullPath] != snapshot.getModifiedTime(fullPath)
 
     def alreadyCollated(self, test, path, sourcePattern):
         if "/" not in sourcePattern:
@@ -777,31 +1091,9 @@ class CollateFiles(plugins.Action):
                 return True  # Don't collate generated files
         return False
 
-    def glob(self, test, sourcePattern):
-        # Test name may contain glob meta-characters, and there is no way to quote them (see comment in fnmatch.py)
-        # So we can't just form an absolute path and glob that
-        localTestDir = test.getDirectory(temporary=1, local=1)
-        localFiles = self.globDir(localTestDir, sourcePattern)
-        if not localFiles:
-            logDir = test.getDirectory(temporary=1)
-            if logDir != localTestDir:
-                logDirFiles = self.globDir(logDir, sourcePattern)
-                if logDirFiles:
-                    return logDir, logDirFiles
-        return localTestDir, localFiles
-
-    def globDir(self, testDir, sourcePattern):
-        origCwd = os.getcwd()
-        os.chdir(testDir)
-        result = glob.glob(sourcePattern)
-        os.chdir(origCwd)
-        return [os.path.join(testDir, f) for f in result]
-
-    def findPaths(self, test, sourcePattern):
+    def findPaths(self, test, sourcePattern, snapshot):
         self.diag.info("Looking for pattern " + sourcePattern + " for " + repr(test))
-        testDir, paths = self.glob(test, sourcePattern)
-        paths.sort()
-        existingPaths = list(filter(os.path.isfile, paths))
+        testDir, existingPaths = snapshot.findPaths(sourcePattern)
         if sourcePattern == "*":  # interpret this specially to mean 'all files which are not collated already'
             return testDir, [f for f in existingPaths if not self.alreadyCollated(test, f, sourcePattern)]
         else:
@@ -828,10 +1120,30 @@ class CollateFiles(plugins.Action):
                 stderr.close()
 
     def kill(self, test, sig):
-        if self.collationProc:
-            proc = self.collationProc
-            self.collationProc = None
-            killProcessAndChildren(proc, cmd=test.getConfigValue("kill_command"))
+        with self.lock:
+            procs = self.collationProcs.pop(test, [])
+        for proc in procs:
+            killProcessAndChildren(proc.pid, cmd=test.getConfigValue("kill_command"))
+
+    def replaceCollationProc(self, test, oldProc, newProc):
+        # Returns False if the old process was killed in the meantime
+        with self.lock:
+            procs = self.collationProcs.get(test, [])
+            if oldProc is not None:
+                if oldProc not in procs:
+                    return False
+                procs.remove(oldProc)
+            if newProc is not None:
+                self.collationProcs.setdefault(test, procs).append(newProc)
+            elif not procs:
+                self.collationProcs.pop(test, None)
+            return True
+
+    def collationKilled(self, test, procName, sourceFilesStr):
+        briefText = "KILLED (" + os.path.basename(procName) + ")"
+        freeText = "Killed collation script '" + procName + \
+            "'\n while collating file(s) at " + sourceFilesStr + "\n"
+        test.changeState(Killed(briefText, freeText, test.state))
 
     def extract(self, test, sourceFiles, targetFile, collationErrFile):
         stem = os.path.splitext(os.path.basename(targetFile))[0]
@@ -844,12 +1156,12 @@ class CollateFiles(plugins.Action):
                 sys.stderr.write(msg)
             return shutil.copyfile(sourceFiles[0], targetFile)
 
-        self.collationProc = None
+        collationProc = None
         stdin = None
         for script in scripts:
             args = script.split()
-            if self.collationProc:
-                stdin = self.collationProc.stdout
+            if collationProc:
+                stdin = collationProc.stdout
             else:
                 args += sourceFiles
             self.diag.info("Opening extract process with args " + repr(args))
@@ -860,8 +1172,19 @@ class CollateFiles(plugins.Action):
                 stdout = subprocess.PIPE
                 stderr = subprocess.STDOUT
 
-            self.collationProc = self.runCollationScript(args, test, stdin, stdout, stderr)
-            if not self.collationProc:
+            newProc = self.runCollationScript(args, test, stdin, stdout, stderr)
+            if not self.replaceCollationProc(test, collationProc, newProc):
+                # Killed while the pipeline was starting up, so nothing else knows about the new process
+                if newProc:
+                    killProcessAndChildren(newProc.pid, cmd=test.getConfigValue("kill_command"))
+                    newProc.wait()
+                self.collationKilled(test, args[0], sourceFilesStr)
+                if hasattr(stdout, "close"):
+                    stdout.close()
+                    stderr.close()
+                return
+            collationProc = newProc
+            if not collationProc:
                 if os.path.isfile(targetFile):
                     os.remove(targetFile)
                 errorMsg = "Could not find extract script '" + script + \
@@ -872,17 +1195,11 @@ class CollateFiles(plugins.Action):
                 stderr.close()
                 return
 
-        if self.collationProc:
+        if collationProc:
             self.diag.info("Waiting for collation process to terminate...")
-            self.collationProc.wait()
-            if self.collationProc:
-                self.collationProc = None
-            else:
-                procName = args[0]
-                briefText = "KILLED (" + os.path.basename(procName) + ")"
-                freeText = "Killed collation script '" + procName + \
-                    "'\n while collating file(s) at " + sourceFilesStr + "\n"
-                test.changeState(Killed(briefText, freeText, test.state))
+            collationProc.wait()
+            if not self.replaceCollationProc(test, collationProc, None):
+                self.collationKilled(test, args[0], sourceFilesStr)
             stdout.close()
             stderr.close()
 
@@ -911,8 +1228,11 @@ class FindExecutionHosts(plugins.Action):
 
 
 class CreateCatalogue(plugins.Action):
+    hashBlockSize = 1024 * 1024
+
     def __init__(self):
         self.catalogues = {}
+        self.contentHashes = {}
         self.diag = logging.getLogger("catalogues")
 
     def __call__(self, test):
@@ -925,10 +1245,13 @@ class CreateCatalogue(plugins.Action):
         else:
             self.diag.info("Collecting original information...")
             self.catalogues[test] = self.findAllPaths(test)[0]
+            if test.getConfigValue("catalogue_compare_contents"):
+                self.contentHashes[test] = self.hashFiles(self.catalogues[test])
 
     def createCatalogueChangeFile(self, test):
-        oldPaths = self.catalogues[test]
+        oldPaths = self.catalogues.pop(test)
         newPaths, ignoredPaths = self.findAllPaths(test)
+        self.ignoreUnchangedContents(oldPaths, newPaths, self.contentHashes.pop(test, {}))
         tmpDir = test.getDirectory(temporary=1, local=1)
         pathsLost, pathsEdited, pathsGained = self.findDifferences(oldPaths, newPaths, ignoredPaths, tmpDir)
         processesGained = self.findProcessesGained(test)
@@ -993,20 +1316,74 @@ class CreateCatalogue(plugins.Action):
         return processes
 
     def findAllPaths(self, test):
-        allPaths = OrderedDict()
-        paths, ignoredPaths = test.listUnownedTmpPaths()
-        for path in paths:
-            editInfo = self.getEditInfo(path)
-            self.diag.info("Path " + path + " edit info " + editInfo)
-            allPaths[path] = editInfo
+        # Same paths, in the same order, as Test.listUnownedTmpPaths, but with the edit information
+        # from the same directory scan
+        allPaths, ignoredPaths = OrderedDict(), []
+        writeDir = test.getDirectory(temporary=1, local=1)
+        names = test.getUnownedTmpNames()
+        with os.scandir(writeDir) as it:
+            entries = {entry.name: entry for entry in it if entry.name in names}
+        for name in names:
+            if name in entries:
+                filesToIgnore = test.getCompositeConfigValue("test_data_ignore", name)
+                self.scanEntries(test, [entries[name]], filesToIgnore, allPaths, ignoredPaths)
+        self.diag.info("Found " + str(len(allPaths)) + " paths, ignoring " + str(len(ignoredPaths)))
         return allPaths, ignoredPaths
 
-    def getEditInfo(self, fullPath):
-        # Check modified times for files and directories, targets for links
-        if os.path.islink(fullPath):
-            return os.path.realpath(fullPath)
-        else:
-            return time.strftime(plugins.datetimeFormat, time.localtime(plugins.modifiedTime(fullPath)))
+    def scanEntries(self, test, entries, filesToIgnore, allPaths, ignoredPaths):
+        # Files before directories, and directories followed by their contents, as in Test.listFilesFrom
+        dirEntries = []
+        for entry in sorted(entries, key=lambda e: e.name):
+            if test.app.fileMatches(entry.name, filesToIgnore):
+                ignoredPaths.append(entry.path)
+            elif entry.is_dir(follow_symlinks=False):
+                dirEntries.append(entry)
+            else:
+                allPaths[entry.path] = self.getEditInfo(entry)
+        for entry in dirEntries:
+            allPaths[entry.path] = self.getEditInfo(entry)
+            try:
+                with os.scandir(entry.path) as it:
+                    subEntries = list(it)
+            except OSError:
+                continue
+            self.scanEntries(test, subEntries, filesToIgnore, allPaths, ignoredPaths)
+
+    def getEditInfo(self, entry):
+        # Check identity, size and modified time for files and directories, targets for links
+        try:
+            if entry.is_symlink():
+                return os.path.realpath(entry.path)
+            statInfo = entry.stat(follow_symlinks=False)
+            return statInfo.st_ino, statInfo.st_size, statInfo.st_mtime_ns
+        except OSError:  # removed while we were looking
+            return None
+
+    def hashFiles(self, paths):
+        hashes = {}
+        for path, editInfo in paths.items():
+            if isinstance(editInfo, tuple) and os.path.isfile(path):
+                hashes[path] = self.hashFile(path)
+        return hashes
+
+    def hashFile(self, path):
+        digest = hashlib.md5()
+        try:
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(self.hashBlockSize), b""):
+                    digest.update(block)
+        except EnvironmentError:
+            return None
+        return digest.digest()
+
+    def ignoreUnchangedContents(self, oldPaths, newPaths, oldHashes):
+        # Files rewritten with the same contents aren't edited. Only those with the same size can be
+        for path, oldHash in oldHashes.items():
+            oldInfo, newInfo = oldPaths.get(path), newPaths.get(path)
+            if isinstance(newInfo, tuple) and isinstance(oldInfo, tuple) and newInfo != oldInfo and newInfo[1] == oldInfo[1] and \
+                    oldHash is not None and self.hashFile(path) == oldHash:
+                self.diag.info("Contents of " + path + " have not changed")
+                newPaths[path] = oldInfo
 
     def findDifferences(self, oldPaths, newPaths, ignoredPaths, writeDir):
         pathsGained, pathsEdited, pathsLost = [], [], []
@@ -1029,14 +1406,11 @@ class CreateCatalogue(plugins.Action):
         return pathsLost, pathsEdited, pathsGained
 
     def removeParents(self, toRemove, toFind):
-        removeList = []
-        for path in toFind:
-            parent = os.path.split(path)[0]
-            if parent in toRemove and not parent in removeList:
-                removeList.append(parent)
-        for path in removeList:
-            self.diag.info("Removing parent path " + path)
-            toRemove.remove(path)
+        parents = set((os.path.split(path)[0] for path in toFind))
+        for path in toRemove:
+            if path in parents:
+                self.diag.info("Removing parent path " + path)
+        toRemove[:] = [path for path in toRemove if path not in parents]
 
     def outputPathName(self, path, writeDir):
         self.diag.info("Output name for " + path)
@@ -1091,6 +1465,8 @@ class UNIXPerformanceInfoFinder:
         cpuTime = None
         realTime = None
         for line in file.readlines():
+            if line.startswith("maxrss_kb") or line.startswith("inblock") or line.startswith("oublock"):
+                continue  # written by RunTest, along with the times
             self.diag.info("Parsing line " + line.strip())
             if line.startswith("user") or line.startswith("User"):
                 cpuTime = self.parseUnixTime(line)
@@ -1100,6 +1476,15 @@ class UNIXPerformanceInfoFinder:
                 realTime = self.parseUnixTime(line)
         return cpuTime, realTime
 
+    def findMemoryUsedBy(self, test):
+        # Peak resident set size in MB of the largest process, if RunTest measured it
+        tmpFile = test.makeTmpFileName("unixperf", forFramework=1)
+        if os.path.isfile(tmpFile):
+            with open(tmpFile) as f:
+                for line in f:
+                    if line.startswith("maxrss_kb"):
+                        return float(line.split()[-1]) / 1024
+
     def parseUnixTime(self, line):
         # Assumes output of GNU time
         words = line.strip().split()
@@ -1122,6 +1507,7 @@ class MakePerformanceFile(PerformanceFileCreator):
         self.systemPerfInfoFinder.setUpApplication(app)
 
     def makePerformanceFiles(self, test):
+        self.makeMemoryFile(test)
         cpuTime, realTime = self.systemPerfInfoFinder.findTimesUsedBy(test)
         # There was still an error (jobs killed in emergency), so don't write performance files
         if cpuTime is None:
@@ -1130,6 +1516,14 @@ class MakePerformanceFile(PerformanceFileCreator):
         fileToWrite = test.makeTmpFileName("performance")
         self.writeFile(test, cpuTime, realTime, fileToWrite)
 
+    def makeMemoryFile(self, test):
+        memoryStem = test.getConfigValue("automatic_memory_stem")
+        memory = self.systemPerfInfoFinder.findMemoryUsedBy(test) if memoryStem else None
+        if memory is not None:
+            # Always measured in MB, whatever performance_unit says
+            with open(test.makeTmpFileName(memoryStem), "w") as f:
+                f.write("Max " + memoryStem.capitalize() + "  :      " + str(round(memory, 2)) + " MB\n")
+
     def timeString(self, timeVal):
         return str(round(float(timeVal), 1)).rjust(9)
 
@@ -1,12 +1,14 @@
 
 """ All the standard scripts that come with the default configuration """
 
-from . import sandbox
+from . import sandbox, rundependent
 import operator
 import os
 import shutil
 import sys
 import random
+import time
+from io import StringIO
 from glob import glob
 from texttestlib import plugins
 from collections import OrderedDict
@@ -462,6 +464,73 @@ class ExtractStandardPerformance(sandbox.ExtractPerformanceFiles):
         return " on unknown machine (extracted)\n"
 
 
+class BenchmarkFiltering(plugins.Action):
+    scriptDoc = "time run_dependent_text/unordered_text filtering of the approved files with and without the compiled engine"
+    filterClasses = [rundependent.RunDependentTextFilter, rundependent.UnorderedTextFilter]
+    times = OrderedDict([(False, 0.0), (True, 0.0)])
+    fileCount = 0
+    differences = []
+
+    @classmethod
+    def finalise(cls):
+        print("Filtered", cls.fileCount, "files:")
+        print("Original engine took", "%.3f" % cls.times[False], "seconds")
+        print("Compiled engine took", "%.3f" % cls.times[True], "seconds")
+        if cls.differences:
+            print("Filtered text differed for:\n" + "\n".join(cls.differences))
+        else:
+            print("Filtered text was identical for all files.")
+
+    def __repr__(self):
+        return "Benchmarking filtering for"
+
+    def __call__(self, test):
+        self.describe(test)
+        resultFiles, _ = test.listApprovedFiles(allVersions=False)
+        for stdFile in resultFiles:
+            if os.path.isfile(stdFile):
+                self.benchmarkFile(test, stdFile)
+
+    def benchmarkFile(self, test, stdFile):
+        stem = os.path.basename(stdFile).split(".")[0]
+        for filterClass in self.filterClasses:
+            texts = test.getCompositeConfigValue(filterClass.configKey, stem)
+            if texts:
+                outputs = [self.filterFile(filterClass(texts, test.getRelPath(), compiled), stdFile)
+                           for compiled in self.times]
+                if outputs[0] != outputs[1]:
+                    self.differences.append(stdFile + " (" + filterClass.configKey + ")")
+                BenchmarkFiltering.fileCount += 1
+
+    def filterFile(self, textFilter, stdFile):
+        output = StringIO()
+        with open(stdFile, errors="ignore") as readFile:
+            startTime = time.time()
+            textFilter.filterFile(readFile, output)
+            self.times[textFilter.compiled] += time.time() - startTime
+        return output.getvalue()
+
+    def setUpSuite(self, suite):
+        self.describe(suite)
+
+
+class PruneFilteredFileCache(plugins.ScriptWithArgs):
+    scriptDoc = "remove the least recently used files from the filtered_file_cache until it is no larger than 'size' (default its configured maximum)"
+
+    def __init__(self, args=[]):
+        argDict = self.parseArguments(args, ["size"])
+        self.maxSize = plugins.parseBytes(argDict["size"]) if "size" in argDict else None
+
+    def setUpApplication(self, app):
+        cache = rundependent.FilteredFileCache.forConfig(app)
+        if cache is None:
+            print("No filtered_file_cache is configured for", app.description())
+            return
+        maxSize = self.maxSize if self.maxSize is not None else cache.maxSize
+        removedCount, removedSize = cache.prune(maxSize)
+        print("Removed", plugins.pluralise(removedCount, "file"), "(" + str(removedSize), "bytes) from", cache.directory)
+
+
 class InsertShortcuts(plugins.ScriptWithArgs):
     def __repr__(self):
         return "Inserting shortcuts into usecases for"
@@ -111,11 +111,17 @@ class Activator(plugins.Responder, plugins.Observable):
             guideSuite = self.findGuideSuiteForCopy(suite.app.versions)
             if guideSuite is not None:
                 self.diag.info("Creating test suite by copying " + repr(guideSuite))
-                return suite.readContents(guideSuite=guideSuite)
+                return suite.app.readInitialTestSuiteContents(suite, guideSuite=guideSuite)
 
         filters = suite.app.getFilterList(self.suites)
         self.diag.info("Creating test suite with filters " + repr(filters))
-        return suite.readContents(filters)
+        return suite.app.readInitialTestSuiteContents(suite, filters)
+
+    def reportStartupTimes(self, app):
+        message = app.describeStartupTimes()
+        self.diag.info(message)
+        if app.getConfigValue("report_startup_times"):
+            plugins.log.info(message)
 
     def run(self):
         goodSuites = []
@@ -133,6 +139,7 @@ class Activator(plugins.Responder, plugins.Observable):
                     rejectionInfo[suite.app] = "no tests matching the selection criteria found."
             except plugins.TextTestError as e:
                 rejectionInfo[suite.app] = str(e)
+            self.reportStartupTimes(suite.app)
 
         self.notify("AllRead", goodSuites)
 
@@ -380,9 +387,9 @@ class TextTest(plugins.Responder, plugins.Observable):
         if testExitCode and self.exitCode != 1:
             self.exitCode = testExitCode
 
-    def run(self):
+    def run(self, allApps=None):
         try:
-            self._run()
+            self._run(allApps)
             self.diag.info("Exiting with exit code " + str(self.exitCode))
             sys.exit(self.exitCode)
         except plugins.TextTestError as e:
@@ -391,8 +398,11 @@ class TextTest(plugins.Responder, plugins.Observable):
         except KeyboardInterrupt:
             pass  # already written about this
 
-    def _run(self):
-        appFindingWroteError, allApps = self.findApps()
+    def _run(self, allApps=None):
+        # The applications may already have been found, if we were forked from a process that did so
+        appFindingWroteError = False
+        if allApps is None:
+            appFindingWroteError, allApps = self.findApps()
         if self.inputOptions.helpMode():
             if len(allApps) > 0:
                 allApps[0].printHelpText()
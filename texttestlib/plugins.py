@@ -14,12 +14,14 @@ import fnmatch
 import subprocess
 from collections import OrderedDict
 from traceback import format_exception
-from threading import currentThread, RLock
+from threading import currentThread, RLock, Lock
 from queue import Queue, Empty
 from glob import glob
 from datetime import datetime
 from pickle import Unpickler, UnpicklingError
 from locale import getpreferredencoding
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
 
 
 class Callable:
@@ -604,6 +606,37 @@ class ThreadedNotificationHandler:
                 self.source = self.idleHandler()
 
 
+class WorkerPool:
+    """ Executors for doing independent pieces of work for a test at the same time, e.g. filtering
+    and comparing its result files. They live for the whole run, so processes are only started once """
+    lock = Lock()
+    executors = {}
+
+    @classmethod
+    def getExecutor(cls, workerCount, useProcesses):
+        # Frozen programs can't start Python subprocesses to run our code
+        useProcesses = useProcesses and not getattr(sys, 'frozen', False)
+        key = workerCount, useProcesses
+        with cls.lock:
+            if key not in cls.executors:
+                if useProcesses:
+                    # Don't fork, other threads may be holding locks
+                    context = multiprocessing.get_context("spawn")
+                    cls.executors[key] = ProcessPoolExecutor(workerCount, mp_context=context)
+                else:
+                    cls.executors[key] = ThreadPoolExecutor(workerCount)
+            return cls.executors[key]
+
+    @classmethod
+    def callAll(cls, method, argLists, workerCount, useProcesses=False):
+        """ Returns method(*args) for each entry in argLists, in the order given """
+        if workerCount < 2 or len(argLists) < 2:
+            return [method(*args) for args in argLists]
+        executor = cls.getExecutor(workerCount, useProcesses)
+        futures = [executor.submit(method, *args) for args in argLists]
+        return [future.result() for future in futures]
+
+
 class Observable:
     threadedNotificationHandler = ThreadedNotificationHandler()
     obsDiag = None
@@ -735,6 +768,15 @@ class TestState(Observable):
         self.executionHosts = executionHosts
         self.lifecycleChange = lifecycleChange
 
+    def __setstate__(self, state):
+        # Each unpickled state would otherwise have its own copy of these, and there can be many thousands of states
+        for var in ["category", "briefText", "lifecycleChange"]:
+            if isinstance(state.get(var), str):
+                state[var] = sys.intern(state[var])
+        if "executionHosts" in state:
+            state["executionHosts"] = [sys.intern(host) for host in state["executionHosts"]]
+        self.__dict__.update(state)
+
     def __str__(self):
         return self.freeText
 
@@ -1551,6 +1593,8 @@ class MultilineTextTrigger(TextTrigger):
 # Used for application and personal configuration files
 class MultiEntryDictionary(OrderedDict):
     warnings = []
+    # Contents of files read in advance by other threads, see testmodel.TestTreePrefetcher
+    prefetchedLines = {}
 
     def __init__(self, importKey="", importFileFinder=None, aliases={}, allowSectionHeaders=True, fileTrackSections={}, *args, **kw):
         OrderedDict.__init__(self, *args, **kw)
@@ -1591,7 +1635,7 @@ class MultiEntryDictionary(OrderedDict):
     def readFromFile(self, filename, *args, **kwargs):
         self.diag.info("Reading file " + filename)
         currSectionName = ""
-        for line in readList(filename):
+        for line in self.readLines(filename):
             if self.allowSectionHeaders and self.isSectionHeader(line):
                 currSectionName = self.getNewSectionInfo(line, *args, **kwargs)
             elif ":" in line:
@@ -1599,6 +1643,10 @@ class MultiEntryDictionary(OrderedDict):
             else:
                 self.warn("Could not parse config line " + line)
 
+    def readLines(self, filename):
+        lines = self.prefetchedLines.pop(filename, None)
+        return readList(filename) if lines is None else lines
+
     def isSectionHeader(self, line):
         return line.startswith("[") and line.endswith("]")
 
@@ -25,6 +25,17 @@ class QueueSystemConfig(default.Config):
     def __init__(self, *args):
         default.Config.__init__(self, *args)
         self.useQueueSystem = False
+        if self.slaveRun():
+            self.findArrayTaskTest()
+
+    def findArrayTaskTest(self):
+        # Slaves submitted as part of a job array read which test to run from the file the master wrote
+        taskFile = os.environ.pop("TEXTTEST_SLAVE_TASK_FILE", None)
+        taskIdVariable = os.environ.pop("TEXTTEST_SLAVE_TASK_ID_VARIABLE", None)
+        if taskFile and taskIdVariable:
+            taskId = int(os.getenv(taskIdVariable))
+            with open(taskFile) as f:
+                self.optionMap["tp"] = f.read().splitlines()[taskId - 1]
 
     def getRunningGroupNames(self, app):
         groups = default.Config.getRunningGroupNames(self, app)
@@ -389,7 +400,9 @@ class QueueSystemConfig(default.Config):
         app.setConfigDefault("queue_system_environment", [
         ], "Environment variables (external to TextTest) whose values need to be transferred to the execution machine")
         app.setConfigDefault("queue_system_processes", 1,
-                             "Number of processes the grid engine should reserve for tests")
+                             "Number of processes the grid engine should reserve for tests (cores, for the local queue system)")
+        app.setConfigDefault("queue_system_memory", 0,
+                             "(local) Memory in MB to reserve for tests. 0 means use approved memory or the most recorded in the runtime history, if any")
         app.setConfigDefault("queue_system_submit_args", "",
                              "Additional arguments to provide to grid engine submission command")
         app.setConfigDefault("queue_system_proxy_executable", "",
@@ -398,6 +411,18 @@ class QueueSystemConfig(default.Config):
                              "Grid engine resources required to locate machine to run proxy process")
         app.setConfigDefault("queue_system_core_file_location", "",
                              "System-wide location for core files from grid jobs, in case TEXTTEST_TMP is generated")
+        app.setConfigDefault("queue_system_test_order", "tree",
+                             "Order to submit tests in: 'tree' (test suite order), 'longest_first' (by expected runtime from performance files or runtime history) or 'deadline' (longest first while 'queue_system_deadline' can be met, then shortest first)")
+        app.setConfigDefault("queue_system_deadline", 0,
+                             "Number of (wall clock) seconds after starting within which tests should complete, for 'deadline' test order")
+        app.setConfigDefault("queue_system_array_size", 0,
+                             "(SGE, LSF) Maximum number of tests to submit together as one array job. 0 submits each test separately")
+        app.setConfigDefault("queue_system_fork_server", 1,
+                             "(local) Start slaves by forking a process that has already imported TextTest and read the configuration, instead of starting Python afresh for each one")
+        app.setConfigDefault("remote_sandbox_compression", "gz",
+                             "Compression for sandboxes sent from remote slaves to the master: 'gz', 'bz2', 'xz', or 'none' (or empty) for none")
+        app.setConfigDefault("queue_system_slave_protocol", "framed",
+                             "How slaves report to the master: 'framed' (one connection per slave), 'compressed' (framed, compressing large messages) or 'classic' (one connection per message)")
         app.addConfigEntry("builtin", "proxy_options", "definition_file_stems")
 
     def setDependentConfigDefaults(self, app):
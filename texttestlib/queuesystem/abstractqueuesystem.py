@@ -1,7 +1,7 @@
 
 """ Base class for all the queue system implementations """
 
-import subprocess, os, sys
+import subprocess, os, sys, time
 from locale import getpreferredencoding
 from texttestlib import plugins
 
@@ -31,6 +31,15 @@ class QueueSystem(object):
     def supportsPolling(self):
         return True
 
+    def supportsArrayJobs(self):
+        # Those that do should provide getArraySubmitCmdArgs, getArrayTaskJobId and arrayTaskIdVariable
+        return False
+
+    def waitForJobChanges(self, timeout):
+        # Queue systems that get told when jobs finish can return True as soon as one does
+        time.sleep(timeout)
+        return False
+
     def findErrorMessage(self, stderr, *args):
         if len(stderr) > 0:
             basicError = self.findSubmitError(stderr)
@@ -58,6 +67,9 @@ class QueueSystem(object):
     def getCapacity(self):
         pass  # treated as no restriction
 
+    def getResourceLimits(self):
+        pass  # cores and memory available for slaves, if the queue system doesn't manage them itself
+
     def setRemoteProcessId(self, *args):
         pass  # only cloud cares about this
 
@@ -416,6 +416,9 @@ class QueueSystem(local.QueueSystem):
     def getCapacity(self):
         return self.capacity
 
+    def getResourceLimits(self):
+        pass  # spread over several machines, which take one test per core
+
     def slavesOnRemoteSystem(self):
         return True
 
@@ -0,0 +1,474 @@
+
+""" Starts local slaves by forking a process that has already imported TextTest and read its configuration """
+
+import os
+import sys
+import json
+import signal
+import select
+import logging
+import selectors
+import tempfile
+import traceback
+import subprocess
+from queue import Queue
+from datetime import datetime
+from threading import Condition, Lock, Thread, active_count
+from texttestlib import plugins
+
+
+class ForkedProcess:
+    # Enough like subprocess.Popen for the local queue system. Not our child, so we can't wait for it:
+    # the fork server reaps it and tells us how it exited
+    exitCodeTimeout = 5.0
+    unknownReturnCode = 1  # if the fork server has gone away, we can't know, but shouldn't claim success
+
+    def __init__(self, pid, server):
+        self.pid = pid
+        self.server = server
+        self.returncode = None
+        try:
+            self.exitFd = os.pidfd_open(pid)
+        except (AttributeError, OSError):
+            self.exitFd = None
+
+    def poll(self):
+        if self.returncode is None and self.hasExited():
+            returncode = self.server.getExitCode(self.pid, self.exitCodeTimeout)
+            self.returncode = returncode if returncode is not None else self.unknownReturnCode
+            if self.exitFd is not None:
+                os.close(self.exitFd)
+                self.exitFd = None
+        return self.returncode
+
+    def hasExited(self):
+        if self.exitFd is not None:
+            # Not select(), the master can have more files open than it can handle
+            poller = select.poll()
+            poller.register(self.exitFd, select.POLLIN)
+            return len(poller.poll(0)) > 0
+        try:
+            os.kill(self.pid, 0)
+            return False
+        except ProcessLookupError:
+            return True
+
+    def send_signal(self, sig):
+        if self.poll() is None:
+            os.kill(self.pid, sig)
+
+
+class ForkServer:
+    def __init__(self):
+        self.diag = logging.getLogger("Fork Server")
+        # What we fork runs this program, so slaves must be started with it
+        self.program = os.path.realpath(sys.argv[0])
+        env = os.environ.copy()
+        packageDir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        env["PYTHONPATH"] = os.pathsep.join(filter(None, [packageDir, env.get("PYTHONPATH")]))
+        serverCode = "from texttestlib.queuesystem.forkserver import serve; serve()"
+        self.process = subprocess.Popen([sys.executable, "-c", serverCode], stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE, env=env, encoding="utf-8")
+        self.diag.info("Started fork server with process ID " + str(self.process.pid))
+        self.requestLock = Lock()
+        self.replies = Queue()
+        self.exitCodes = {}
+        self.exitCondition = Condition()
+        self.serverGone = False
+        # Exit reports arrive whenever slaves exit, mixed in with the replies to our requests
+        self.readerThread = Thread(target=self.readMessages, daemon=True)
+        self.readerThread.start()
+
+    def readMessages(self):
+        for line in self.process.stdout:
+            message = json.loads(line)
+            with self.exitCondition:
+                if "exited" in message:
+                    self.exitCodes[message["exited"]] = message["returncode"]
+                    self.exitCondition.notify_all()
+                    continue
+                elif "pid" in message:
+                    # Always sent before the new process's exit report, so anything here is for an old process with the same ID
+                    self.exitCodes.pop(message["pid"], None)
+            self.replies.put(message)
+        with self.exitCondition:
+            self.serverGone = True
+            self.exitCondition.notify_all()
+        self.replies.put(None)
+
+    def getExitCode(self, pid, timeout):
+        # The process has exited, but the server may not have reaped it and told us yet. None if we can't find out
+        with self.exitCondition:
+            self.exitCondition.wait_for(lambda: pid in self.exitCodes or self.serverGone, timeout)
+            return self.exitCodes.pop(pid, None)
+
+    def canStart(self, cmdArgs, env):
+        # Wrappers and CaptureMock need a real process start
+        if os.path.realpath(cmdArgs[0]) != self.program:
+            self.diag.info("Starting slave normally, it runs " + cmdArgs[0] + " rather than " + self.program)
+            return False
+        captureMockVars = [var for var in env if var.startswith("CAPTUREMOCK")]
+        if captureMockVars:
+            self.diag.info("Starting slave normally, CaptureMock is enabled with " + ", ".join(captureMockVars))
+            return False
+        return True
+
+    def startSlave(self, cmdArgs, env, cwd, stdoutFile, stderrFile):
+        # Returns None if the server can't do it, so the caller can start the process normally
+        if not self.canStart(cmdArgs, env):
+            return
+        request = {"args": cmdArgs, "env": env, "cwd": cwd, "stdout": stdoutFile, "stderr": stderrFile}
+        with self.requestLock:
+            reply = None
+            if not self.serverGone:
+                try:
+                    self.process.stdin.write(json.dumps(request) + "\n")
+                    self.process.stdin.flush()
+                    reply = self.replies.get()
+                except (OSError, ValueError):
+                    pass
+        if not reply:
+            self.diag.info("Fork server has gone away")
+            return
+        if "pid" in reply:
+            self.diag.info("Forked slave with process ID " + str(reply["pid"]))
+            return ForkedProcess(reply["pid"], self)
+        else:
+            self.diag.info("Fork server failed to start slave : " + reply.get("error", ""))
+
+    def stop(self):
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        self.process.wait()
+
+
+def getReturnCode(status):
+    # As subprocess would report it
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    else:
+        return os.WEXITSTATUS(status)
+
+
+class MessageReader:
+    def __init__(self, fd):
+        self.fd = fd
+        self.data = b""
+
+    def read(self):
+        # All complete messages received so far, or None if the other end has closed
+        data = os.read(self.fd, 65536)
+        if not data:
+            return
+        lines = (self.data + data).split(b"\n")
+        self.data = lines.pop()
+        return [json.loads(line.decode("utf-8")) for line in lines]
+
+
+class SlaveStarter:
+    # Forks slaves on request, and reports how they exit.
+    # Children exiting wake up the select below, so their exits are reported between replies rather than in them
+    def __init__(self, inputFd, output):
+        self.requests = MessageReader(inputFd)
+        self.output = output
+        self.ignoredPids = set()
+        self.stopped = False
+        self.wakeupFds = os.pipe()
+        for fd in self.wakeupFds:
+            os.set_blocking(fd, False)
+        signal.set_wakeup_fd(self.wakeupFds[1])
+        signal.signal(signal.SIGCHLD, lambda *args: None)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(inputFd, selectors.EVENT_READ, self.readRequests)
+        self.selector.register(self.wakeupFds[0], selectors.EVENT_READ, self.reportExits)
+
+    def serve(self):
+        while not self.stopped:
+            for key, _ in self.selector.select():
+                if self.selector.get_map().get(key.fd) is key:  # not closed while handling an earlier one
+                    key.data()
+
+    def readRequests(self):
+        requests = self.requests.read()
+        if requests is None:
+            self.stopped = True
+        else:
+            for request in requests:
+                self.startSlave(request)
+
+    def reportExits(self):
+        try:
+            while os.read(self.wakeupFds[0], 4096):
+                pass
+        except BlockingIOError:
+            pass
+        try:
+            while True:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+                if pid == 0:
+                    break
+                if pid in self.ignoredPids:
+                    self.ignoredPids.remove(pid)
+                else:
+                    self.sendMessage({"exited": pid, "returncode": getReturnCode(status)})
+        except ChildProcessError:
+            pass
+
+    def sendMessage(self, message):
+        self.output.write(json.dumps(message) + "\n")
+        self.output.flush()
+
+    def startSlave(self, request):
+        try:
+            pid = self.fork(runSlave, request)
+        except OSError as e:
+            self.sendMessage({"error": str(e)})
+        else:
+            self.sendMessage({"pid": pid})
+
+    def fork(self, method, *args):
+        pid = os.fork()
+        if pid == 0:
+            self.closeInChild()
+            runChild(method, *args)
+        return pid
+
+    def closeInChild(self):
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        for key in list(self.selector.get_map().values()):
+            if key.fd > 2:  # standard streams are redirected instead
+                os.close(key.fd)
+        self.selector.close()
+        os.close(self.wakeupFds[1])
+
+
+class ForkServerMain(SlaveStarter):
+    # Slaves with the same arguments apart from which test they run read the same configuration.
+    # So we start a template process for each such group, which reads it once and then forks those slaves
+    def __init__(self):
+        SlaveStarter.__init__(self, sys.stdin.fileno(), sys.stdout)
+        self.templates = {}
+
+    def startSlave(self, request):
+        template = self.findTemplate(request)
+        if template is None or not self.startFromTemplate(template, request):
+            SlaveStarter.startSlave(self, request)
+
+    def findTemplate(self, request):
+        key = getTemplateKey(request)
+        if key is None:
+            return
+        if key not in self.templates:
+            self.templates[key] = self.startTemplate(request)
+        return self.templates[key]
+
+    def startTemplate(self, request):
+        requestFds, replyFds = os.pipe(), os.pipe()
+        # Children leave by raising SystemExit through here, so no 'finally'
+        try:
+            pid = self.fork(runTemplate, request, requestFds, replyFds)
+        except OSError:
+            pid = None
+        os.close(requestFds[0])
+        os.close(replyFds[1])
+        template = SlaveTemplate(requestFds[1], replyFds[0])
+        if pid is not None:
+            self.ignoredPids.add(pid)
+            # Blocks until it has read everything, which the first slave would have had to wait for anyway
+            if self.waitForReply(template) == {"ready": True}:
+                self.selector.register(template.replies.fd, selectors.EVENT_READ,
+                                       plugins.Callable(self.readFromTemplate, template))
+                return template
+        template.close()
+
+    def startFromTemplate(self, template, request):
+        try:
+            os.write(template.requestFd, (json.dumps(request) + "\n").encode("utf-8"))
+            reply = self.waitForReply(template)
+        except OSError:
+            reply = None
+        if reply is None:
+            self.templateGone(template)
+            return False
+        return "pid" in reply  # if it couldn't fork, we do it ourselves
+
+    def waitForReply(self, template):
+        # Exit reports may arrive around the reply, and must be passed on in the same order.
+        # None if the template has gone away
+        reply = None
+        while reply is None:
+            messages = template.replies.read()
+            if messages is None:
+                return
+            for message in messages:
+                if "exited" in message or "pid" in message:
+                    self.sendMessage(message)
+                if "exited" not in message:
+                    reply = message
+        return reply
+
+    def readFromTemplate(self, template):
+        # Only exit reports arrive without a request
+        messages = template.replies.read()
+        if messages is None:
+            self.templateGone(template)
+        else:
+            for message in messages:
+                self.sendMessage(message)
+
+    def templateGone(self, template):
+        # Fork slaves ourselves from now on. Any it had still running are no longer our children, so we can't report them
+        for key, otherTemplate in list(self.templates.items()):
+            if otherTemplate is template:
+                self.templates[key] = None
+        self.selector.unregister(template.replies.fd)
+        template.close()
+
+    def closeInChild(self):
+        SlaveStarter.closeInChild(self)
+        for template in self.templates.values():
+            if template:
+                os.close(template.requestFd)  # reply fds were registered with the selector, so are already closed
+
+
+class SlaveTemplate:
+    def __init__(self, requestFd, replyFd):
+        self.requestFd = requestFd
+        self.replies = MessageReader(replyFd)
+
+    def close(self):
+        # The template exits when it sees its input close
+        os.close(self.requestFd)
+        os.close(self.replies.fd)
+
+
+class TemplateSlaveStarter(SlaveStarter):
+    def __init__(self, inputFd, output, program, allApps):
+        SlaveStarter.__init__(self, inputFd, output)
+        self.program = program
+        self.allApps = allApps
+
+    def startSlave(self, request):
+        try:
+            pid = self.fork(runPreparedSlave, self.program, self.allApps, request)
+        except OSError as e:
+            self.sendMessage({"error": str(e)})
+        else:
+            self.sendMessage({"pid": pid})
+
+    def closeInChild(self):
+        SlaveStarter.closeInChild(self)
+        self.output.close()
+
+
+def getTemplateKey(request):
+    # None if slaves with these arguments can't share a template.
+    # Diagnostics are written per slave, and set up while reading the configuration
+    args = request["args"]
+    if "-x" in args or "-tp" not in args[:-1]:
+        return
+    keyArgs = list(args)
+    keyArgs[keyArgs.index("-tp") + 1] = None
+    return json.dumps([keyArgs, request["cwd"], sorted(request["env"].items())])
+
+
+def getTestPath(args):
+    return args[args.index("-tp") + 1].strip()
+
+
+def serve():
+    # Everything a slave would import anyway, so each one saves the time
+    import texttestlib.engine
+    import texttestlib.queuesystem
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the master stops us by closing our input
+    ForkServerMain().serve()
+
+
+def runChild(method, *args):
+    # Never return into the loop of the process we were forked from, whatever happens
+    try:
+        method(*args)
+    except SystemExit:
+        raise
+    except BaseException:
+        traceback.print_exc()
+        sys.exit(1)
+    sys.exit(0)
+
+
+def setUpSlaveProcess(request):
+    os.chdir(request["cwd"])
+    os.environ.clear()
+    os.environ.update(request["env"])
+    sys.argv = request["args"]
+
+
+def redirect(fileName, targetFd, flags):
+    fd = os.open(fileName, flags, 0o666)
+    os.dup2(fd, targetFd)
+    os.close(fd)
+
+
+def redirectOutput(request):
+    redirect(os.devnull, 0, os.O_RDONLY)
+    redirect(request["stdout"], 1, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+    redirect(request["stderr"], 2, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+
+
+def runSlave(request):
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    setUpSlaveProcess(request)
+    redirectOutput(request)
+    from texttestlib.engine import TextTest
+    program = TextTest()
+    program.run()  # exits via SystemExit, leaving the interpreter to shut down as normal
+
+
+def runTemplate(request, requestFds, replyFds):
+    os.close(requestFds[1])
+    os.close(replyFds[0])
+    requestFd = requestFds[0]
+    output = os.fdopen(replyFds[1], "w", encoding="utf-8")
+    setUpSlaveProcess(request)
+    # Anything written while reading the configuration belongs in a slave's own output,
+    # so in that case leave the slaves to read it themselves
+    with tempfile.TemporaryFile() as loadOutput:
+        redirect(os.devnull, 0, os.O_RDONLY)
+        for fd in [1, 2]:
+            os.dup2(loadOutput.fileno(), fd)
+        from texttestlib.engine import TextTest
+        program = TextTest()
+        program.setSignalHandlers(signal.SIG_IGN)  # slaves set them back
+        raisedError, allApps = program.findApps()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        wroteOutput = os.fstat(loadOutput.fileno()).st_size > 0
+        for fd in [1, 2]:
+            redirect(os.devnull, fd, os.O_WRONLY)
+    # Forking once threads are running is not safe
+    if raisedError or wroteOutput or len(allApps) == 0 or program.inputOptions.helpMode() or active_count() > 1:
+        output.write(json.dumps({"ready": False}) + "\n")
+        output.flush()
+        return
+    for app in allApps:
+        for partApp in [app] + app.extras:
+            partApp.preloadTestTreeSnapshot()
+    starter = TemplateSlaveStarter(requestFd, output, program, allApps)
+    starter.sendMessage({"ready": True})
+    starter.serve()
+
+
+def runPreparedSlave(program, allApps, request):
+    redirectOutput(request)
+    sys.argv = request["args"]
+    program.inputOptions["tp"] = getTestPath(request["args"])
+    # Our own start, not the template's, which also names our write directories
+    plugins.globalStartTime = datetime.now()
+    for app in allApps:
+        for partApp in [app] + app.extras:
+            partApp.setUpWriteDirectories()
+    program.setSignalHandlers(program.handleSignalWhileStarting)
+    program.run(allApps)
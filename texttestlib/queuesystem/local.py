@@ -3,41 +3,96 @@
 
 import subprocess
 import os
+import sys
 import signal
+import selectors
 from . import abstractqueuesystem
+from .forkserver import ForkServer
 from multiprocessing import cpu_count
 from texttestlib import plugins
 
 
 class QueueSystem(abstractqueuesystem.QueueSystem):
-    def __init__(self, *args):
+    def __init__(self, configObj=None):
         self.processes = {}
+        # Lets us wait for slave processes to exit rather than polling them, where the OS supports it
+        self.exitSelector = selectors.DefaultSelector() if hasattr(os, "pidfd_open") else None
+        useForkServer = configObj is not None and hasattr(os, "fork") and not getattr(sys, "frozen", False) and \
+            configObj.getConfigValue("queue_system_fork_server")
+        # Start it now, so it has done its imports by the time the first slave is needed
+        self.forkServer = ForkServer() if useForkServer else None
 
     def submitSlaveJob(self, cmdArgs, slaveEnv, logDir, submissionRules, jobType):
         outputFile, errorsFile = submissionRules.getJobFiles()
+        env = self.getSlaveEnvironment(slaveEnv)
+        process = self.forkSlave(cmdArgs, env, logDir, outputFile, errorsFile)
+        errorMessage = None
+        if process is None:
+            process, errorMessage = self.startSlave(cmdArgs, env, logDir, outputFile, errorsFile)
+        if errorMessage:
+            return None, self.getFullSubmitError(errorMessage, cmdArgs, jobType)
+        else:
+            jobId = str(process.pid)
+            self.processes[jobId] = process
+            self.watchForExit(process)
+            return jobId, None
+
+    def startSlave(self, cmdArgs, env, logDir, outputFile, errorsFile):
         stdout = open(os.path.join(logDir, outputFile), "w")
         stderr = open(os.path.join(logDir, errorsFile), "w")
         createflags = subprocess.CREATE_NEW_PROCESS_GROUP if os.name == "nt" else 0
         try:
             process = subprocess.Popen(cmdArgs, stdout=stdout, stderr=stderr,
-                                       cwd=logDir, env=self.getSlaveEnvironment(slaveEnv),
+                                       cwd=logDir, env=env,
                                        startupinfo=plugins.getHideStartUpInfo(),
                                        creationflags=createflags)
-            errorMessage = None
+            return process, None
         except OSError as e:
             stdout.close()
             stderr.close()
-            errorMessage = "Failed to start slave process : " + str(e)
-        if errorMessage:
-            return None, self.getFullSubmitError(errorMessage, cmdArgs, jobType)
-        else:
-            jobId = str(process.pid)
-            self.processes[jobId] = process
-            return jobId, None
+            return None, "Failed to start slave process : " + str(e)
+
+    def forkSlave(self, cmdArgs, env, logDir, outputFile, errorsFile):
+        if self.forkServer:
+            return self.forkServer.startSlave(cmdArgs, env, logDir, os.path.join(logDir, outputFile),
+                                              os.path.join(logDir, errorsFile))
+
+    def cleanup(self, final=False):
+        if final and self.forkServer:
+            self.forkServer.stop()
+            self.forkServer = None
+        return True
+
+    def watchForExit(self, process):
+        if self.exitSelector:
+            try:
+                exitFd = os.pidfd_open(process.pid)
+            except OSError:
+                return  # not supported by the kernel, polling will find it
+            self.exitSelector.register(exitFd, selectors.EVENT_READ)
+
+    def waitForJobChanges(self, timeout):
+        if not self.exitSelector or not self.exitSelector.get_map():
+            return abstractqueuesystem.QueueSystem.waitForJobChanges(self, timeout)
+        events = self.exitSelector.select(timeout)
+        for key, _ in events:
+            self.exitSelector.unregister(key.fd)
+            os.close(key.fd)
+        return len(events) > 0
 
     def getCapacity(self):
         return cpu_count()
 
+    def getResourceLimits(self):
+        return cpu_count(), self.getPhysicalMemory()
+
+    def getPhysicalMemory(self):
+        # In MB, or None if we can't tell
+        try:
+            return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+        except (AttributeError, ValueError, OSError):
+            pass
+
     def formatCommand(self, cmdArgs):
         return " ".join(cmdArgs)
 
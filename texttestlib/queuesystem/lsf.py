@@ -7,6 +7,7 @@ from . import gridqueuesystem
 
 class QueueSystem(gridqueuesystem.QueueSystem):
     submitProg = "bsub"
+    arrayTaskIdVariable = "LSB_JOBINDEX"
     def getSubmitCmdArgs(self, submissionRules, commandArgs=[], slaveEnv={}):
         bsubArgs = ["bsub", "-J", submissionRules.getJobName()]
         if submissionRules.processesNeeded != 1:
@@ -23,6 +24,17 @@ class QueueSystem(gridqueuesystem.QueueSystem):
         bsubArgs += ["-u", "nobody", "-o", os.devnull, "-e", os.devnull]
         return self.addExtraAndCommand(bsubArgs, submissionRules, commandArgs)
 
+    def supportsArrayJobs(self):
+        return True
+
+    def getArraySubmitCmdArgs(self, submissionRules, taskCount, commandArgs, slaveEnv):
+        bsubArgs = self.getSubmitCmdArgs(submissionRules, commandArgs, slaveEnv)
+        bsubArgs[2] += "[1-" + str(taskCount) + "]"
+        return bsubArgs
+
+    def getArrayTaskJobId(self, jobId, taskIndex):
+        return jobId + "[" + str(taskIndex) + "]"
+
     def getSlaveVarsToBlock(self):
         """Make sure we clear out the master scripts so the slave doesn't use them too,
         otherwise just use the environment as is.
@@ -52,7 +64,7 @@ class QueueSystem(gridqueuesystem.QueueSystem):
         return 1
 
     def _getJobFailureInfo(self, jobId):
-        resultOutput = os.popen("bjobs -a -l " + jobId + " 2>&1").read()
+        resultOutput = os.popen("bjobs -a -l '" + jobId + "' 2>&1").read()
         if resultOutput.find("is not found") != -1:
             return "LSF lost job:" + jobId
         else:
@@ -63,7 +75,7 @@ class QueueSystem(gridqueuesystem.QueueSystem):
         return False
 
     def killJob(self, jobId):
-        resultOutput = os.popen("bkill -s USR1 " + jobId + " 2>&1").read()
+        resultOutput = os.popen("bkill -s USR1 '" + jobId + "' 2>&1").read()
         return resultOutput.find("is being terminated") != -1 or resultOutput.find("is being signaled") != -1
 
     def getJobId(self, line):
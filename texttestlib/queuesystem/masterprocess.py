@@ -8,16 +8,19 @@ import socket
 import signal
 import logging
 import time
+import selectors
 from .utils import *
 from queue import Queue
+from bisect import insort
+from itertools import count
 from socketserver import ThreadingTCPServer, StreamRequestHandler
-from threading import RLock, Lock
-from collections import OrderedDict
+from threading import RLock, Lock, Condition
+from collections import OrderedDict, deque
 from texttestlib import plugins
 from texttestlib.default.console import TextDisplayResponder, InteractiveResponder
 from texttestlib.default.knownbugs import CheckForBugs
 from texttestlib.default.actionrunner import BaseActionRunner
-from texttestlib.default.performance import getTestPerformance
+from texttestlib.default.performance import getTestPerformance, getExpectedRuntime, getExpectedMemory
 from glob import glob
 from locale import getpreferredencoding
 
@@ -44,6 +47,135 @@ class Pending(plugins.TestState):
             return self.__class__(newFreeText, newRunStatus, lifecycleChange)
 
 
+class RuntimeOrderedQueue(Queue):
+    """Test queue handing out the tests with the longest expected runtime first.
+    Status messages stay in front of all tests and terminators stay behind them.
+    With a deadline, switches to shortest-first once the remaining work no longer fits,
+    so that as many tests as possible complete in time."""
+    def __init__(self, runtimeGetter, capacity, deadline=None):
+        self.runtimeGetter = runtimeGetter
+        self.capacity = max(capacity, 1)
+        self.deadline = deadline
+        self.diag = logging.getLogger("Queue System Order")
+        Queue.__init__(self)
+
+    def _init(self, maxsize):
+        self.messages = deque()
+        self.tests = []  # sorted list of (sortKey, sequence number, runtime, test)
+        self.terminators = 0
+        self.sequence = count()
+        self.remainingRuntime = 0.0
+
+    def _qsize(self):
+        return len(self.messages) + len(self.tests) + self.terminators
+
+    def _put(self, item):
+        if item is None:
+            self.terminators += 1
+        elif isinstance(item, str):
+            self.messages.append(item)
+        else:
+            runtime = self.runtimeGetter(item)
+            # Tests we know nothing about go first, in case they turn out to be long
+            sortKey = -runtime if runtime >= 0 else float("-inf")
+            self.diag.info("Expected runtime for " + item.uniqueName + " is " + repr(runtime))
+            self.remainingRuntime += max(runtime, 0)
+            insort(self.tests, (sortKey, next(self.sequence), runtime, item))
+
+    def _get(self):
+        if self.messages:
+            return self.messages.popleft()
+        elif self.tests:
+            return self.popTest(0 if self.orderLongestFirst() else -1)
+        else:
+            self.terminators -= 1
+
+    def popTest(self, index):
+        _, _, runtime, test = self.tests.pop(index)
+        self.remainingRuntime -= max(runtime, 0)
+        return test
+
+    def orderLongestFirst(self):
+        if self.deadline is None:
+            return True
+        projectedEnd = time.time() + self.remainingRuntime / self.capacity
+        if projectedEnd > self.deadline:
+            self.diag.info("Projected end " + repr(projectedEnd) + " is after deadline, running shortest tests first")
+            return False
+        return True
+
+    def getFirstMatching(self, predicate):
+        # Tests only: messages and terminators are left for the submission loop
+        with self.mutex:
+            indices = range(len(self.tests))
+            if not self.orderLongestFirst():
+                indices = reversed(indices)
+            for index in indices:
+                if predicate(self.tests[index][-1]):
+                    return self.popTest(index)
+
+
+class ResourcePool:
+    # Cores and memory (in MB) of a machine that runs slaves itself, so tests using several
+    # processes or a lot of memory don't overload it
+    def __init__(self, cores, memory):
+        self.cores = cores
+        self.memory = memory
+        self.reservations = OrderedDict()
+        self.condition = Condition()
+        self.diag = logging.getLogger("Resource Pool")
+
+    def limitNeeds(self, cores, memory):
+        # A test that needs more than the whole machine gets all of it
+        memory = max(memory, 0)
+        if self.memory is not None:
+            memory = min(memory, self.memory)
+        return min(max(cores, 1), self.cores), memory
+
+    def getFree(self):
+        freeCores, freeMemory = self.cores, self.memory
+        for cores, memory in self.reservations.values():
+            freeCores -= cores
+            if freeMemory is not None:
+                freeMemory -= memory
+        return freeCores, freeMemory
+
+    def fits(self, needs):
+        with self.condition:
+            if not self.reservations:
+                return True
+            freeCores, freeMemory = self.getFree()
+            cores, memory = needs
+            return cores <= freeCores and (freeMemory is None or memory <= freeMemory)
+
+    def reserve(self, test, needs, shouldStop):
+        # Waits until enough of what's running has finished
+        with self.condition:
+            while not self.fits(needs) and not shouldStop():
+                self.diag.info("Waiting for " + repr(needs) + " to be free for " + test.uniqueName +
+                               ", free now " + repr(self.getFree()))
+                self.condition.wait(1)
+            self.reservations[test] = needs
+            self.diag.info("Reserved " + repr(needs) + " for " + test.uniqueName + ", free now " + repr(self.getFree()))
+
+    def covers(self, test, needs):
+        # Whether the slave that ran the test has enough reserved to run something else
+        with self.condition:
+            cores, memory = self.reservations.get(test, needs)
+            return needs[0] <= cores and needs[1] <= memory
+
+    def transfer(self, oldTest, newTest):
+        with self.condition:
+            if oldTest in self.reservations:
+                self.reservations[newTest] = self.reservations.pop(oldTest)
+
+    def release(self, test):
+        with self.condition:
+            if self.reservations.pop(test, None):
+                self.diag.info("Released resources for " + test.uniqueName + ", free now " + repr(self.getFree()))
+                self.condition.notify_all()
+
+
 class QueueSystemServer(BaseActionRunner):
     instance = None
 
@@ -57,6 +189,8 @@ class QueueSystemServer(BaseActionRunner):
         self.maxCapacity = 100000  # infinity, sort of
         self.allApps = allApps
         self.jobs = OrderedDict()
+        self.jobTests = {}
+        self.jobStatuses = {}
         self.submissionRules = {}
         self.killedJobs = {}
         self.queueSystems = {}
@@ -93,11 +227,56 @@ class QueueSystemServer(BaseActionRunner):
                 "something is uninstalled or unavailable. Exiting.")
 
         self.maxCapacity = min((c for c in appCapacities if c != 0))
+        self.resourcePool = self.makeResourcePool(allApps)
         capacityPerSuite = self.maxCapacity / len(allApps)
         for app in allApps:
             self.remainingForApp[app.name] = capacityPerSuite
+        self.testQueue = self.makeTestQueue(allApps[0])
         QueueSystemServer.instance = self
 
+    def makeTestQueue(self, app):
+        testOrder = app.getConfigValue("queue_system_test_order")
+        if testOrder == "tree":
+            return Queue()
+        deadline = None
+        if testOrder == "deadline":
+            seconds = app.getConfigValue("queue_system_deadline")
+            if seconds > 0:
+                deadline = time.time() + seconds
+        elif testOrder != "longest_first":
+            raise plugins.TextTestError("Unknown value '" + testOrder + "' for 'queue_system_test_order', " +
+                                        "expected 'tree', 'longest_first' or 'deadline'")
+        return RuntimeOrderedQueue(self.getExpectedRuntime, self.maxCapacity, deadline)
+
+    def getExpectedRuntime(self, test):
+        # Negative if unknown
+        return getExpectedRuntime(test)
+
+    def makeResourcePool(self, allApps):
+        # Grid engines place jobs according to what they request themselves
+        limits = set((self.getQueueSystem(app).getResourceLimits() for app in allApps))
+        if len(limits) == 1 and None not in limits:
+            cores, memory = limits.pop()
+            # Anyone who has raised queue_system_max_capacity wants that many tests at once
+            return ResourcePool(max(cores, self.maxCapacity), memory)
+
+    def getResourceNeeds(self, test):
+        memory = test.getConfigValue("queue_system_memory") or getExpectedMemory(test)
+        return self.resourcePool.limitNeeds(self.getSubmissionRules(test).processesNeeded, memory)
+
+    def reserveResources(self, test):
+        if self.resourcePool:
+            self.resourcePool.reserve(test, self.getResourceNeeds(test), lambda: self.exited)
+
+    def releaseResources(self, test):
+        if self.resourcePool:
+            self.resourcePool.release(test)
+
+    def getTestThatFits(self):
+        # Pack the free cores and memory with the longest test that fits in them, if any
+        if self.resourcePool and isinstance(self.testQueue, RuntimeOrderedQueue):
+            return self.testQueue.getFirstMatching(lambda t: self.resourcePool.fits(self.getResourceNeeds(t)))
+
     def addSuites(self, suites):
         for suite in suites:
             self.slaveLogDirs.add(suite.app.makeWriteDirectory("slavelogs"))
@@ -163,12 +342,14 @@ class QueueSystemServer(BaseActionRunner):
         attempts = int(float(os.getenv("TEXTTEST_QS_POLL_WAIT", "5")) / interval) # Amount of time to wait before initiating polling of grid/cloud
         subsequentAttempts = int(float(os.getenv("TEXTTEST_QS_POLL_SUBSEQUENT_WAIT", "15")) / interval) # Amount of time to wait before subsequent polling of grid/cloud
         if attempts >= 0:
+            queueSystem = self.getQueueSystem(list(self.jobs.keys())[0])
             while True:
                 for _ in range(attempts):
-                    time.sleep(interval)
+                    # Returns early if the queue system can tell us that jobs have finished
+                    jobsChanged = queueSystem.waitForJobChanges(interval)
                     if self.allComplete:
                         return
-                    if self.exited:
+                    if self.exited or jobsChanged:
                         break
                 if not self.exited:
                     self.updateJobStatus()
@@ -187,17 +368,36 @@ class QueueSystemServer(BaseActionRunner):
         statusInfo = queueSystem.getStatusForAllJobs()
         self.diag.info("Got status for all jobs : " + repr(statusInfo))
         if statusInfo is not None:  # queue system not available for some reason
-            for test, jobs in list(self.jobs.items()):
-                if not test.state.isComplete():
-                    for jobId, jobName in jobs:
-                        status = statusInfo.get(jobId)
+            for jobId in self.findChangedJobs(statusInfo):
+                status = statusInfo.get(jobId)
+                for test, jobName in self.jobTests.get(jobId, []):
+                    if not test.state.isComplete() and (jobId, jobName) in self.getJobInfo(test):
                         if status:
                             # Only do this to test jobs (might make a difference for derived configurations)
                             # Ignore filtering states for now, which have empty 'briefText'.
                             self.updateRunStatus(test, status)
-                        elif not status and not self.jobCompleted(test, jobName):
+                        elif not self.jobCompleted(test, jobName):
                             # Do this to any jobs
                             self.setSlaveFailed(test, self.jobStarted(test, jobName), True, jobId)
+                if not status:
+                    # Job has gone, nothing more can happen to it
+                    self.jobTests.pop(jobId, None)
+                    self.jobStatuses.pop(jobId, None)
+
+    def findChangedJobs(self, statusInfo):
+        changedJobs = []
+        for jobId in list(self.jobTests.keys()):
+            status = statusInfo.get(jobId)
+            if jobId not in self.jobStatuses or status != self.jobStatuses[jobId]:
+                self.jobStatuses[jobId] = status
+                changedJobs.append(jobId)
+        self.diag.info("Jobs with changed status : " + repr(changedJobs))
+        return changedJobs
+
+    def addJobTest(self, test, jobId, jobName):
+        self.jobTests.setdefault(jobId, []).append((test, jobName))
+        # Make sure the new test hears about the job's status
+        self.jobStatuses.pop(jobId, None)
 
     def updateRunStatus(self, test, status):
         newRunStatus, newExplanation = status
@@ -226,6 +426,10 @@ class QueueSystemServer(BaseActionRunner):
 
     def markTestReuse(self, test, newTest):
         self.jobs[newTest] = self.getJobInfo(test)
+        if self.resourcePool:
+            self.resourcePool.transfer(test, newTest)
+        for jobId, jobName in self.jobs[newTest]:
+            self.addJobTest(newTest, jobId, jobName)
         with self.counterLock:
             if self.testCount > 1:
                 self.testCount -= 1
@@ -246,8 +450,12 @@ class QueueSystemServer(BaseActionRunner):
                     self.markTestReuse(test, newTest)
                     return newTest
             else:
-                # Don't allow this to use up the terminator
-                newTest = self.getTest(block=False, replaceTerminators=True)
+                if tryReuse and isinstance(self.testQueue, RuntimeOrderedQueue):
+                    # Take the longest remaining test this slave can run, leave the others for new submissions
+                    newTest = self.testQueue.getFirstMatching(lambda t: self.allowReuse(test, state, t))
+                else:
+                    # Don't allow this to use up the terminator
+                    newTest = self.getTest(block=False, replaceTerminators=True)
                 if newTest:
                     if tryReuse and self.allowReuse(test, state, newTest):
                         if not doneRerun:
@@ -255,6 +463,8 @@ class QueueSystemServer(BaseActionRunner):
                         self.markTestReuse(test, newTest)
                         return newTest
                     else:
+                        # Free this slave's resources first, so the new test can use them
+                        self.releaseResources(test)
                         self.diag.info("Adding to reuse failure queue : " + newTest.uniqueName)
                         self.reuseFailureQueue.put(newTest)
                 else:
@@ -262,6 +472,7 @@ class QueueSystemServer(BaseActionRunner):
                 self.reusedTests[test] = None
 
         # Allowed a submitted job to terminate
+        self.releaseResources(test)
         with self.counterLock:
             self.testsSubmitted -= 1
             self.diag.info("No reuse for " + test.uniqueName + " : " +
@@ -284,6 +495,9 @@ class QueueSystemServer(BaseActionRunner):
                 oldTest.getConfigValue("virtual_display_count") != newTest.getConfigValue("virtual_display_count"):
             return False
 
+        if self.resourcePool and not self.resourcePool.covers(oldTest, self.getResourceNeeds(newTest)):
+            return False
+
         oldRules = self.getSubmissionRules(oldTest)
         newRules = self.getSubmissionRules(newTest)
         return oldRules.allowsReuse(newRules)
@@ -309,7 +523,7 @@ class QueueSystemServer(BaseActionRunner):
             return
         if type(testOrStatus) == str:
             self.sendServerState(testOrStatus)
-            return self.getTest(block)
+            return self.getTest(block, replaceTerminators)
         else:
             return testOrStatus
 
@@ -332,7 +546,7 @@ class QueueSystemServer(BaseActionRunner):
             return reuseFailure
         else:
             self.diag.info("Waiting for new tests...")
-            newTest = self.getTest(block=block)
+            newTest = self.getTestThatFits() or self.getTest(block=block)
             if newTest:
                 return newTest
             else:
@@ -401,12 +615,18 @@ class QueueSystemServer(BaseActionRunner):
 
     def runTest(self, test):
         submissionRules = self.getSubmissionRules(test)
+        arrayTests = self.findArrayTests(test, submissionRules)
+        if arrayTests:
+            return self.runArray([test] + arrayTests, submissionRules)
+
         commandArgs = self.getSlaveCommandArgs(test, submissionRules)
+        self.reserveResources(test)
         plugins.log.info("Q: Submitting " + repr(test) + submissionRules.getSubmitSuffix())
         sys.stdout.flush()
         self.jobs[test] = []  # Preliminary jobs aren't interesting any more
         slaveEnv = OrderedDict()
         if not self.submitJob(test, submissionRules, commandArgs, slaveEnv):
+            self.releaseResources(test)
             return
 
         with self.counterLock:
@@ -418,6 +638,83 @@ class QueueSystemServer(BaseActionRunner):
         if self.testsSubmitted == self.maxCapacity:
             self.sendServerState("Completed submission of tests up to capacity")
 
+    def runArray(self, tests, submissionRules):
+        commandArgs = self.getSlaveCommandArgs(tests[0], submissionRules)
+        # Each task finds its test in the task file, make sure it can't run the first one by mistake
+        commandArgs[commandArgs.index("-tp") + 1] = "array_task"
+        plugins.log.info("Q: Submitting " + str(len(tests)) + " tests as a job array" + submissionRules.getSubmitSuffix())
+        for test in tests:
+            plugins.log.info("Q: Submitting " + repr(test) + " in job array")
+            self.jobs[test] = []
+        sys.stdout.flush()
+        if not self.submitArrayJob(tests, submissionRules, commandArgs):
+            return
+
+        with self.counterLock:
+            self.testCount -= len(tests)
+            self.testsSubmitted += len(tests)
+            self.diag.info("Array submission successful" + self.remainStr())
+        for test in tests:
+            if not test.state.hasStarted():
+                test.changeState(self.getPendingState(test))
+        if self.testsSubmitted == self.maxCapacity:
+            self.sendServerState("Completed submission of tests up to capacity")
+
+    def findArrayTests(self, test, submissionRules):
+        # Other tests that can be submitted along with this one as a single array job
+        maxArraySize = test.getConfigValue("queue_system_array_size")
+        queueSystem = self.getQueueSystem(test)
+        if maxArraySize < 2 or not queueSystem.supportsArrayJobs() or "xs" in self.optionMap or \
+                test.getConfigValue("queue_system_proxy_executable"):
+            return []
+
+        with self.counterLock:
+            taskLimit = min(maxArraySize, self.maxCapacity - self.testsSubmitted) - 1
+        arrayKey = self.getArrayKey(test, submissionRules)
+        def canJoinArray(otherTest):
+            return not otherTest.state.isComplete() and \
+                self.getArrayKey(otherTest, self.getSubmissionRules(otherTest)) == arrayKey
+
+        arrayTests = []
+        while len(arrayTests) < taskLimit and not self.exited:
+            newTest = self.getTestForArray(canJoinArray)
+            if newTest is None:
+                break
+            arrayTests.append(newTest)
+        self.diag.info("Found " + str(len(arrayTests)) + " tests to submit in an array with " + test.uniqueName)
+        return arrayTests
+
+    def getTestForArray(self, canJoinArray):
+        if isinstance(self.testQueue, RuntimeOrderedQueue):
+            return self.testQueue.getFirstMatching(canJoinArray)
+
+        # Don't allow this to use up the terminator
+        newTest = self.getTest(block=False, replaceTerminators=True)
+        if newTest and not canJoinArray(newTest):
+            # Submitted next in the normal way, so the tree order is kept
+            self.diag.info("Adding to reuse failure queue : " + newTest.uniqueName)
+            self.reuseFailureQueue.put(newTest)
+            return
+        return newTest
+
+    def getArrayKey(self, test, submissionRules):
+        # Tests can share an array if everything but the job name would be submitted the same way
+        jobName = submissionRules.getJobName()
+        submitArgs = [arg for arg in self.getSubmitCmdArgs(test, submissionRules) if arg != jobName]
+        slaveEnv = OrderedDict()
+        self.fixConfigEnv(slaveEnv, test)
+        self.fixProtocolVar(slaveEnv, test)
+        return test.app, tuple(submitArgs), tuple(slaveEnv.items())
+
+    def writeArrayTaskFile(self, tests, arrayName):
+        logDir = self.getSlaveLogDir(tests[0])
+        plugins.ensureDirectoryExists(logDir)
+        taskFile = os.path.join(logDir, arrayName + ".tasks")
+        with open(taskFile, "w") as f:
+            for test in tests:
+                f.write(test.getRelPath() + "\n")
+        return taskFile
+
     def fixConfigEnv(self, env, test):
         for envVar in test.getConfigValue("queue_system_environment"):
             val = os.getenv(envVar)
@@ -428,6 +725,11 @@ class QueueSystemServer(BaseActionRunner):
         if withProxy and test.getConfigValue("queue_system_proxy_executable"):
             env["TEXTTEST_SUBMIT_COMMAND_ARGS"] = "?"
 
+    def fixProtocolVar(self, env, test):
+        # Older slaves ignore this and use the classic protocol and text transfer of sandboxes,
+        # which the slave server still understands
+        env["TEXTTEST_SLAVE_PROTOCOL"] = test.getConfigValue("queue_system_slave_protocol")
+
     def getPendingState(self, test):
         return Pending(freeText="Job pending in " + queueSystemName(test.app))
 
@@ -523,6 +825,7 @@ class QueueSystemServer(BaseActionRunner):
         self.diag.info("Creating job at " + plugins.localtime())
         self.fixConfigEnv(slaveEnv, test)
         self.fixProxyVar(slaveEnv, test, withProxy)
+        self.fixProtocolVar(slaveEnv, test)
         queueSystem = self.getQueueSystem(test)
         queueSystem.prepareEnvForSubmit(slaveEnv)
         cmdArgs = self.getSubmitCmdArgs(test, submissionRules, commandArgs, slaveEnv)
@@ -546,6 +849,7 @@ class QueueSystemServer(BaseActionRunner):
                 if queueSystem.slavesOnRemoteSystem():
                     self.checkQueueCapacity(queueSystem)
                 self.jobs.setdefault(test, []).append((jobId, jobName))
+                self.addJobTest(test, jobId, jobName)
                 self.lockDiag.info("Releasing lock for submission...")
                 return True
             else:
@@ -554,6 +858,45 @@ class QueueSystemServer(BaseActionRunner):
                 self.handleErrorState(test)
                 return False
 
+    def submitArrayJob(self, tests, submissionRules, commandArgs):
+        test = tests[0]
+        queueSystem = self.getQueueSystem(test)
+        jobName = submissionRules.getJobName()
+        slaveEnv = OrderedDict()
+        self.fixConfigEnv(slaveEnv, test)
+        self.fixProtocolVar(slaveEnv, test)
+        slaveEnv["TEXTTEST_SLAVE_TASK_FILE"] = self.writeArrayTaskFile(tests, jobName)
+        slaveEnv["TEXTTEST_SLAVE_TASK_ID_VARIABLE"] = queueSystem.arrayTaskIdVariable
+        queueSystem.prepareEnvForSubmit(slaveEnv)
+        cmdArgs = queueSystem.getArraySubmitCmdArgs(submissionRules, len(tests), commandArgs, slaveEnv)
+        self.diag.info("Creating job array " + jobName + " with command arguments : " + " ".join(cmdArgs))
+        with self.lock:
+            if self.exited:
+                for test in tests:
+                    self.cancel(test)
+                plugins.log.info("Q: Submission cancelled for job array - exit underway")
+                return False
+
+            self.lockDiag.info("Got lock for array submission")
+            logDir = self.getSlaveLogDir(test)
+            jobId, errorMessage = queueSystem.submitSlaveJob(cmdArgs, slaveEnv, logDir, submissionRules, "job array")
+            if jobId is not None:
+                self.diag.info("Job array created with id " + jobId)
+                for taskIndex, test in enumerate(tests, start=1):
+                    taskJobId = queueSystem.getArrayTaskJobId(jobId, taskIndex)
+                    # The slave logs are named after the test it runs, not the array
+                    taskJobName = self.getSubmissionRules(test).getJobName()
+                    self.jobs.setdefault(test, []).append((taskJobId, taskJobName))
+                    self.addJobTest(test, taskJobId, taskJobName)
+                self.lockDiag.info("Releasing lock for array submission...")
+                return True
+            else:
+                self.diag.info("Job array not created : " + errorMessage)
+                for test in tests:
+                    test.changeState(plugins.Unrunnable(errorMessage, "NOT SUBMITTED"))
+                    self.handleErrorState(test)
+                return False
+
     def checkQueueCapacity(self, queueSystem):
         queueCapacity = queueSystem.getCapacity()
         if queueCapacity:
@@ -567,6 +910,7 @@ class QueueSystemServer(BaseActionRunner):
                 self.maxCapacity -= 1
             if previouslySubmitted:
                 self.testsSubmitted -= 1
+                self.releaseResources(test)
             else:
                 self.testCount -= 1
         self.diag.info(repr(test) + " in error state" + self.remainStr())
@@ -953,16 +1297,59 @@ class TestSubmissionRules(SubmissionRules):
 
 
 class SlaveRequestHandler(StreamRequestHandler):
+    framed = False
+
     def handle(self):
         identifier = str(self.rfile.readline().strip(), getpreferredencoding())
         if identifier == "TERMINATE_SERVER":
             return
 
+        compress = parseFramedHello(identifier)
+        if compress is None:
+            self.handleMessage(identifier)
+        else:
+            self.handleFramedMessages(compress)
+
+    def handleFramedMessages(self, compress):
+        # One connection for all messages from this slave. As it doesn't send anything until it gets
+        # our reply, nothing has been buffered in rfile and we can read the socket directly from now on
+        self.framed = True
+        self.wfile.write(makeFramedHello(compress).encode(getpreferredencoding()))
+        # Not select(), there can be more connections than it can handle
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.connection, selectors.EVENT_READ)
+            while not self.server.terminate:
+                # Check for termination now and again, the slave may never close the connection
+                if selector.select(10):
+                    message = readFramedMessage(self.connection)
+                    if message is None:
+                        return
+                    self.handleFramedMessage(message, openFramedMessage(self.connection, compress))
+
+    def handleFramedMessage(self, message, response):
+        # Everything else reads and writes the file objects, as for separate connections
+        self.rfile = message
+        self.wfile = response
+        identifier = str(self.rfile.readline().strip(), getpreferredencoding())
         self.handleMessage(identifier)
+        # Skip anything not read, e.g. from tests that were already complete
+        while self.rfile.read(frameSize):
+            pass
+        self.wfile.close()
+
+    def shutdownConnection(self, how):
+        if self.framed:
+            return  # The end of the frame marks the end of the message
+
+        try:
+            self.connection.shutdown(how)
+        except socket.error:
+            # This only occurs on a mac, and doesn't affect functionality.
+            pass
 
     def handleMessage(self, identifier):
         # Don't use port, it changes all the time
-        identifier, sendFiles, getFiles, tryReuse, rerun = parseIdentifier(identifier)
+        identifier, sendFiles, getFiles, tryReuse, rerun, sendArchive = parseIdentifier(identifier)
         testString = str(self.rfile.readline().strip(), getpreferredencoding())
         test = self.server.getTest(testString)
         if test is None:
@@ -972,7 +1359,11 @@ class SlaveRequestHandler(StreamRequestHandler):
         elif getFiles:
             self.pushFiles(test)
         elif not test.state.isComplete() or not test.state.hasResults():  # we might have killed it already...
-            if sendFiles:
+            if sendArchive:
+                self.server.diag.info("Test " + test.uniqueName +
+                                      " - receiving archive sent from slave to sandbox directory")
+                directoryUnarchive(test.writeDirectory, self.rfile)
+            elif sendFiles:
                 self.server.diag.info("Test " + test.uniqueName +
                                       " - receiving files sent from slave to sandbox directory")
                 directoryUnserialise(test.writeDirectory, self.rfile)
@@ -981,11 +1372,7 @@ class SlaveRequestHandler(StreamRequestHandler):
         else:
             self.server.diag.info("Test " + test.uniqueName + " already complete, ignoring new results")
             self.sendReuseResponse(test, test.state, tryReuse, False)
-        try:
-            self.connection.shutdown(socket.SHUT_RDWR)
-        except socket.error:
-            # This only occurs on a mac, and doesn't affect functionality.
-            pass
+        self.shutdownConnection(socket.SHUT_RDWR)
 
     def getHostName(self, ipAddress):
         try:
@@ -1015,11 +1402,7 @@ class SlaveRequestHandler(StreamRequestHandler):
         if test.state.isComplete():
             state.lifecycleChange = "recalculated"
         doneRerun = self.server.changeStateOrRerun(test, state, rerun)
-        try:
-            self.connection.shutdown(socket.SHUT_RD)
-        except socket.error:
-            # This only occurs on a mac, and doesn't affect functionality.
-            pass
+        self.shutdownConnection(socket.SHUT_RD)
         if state.isComplete():
             self.sendReuseResponse(test, state, tryReuse, doneRerun)
         else:
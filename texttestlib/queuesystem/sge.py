@@ -32,9 +32,11 @@ class QueueSystem(gridqueuesystem.QueueSystem):
                    "T": ("THRESH", "Suspended by SGE as it exceeded allowed thresholds")}
     errorStatuses = ["Eqw", "ERq"]
     submitProg = "qsub"
+    arrayTaskIdVariable = "SGE_TASK_ID"
     def __init__(self, *args):
         self.qdelOutput = ""
         self.errorReasons = {}
+        self.arrayJobIds = set()
         gridqueuesystem.QueueSystem.__init__(self, *args)
 
     def getSlaveStartErrorFile(self):
@@ -67,6 +69,30 @@ class QueueSystem(gridqueuesystem.QueueSystem):
         qsubArgs += ["-o", os.devnull, "-e", self.getSlaveStartErrorFile()]
         return self.addExtraAndCommand(qsubArgs, submissionRules, commandArgs)
 
+    def supportsArrayJobs(self):
+        return True
+
+    def getArraySubmitCmdArgs(self, submissionRules, taskCount, commandArgs, slaveEnv):
+        qsubArgs = self.getSubmitCmdArgs(submissionRules, commandArgs, slaveEnv)
+        qsubArgs[1:1] = ["-t", "1-" + str(taskCount)]
+        return qsubArgs
+
+    def getArrayTaskJobId(self, jobId, taskIndex):
+        # qsub reports e.g. 1234.1-20:1. qdel and qstat -j understand 1234.5 as task 5
+        arrayJobId = jobId.split(".")[0]
+        self.arrayJobIds.add(arrayJobId)
+        return arrayJobId + "." + str(taskIndex)
+
+    def getArrayTaskIds(self, taskText):
+        # qstat shows pending tasks as ranges, e.g. 4-20:1 or 4,6-8:2, and running ones individually
+        taskIds = []
+        for taskRange in taskText.split(","):
+            bounds, _, step = taskRange.partition(":")
+            first, _, last = bounds.partition("-")
+            if first.isdigit() and (not last or last.isdigit()) and (not step or step.isdigit()):
+                taskIds += list(map(str, range(int(first), int(last or first) + 1, int(step or 1))))
+        return taskIds
+
     def getResourceArg(self, submissionRules):
         resourceList = submissionRules.findResourceList()
         machines = submissionRules.findMachineList()
@@ -115,21 +141,29 @@ class QueueSystem(gridqueuesystem.QueueSystem):
         for line in outMsg.splitlines():
             words = line.split()
             if len(words) >= 5 and words[0].isdigit():
-                jobId = words[0]
                 statusLetter = self.getStatusLetter(words, 4)
-                if statusLetter in self.errorStatuses:
-                    self.errorReasons[jobId] = self.getErrorReason(jobId)
-                    self.killJob(jobId)
-                    continue
-
-                status = self.allStatuses.get(statusLetter)
-                if status:
-                    statusDict[jobId] = status
+                if words[0] in self.arrayJobIds:
+                    # The last column, ja-task-ID, says which tasks of the array the line is about
+                    jobIds = [words[0] + "." + taskId for taskId in self.getArrayTaskIds(words[-1])]
                 else:
-                    log.info("WARNING: unexpected job status " + repr(statusLetter) + " received from SGE!")
-                    statusDict[jobId] = statusLetter, statusLetter
+                    jobIds = [words[0]]
+                for jobId in jobIds:
+                    self.addJobStatus(statusDict, jobId, statusLetter)
         return statusDict
 
+    def addJobStatus(self, statusDict, jobId, statusLetter):
+        if statusLetter in self.errorStatuses:
+            self.errorReasons[jobId] = self.getErrorReason(jobId)
+            self.killJob(jobId)
+            return
+
+        status = self.allStatuses.get(statusLetter)
+        if status:
+            statusDict[jobId] = status
+        else:
+            log.info("WARNING: unexpected job status " + repr(statusLetter) + " received from SGE!")
+            statusDict[jobId] = statusLetter, statusLetter
+
     def isDate(self, text):
         return len(text) == 10 and text.count("/") == 2
 
@@ -140,7 +174,8 @@ class QueueSystem(gridqueuesystem.QueueSystem):
             return self.getStatusLetter(words, statusIndex + 1)
 
     def getErrorReason(self, jobId):
-        proc = subprocess.Popen(["qstat", "-j", jobId], stdin=open(os.devnull), encoding=getpreferredencoding(),
+        # Array tasks share the job's error reason
+        proc = subprocess.Popen(["qstat", "-j", jobId.split(".")[0]], stdin=open(os.devnull), encoding=getpreferredencoding(),
                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         outMsg = proc.communicate()[0]
         for line in outMsg.splitlines():
@@ -182,10 +217,13 @@ class QueueSystem(gridqueuesystem.QueueSystem):
             return "Could not find info about job: " + jobId + "\nqacct error was as follows:\n" + acctError
 
     def getAccountInfo(self, jobId, extraArgs=[]):
-        cmdArgs = ["qacct", "-j", jobId] + extraArgs
+        arrayJobId, _, taskId = jobId.partition(".")
+        cmdArgs = ["qacct", "-j", arrayJobId] + extraArgs
+        if taskId:
+            cmdArgs += ["-t", taskId]
         proc = subprocess.Popen(cmdArgs, stdin=open(os.devnull), stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding=getpreferredencoding())
         outMsg, errMsg = proc.communicate()
-        notFoundMsg = "error: job id " + jobId + " not found"
+        notFoundMsg = "error: job id " + arrayJobId + " not found"
         if len(errMsg) == 0 or notFoundMsg not in errMsg:
             return outMsg, errMsg
         else:
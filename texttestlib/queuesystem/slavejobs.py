@@ -17,6 +17,7 @@ from texttestlib.default.actionrunner import ActionRunner
 from texttestlib.utils import getUserName
 from pickle import dumps
 from locale import getpreferredencoding
+from threading import Lock
 
 
 def importAndCallFromQueueSystem(app, *args):
@@ -77,6 +78,14 @@ class SocketResponder(plugins.Responder, plugins.Observable):
         self.transferAll = optionMap.get("keepslave") or optionMap.get("keeptmp")
         self.testsForRerun = []
         self.serverAddress = self.getServerAddress(optionMap)
+        # Set by masters that understand the framed protocol and archive transfer of sandboxes.
+        # If framed, keep one connection open for all messages
+        protocol = os.getenv("TEXTTEST_SLAVE_PROTOCOL")
+        self.sendArchives = protocol is not None
+        self.framed = protocol in ["framed", "compressed"]
+        self.compress = protocol == "compressed"
+        self.framedSocket = None
+        self.framedLock = Lock()
 
     def getServerAddress(self, optionMap):
         servAddrStr = optionMap.get("servaddr", os.getenv("CAPTUREMOCK_SERVER"))
@@ -105,12 +114,12 @@ class SocketResponder(plugins.Responder, plugins.Observable):
     def notifyKillProcesses(self, *args):
         self.killed = True
 
-    def getProcessIdentifier(self, test, sendFiles):
+    def getProcessIdentifier(self, test, sendFiles, sendArchive):
         identifier = str(os.getpid())
         rerun = test in self.testsForRerun
         if rerun:
             self.testsForRerun.remove(test)
-        return makeIdentifierLine(identifier, sendFiles, False, self.killed, rerun)
+        return makeIdentifierLine(identifier, sendFiles, False, self.killed, rerun, sendArchive)
 
     def notifyRerun(self, test):
         self.testsForRerun.append(test)
@@ -120,20 +129,27 @@ class SocketResponder(plugins.Responder, plugins.Observable):
         protocol = int(os.getenv("TEXTTEST_PICKLE_PROTOCOL", 2)) # Which pickle protocol to use. Useful to set to plain text for self-tests.
         pickleData = dumps(state, protocol=protocol)
         sendFiles = self.synchFiles and changeDesc == "complete" and (self.transferAll or not test.state.hasSucceeded())
-        fullData = self.getProcessIdentifier(test, sendFiles) + os.linesep + testData + os.linesep
-        if sendFiles:
-            fullData += directorySerialise(test.writeDirectory) + os.linesep
-        fullDataBytes = fullData.encode(getpreferredencoding()) + pickleData
-        return self.sendAndInterpret(fullDataBytes, self.interpretResponse, state)
+        sendArchive = sendFiles and self.sendArchives
+        fullData = self.getProcessIdentifier(test, sendFiles and not sendArchive, sendArchive) + os.linesep + testData + os.linesep
+        if sendArchive:
+            # Written straight from the files as the message is sent
+            compression = getArchiveCompression(test.getConfigValue("remote_sandbox_compression"))
+            def writeArchive(f):
+                directoryArchive(test.writeDirectory, f, compression)
+            messageParts = [fullData.encode(getpreferredencoding()), writeArchive, pickleData]
+        else:
+            if sendFiles:
+                fullData += directorySerialise(test.writeDirectory) + os.linesep
+            messageParts = [fullData.encode(getpreferredencoding()), pickleData]
+        return self.sendAndInterpret(messageParts, self.interpretResponse, state)
 
     def sendAndInterpret(self, fullData, responseMethod, *args):
         sleepTime = 1
         for _ in range(9):
-            sendSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            if not self.connect(sendSocket):
-                return self.notify("NoMoreExtraTests")
             try:
-                response = self.sendData(sendSocket, fullData)
+                response = self.sendFramedData(fullData) if self.framed else self.sendClassicData(fullData)
+                if response is None:
+                    return self.notify("NoMoreExtraTests")
                 return responseMethod(response, *args) if responseMethod else True
             except socket.error as e:
                 plugins.log.info("Failed to communicate with master process - waiting " +
@@ -147,8 +163,55 @@ class SocketResponder(plugins.Responder, plugins.Observable):
         plugins.log.info(message.strip())
         self.notify("NoMoreExtraTests")
 
-    def sendData(self, sendSocket, fullData):
-        sendSocket.sendall(fullData)
+    def sendClassicData(self, messageParts):
+        sendSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self.connect(sendSocket):
+            return self.sendData(sendSocket, messageParts)
+
+    def sendFramedData(self, messageParts):
+        # Tests may complete in several threads at once
+        with self.framedLock:
+            if self.framedSocket is None:
+                self.framedSocket = self.openFramedConnection()
+                if self.framedSocket is None:
+                    return
+            try:
+                message = openFramedMessage(self.framedSocket, self.compress)
+                writeMessage(message, messageParts)
+                message.close()
+                response = readFramedMessage(self.framedSocket)
+                if response is None:
+                    raise socket.error("Master process closed the connection")
+                return str(response.read(), getpreferredencoding())
+            except Exception:
+                # Connect again next time. Whatever went wrong, the master can't make sense of a half-sent message
+                self.framedSocket.close()
+                self.framedSocket = None
+                raise
+
+    def openFramedConnection(self):
+        sendSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if not self.connect(sendSocket):
+            return
+        if self.synchFiles:
+            # See sendData
+            sendSocket.settimeout(25)
+        try:
+            sendSocket.sendall(makeFramedHello(self.compress).encode(getpreferredencoding()))
+            # Don't send any messages until the master has replied, it's still reading lines at this point
+            reply = receiveLine(sendSocket)
+        except socket.error:
+            sendSocket.close()
+            raise
+        if parseFramedHello(reply) is None:
+            sendSocket.close()
+            raise socket.error("Unexpected reply to framed protocol request : " + repr(reply))
+        return sendSocket
+
+    def sendData(self, sendSocket, messageParts):
+        sendFile = sendSocket.makefile("wb")
+        writeMessage(sendFile, messageParts)
+        sendFile.close()
         sendSocket.shutdown(socket.SHUT_WR)
         if self.synchFiles:
             # Remote socket, possibly firewalls that kill connections, possibly other things. Use timeout and be prepared to retry...
@@ -172,7 +235,7 @@ class SocketResponder(plugins.Responder, plugins.Observable):
                 plugins.log.info(test.getIndent() + "Fetching required test data at " + repr(path) + " ...")
             data = makeIdentifierLine(str(os.getpid()), getFiles=True) + "\n" + socketSerialise(test) + "\n" + \
                 getUserName() + "@" + getIPAddress([test]) + "\n" + "\n".join(paths)
-            self.sendAndInterpret(data.encode(getpreferredencoding()), None)  # Just wait, no response to interpret
+            self.sendAndInterpret([data.encode(getpreferredencoding())], None)  # Just wait, no response to interpret
 
 
 class SlaveActionRunner(ActionRunner):
@@ -4,13 +4,19 @@ Utilities for both master and slave code
 """
 
 import os
+import io
 import socket
+import struct
+import tarfile
+import shutil
+import zlib
 from texttestlib import plugins
 from locale import getpreferredencoding
 
 noReusePostfix = ".NO_REUSE"
 rerunPostfix = ".RERUN_TEST"
 sendFilePostfix = ".SEND_FILES"
+sendArchivePostfix = ".SEND_ARCHIVE"
 getFilePostfix = ".GET_FILES"
 
 
@@ -48,9 +54,11 @@ def socketParse(testString):
     return testString.strip().split(":", 1)
 
 
-def makeIdentifierLine(identifier, sendFiles=False, getFiles=False, noReuse=False, rerun=False):
+def makeIdentifierLine(identifier, sendFiles=False, getFiles=False, noReuse=False, rerun=False, sendArchive=False):
     if sendFiles:
         identifier += sendFilePostfix
+    if sendArchive:
+        identifier += sendArchivePostfix
     if getFiles:
         identifier += getFilePostfix
     if noReuse:
@@ -69,6 +77,10 @@ def parseIdentifier(line):
     if not tryReuse:
         line = line.replace(noReusePostfix, "")
 
+    sendArchive = line.endswith(sendArchivePostfix)
+    if sendArchive:
+        line = line.replace(sendArchivePostfix, "")
+
     sendFiles = line.endswith(sendFilePostfix)
     if sendFiles:
         line = line.replace(sendFilePostfix, "")
@@ -77,7 +89,143 @@ def parseIdentifier(line):
     if getFiles:
         line = line.replace(getFilePostfix, "")
 
-    return line, sendFiles, getFiles, tryReuse, rerun
+    return line, sendFiles, getFiles, tryReuse, rerun, sendArchive
+
+
+# Framed protocol: after a hello line in each direction, messages in both directions are a sequence of
+# frames, each a header giving flags and length followed by data. The data of all the frames in a message
+# is the same as the classic protocol sends over a whole connection
+framedHello = "TEXTTEST_FRAMED"
+framedVersion = 1
+frameHeader = struct.Struct("!BI")
+compressedFlag = 1
+moreFramesFlag = 2
+frameSize = 64 * 1024
+minCompressSize = 1024
+
+
+def makeFramedHello(compress):
+    return framedHello + " " + str(framedVersion) + " " + ("zlib" if compress else "none") + "\n"
+
+
+def parseFramedHello(line):
+    # Returns whether compression is requested, or None if it isn't a hello line at all
+    parts = line.split()
+    if len(parts) == 3 and parts[0] == framedHello:
+        return parts[2] == "zlib"
+
+
+def sendFrame(sock, data, compress=False, more=False):
+    flags = moreFramesFlag if more else 0
+    if compress and len(data) >= minCompressSize:
+        data = zlib.compress(data)
+        flags |= compressedFlag
+    sock.sendall(frameHeader.pack(flags, len(data)) + data)
+
+
+def receiveFrame(sock):
+    # Returns the data and whether more frames follow, or None if the other end closed the connection
+    header = receiveExactly(sock, frameHeader.size)
+    if header is None:
+        return
+    flags, length = frameHeader.unpack(header)
+    data = receiveExactly(sock, length) if length else b""
+    if data is None:
+        raise socket.error("Connection closed in the middle of a message")
+    if flags & compressedFlag:
+        data = zlib.decompress(data)
+    return data, bool(flags & moreFramesFlag)
+
+
+class FrameWriter(io.RawIOBase):
+    """ Sends what is written as frames of one message, which ends when it is closed """
+
+    def __init__(self, sock, compress):
+        self.sock = sock
+        self.compress = compress
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if len(data):
+            sendFrame(self.sock, bytes(data), self.compress, more=True)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            sendFrame(self.sock, b"")
+        io.RawIOBase.close(self)
+
+
+class FrameReader(io.RawIOBase):
+    """ Reads the frames of one message, signalling end of file after the last one """
+
+    def __init__(self, sock, data, more):
+        self.sock = sock
+        self.data = data
+        self.more = more
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self.pos == len(self.data):
+            if not self.more:
+                return 0
+            frame = receiveFrame(self.sock)
+            if frame is None:
+                raise socket.error("Connection closed in the middle of a message")
+            self.data, self.more = frame
+            self.pos = 0
+        size = min(len(buffer), len(self.data) - self.pos)
+        buffer[:size] = self.data[self.pos:self.pos + size]
+        self.pos += size
+        return size
+
+
+def openFramedMessage(sock, compress):
+    return io.BufferedWriter(FrameWriter(sock, compress), frameSize)
+
+
+def readFramedMessage(sock):
+    # Returns None if the other end closed the connection instead of sending a message
+    frame = receiveFrame(sock)
+    if frame is not None:
+        return io.BufferedReader(FrameReader(sock, *frame), frameSize)
+
+
+def writeMessage(f, messageParts):
+    # Parts are either bytes or methods that write to the file themselves
+    for part in messageParts:
+        if isinstance(part, bytes):
+            f.write(part)
+        else:
+            part(f)
+
+
+def receiveExactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(min(size - len(data), 1024 * 1024))
+        if not chunk:
+            if len(data) == 0:
+                return
+            raise socket.error("Connection closed in the middle of a message")
+        data += chunk
+    return bytes(data)
+
+
+def receiveLine(sock):
+    # Read byte by byte, so nothing after the line is consumed
+    data = b""
+    while not data.endswith(b"\n"):
+        char = sock.recv(1)
+        if not char:
+            raise socket.error("Connection closed before end of line")
+        data += char
+    return str(data, getpreferredencoding())
 
 
 dirText = "DIRECTORY_CONTENTS"
@@ -120,3 +268,122 @@ def directoryUnserialise(rootDir, f):
                 currFile = open(path, "w")
             elif lineStr.startswith(endPrefix + dirText):
                 break
+
+
+# Archive transfer: a tar stream, cut into chunks each preceded by its length and ended by an empty one.
+# The reader therefore knows where it ends, even if decompression reads ahead
+chunkHeader = struct.Struct("!I")
+
+
+class ChunkWriter(io.RawIOBase):
+    def __init__(self, f):
+        self.f = f
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if len(data):
+            self.f.write(chunkHeader.pack(len(data)) + bytes(data))
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.f.write(chunkHeader.pack(0))
+        io.RawIOBase.close(self)
+
+
+class ChunkReader(io.RawIOBase):
+    def __init__(self, f):
+        self.f = f
+        self.remaining = 0
+        self.finished = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.remaining == 0 and not self.finished:
+            self.remaining = chunkHeader.unpack(self.readExactly(chunkHeader.size))[0]
+            self.finished = self.remaining == 0
+        if self.finished:
+            return 0
+        data = self.readExactly(min(len(buffer), self.remaining))
+        buffer[:len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
+
+    def readExactly(self, size):
+        data = self.f.read(size)
+        if len(data) < size:
+            raise EOFError("Archive transfer ended early")
+        return data
+
+
+archiveCompressions = {"gz": "gz", "bz2": "bz2", "xz": "xz", "none": "", "": ""}
+
+
+def getArchiveCompression(configValue):
+    if configValue in archiveCompressions:
+        return archiveCompressions[configValue]
+    plugins.printWarning("Unknown remote_sandbox_compression '" + configValue + "', using 'gz'")
+    return "gz"
+
+
+class PaddedReader:
+    # Gives tarfile the size it was promised even if the file shrinks while we read it,
+    # as anything less would leave the rest of the archive unreadable
+    def __init__(self, f, size):
+        self.f = f
+        self.remaining = size
+
+    def read(self, size):
+        data = self.f.read(min(size, self.remaining))
+        if len(data) < min(size, self.remaining):
+            data += b"\0" * (min(size, self.remaining) - len(data))
+        self.remaining -= len(data)
+        return data
+
+
+def directoryArchive(dirName, f, compression="gz"):
+    chunkFile = io.BufferedWriter(ChunkWriter(f), frameSize)
+    with tarfile.open(fileobj=chunkFile, mode="w|" + compression) as tar:
+        for root, _, files in os.walk(dirName):
+            for fn in sorted(files):
+                path = os.path.join(root, fn)
+                if not os.path.islink(path):
+                    addToArchive(tar, path, plugins.relpath(path, dirName))
+    chunkFile.close()
+
+
+def addToArchive(tar, path, arcname):
+    # Skip anything we can't read rather than abandon the archive, which is being sent as we write it
+    try:
+        if not os.path.isfile(path):  # only files are unpacked, and pipes would block
+            return
+        f = open(path, "rb")
+    except OSError as e:
+        plugins.printWarning("Could not send file at " + path + " to the master process : " + str(e))
+        return
+    with f:
+        tarinfo = tar.gettarinfo(arcname=arcname, fileobj=f)
+        tar.addfile(tarinfo, PaddedReader(f, tarinfo.size))
+
+
+def directoryUnarchive(rootDir, f):
+    chunkFile = io.BufferedReader(ChunkReader(f), frameSize)
+    with tarfile.open(fileobj=chunkFile, mode="r|*") as tar:
+        for member in tar:
+            if member.isfile() and isSafeArchivePath(member.name):
+                path = os.path.join(rootDir, member.name)
+                plugins.ensureDirExistsForFile(path)
+                with open(path, "wb") as dstFile:
+                    shutil.copyfileobj(tar.extractfile(member), dstFile)
+                os.chmod(path, member.mode & 0o777)
+    # Skip the end of the archive, so the next reader starts in the right place
+    while chunkFile.read(frameSize):
+        pass
+
+
+def isSafeArchivePath(name):
+    return not os.path.isabs(name) and ".." not in name.replace("\\", "/").split("/")
@@ -10,14 +10,18 @@ import logging
 import glob
 import functools
 import fnmatch
+import hashlib
+import time
 
 from multiprocessing import cpu_count
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pickle import Pickler, Unpickler, UnpicklingError
 from threading import Lock
 from tempfile import mkstemp, mkdtemp
 from copy import deepcopy
 from functools import reduce, cmp_to_key
+from bisect import bisect_left
 from locale import getpreferredencoding
 
 helpIntro = """
@@ -28,26 +32,45 @@ http://www.texttest.org
 
 
 class DirectoryCache:
-    def __init__(self, dir):
+    def __init__(self, dir, contents=None):
         self.dir = dir
-        self.contents = []
-        self.refresh()
+        if contents is None:
+            self.refresh()
+        else:
+            self.contents = contents
+            self.buildIndex()
 
     def refresh(self):
+        self.contents = self.readContents(self.dir)
+        self.buildIndex()
+
+    @staticmethod
+    def readContents(dir):
         try:
-            self.contents = os.listdir(self.dir)
-            self.contents.sort()
+            return sorted(os.listdir(dir))
         except OSError:  # usually caused by people removing stuff externally
-            self.contents = []
+            return []
 
-    def hasStem(self, stem):
+    def buildIndex(self):
+        # Split each file name once, and index on the part before the first "."
+        # Lookups then only need to examine files sharing that first part
+        self.fileNames = set(self.contents)
+        self.splitContents = []
+        self.stemIndex = {}
         for fileName in self.contents:
-            if fileName.startswith(stem):
-                return True
-        return False
+            parts = fileName.split(".")
+            self.splitContents.append((parts[0], frozenset(parts[1:])))
+            self.stemIndex.setdefault(parts[0], []).append((fileName, parts[1:]))
+        self.versionSetCache = {}
+        self.subdirCaches = {}
+
+    def hasStem(self, stem):
+        # contents is sorted, so any file starting with stem must come directly after where stem would be inserted
+        pos = bisect_left(self.contents, stem)
+        return pos < len(self.contents) and self.contents[pos].startswith(stem)
 
     def exists(self, fileName):
-        return fileName in self.contents
+        return fileName in self.fileNames
 
     def pathName(self, fileName):
         return os.path.join(self.dir, fileName)
@@ -66,19 +89,42 @@ class DirectoryCache:
         versionSets = self.findVersionSets(stem, extensionPred)
         return reduce(operator.add, list(versionSets.values()), [])
 
+    def getSubdirCache(self, root):
+        subdirCache = self.subdirCaches.get(root)
+        if subdirCache is None:
+            subdirCache = DirectoryCache(os.path.join(self.dir, root))
+            self.subdirCaches[root] = subdirCache
+        return subdirCache
+
     def findVersionSets(self, stem, predicate):
         # added normpath, needs review MB 2018-12-07
         stem = os.path.normpath(stem)
         if os.sep in stem:
             root, local = os.path.split(stem)
-            newCache = DirectoryCache(os.path.join(self.dir, root))
-            return newCache.findVersionSets(local, predicate)
+            return self.getSubdirCache(root).findVersionSets(local, predicate)
 
         versionSets = OrderedDict()
-        for fileName in self.contents:
-            versionSet = self.findVersionSet(fileName, stem)
-            if versionSet is not None and (predicate is None or predicate(versionSet)):
+        for versionSet, paths in self.getAllVersionSets(stem).items():
+            if predicate is None or predicate(versionSet):
+                # Copy the list, callers are free to extend it
+                versionSets[versionSet] = list(paths)
+        return versionSets
+
+    def getAllVersionSets(self, stem):
+        versionSets = self.versionSetCache.get(stem)
+        if versionSets is None:
+            versionSets = OrderedDict()
+            stemParts = stem.split(".")
+            numParts = len(stemParts)
+            for fileName, versionParts in self.stemIndex.get(stemParts[0], []):
+                if numParts == 1:
+                    versionSet = frozenset(versionParts)
+                elif versionParts[:numParts - 1] == stemParts[1:]:
+                    versionSet = frozenset(versionParts[numParts - 1:])
+                else:
+                    continue
                 versionSets.setdefault(versionSet, []).append(self.pathName(fileName))
+            self.versionSetCache[stem] = versionSets
         return versionSets
 
     def findStemsMatching(self, pattern):
@@ -86,10 +132,11 @@ class DirectoryCache:
 
     def findAllStems(self, predicate=None):
         stems = []
-        for file in self.contents:
-            stem, versionSet = self.splitStem(file)
-            if len(stem) > 0 and stem not in stems and (predicate is None or predicate(stem, versionSet)):
+        stemsFound = set()
+        for stem, versionSet in self.splitContents:
+            if len(stem) > 0 and stem not in stemsFound and (predicate is None or predicate(stem, versionSet)):
                 stems.append(stem)
+                stemsFound.add(stem)
         return stems
 
 
@@ -877,13 +924,16 @@ class TestCase(Test):
         # We allow one non-option after the last one in case it's an argument
         return min(lastOptionIndex + 2, len(optionArgs))
 
-    def listUnownedTmpPaths(self):
-        paths, ignoredPaths = [], []
+    def getUnownedTmpNames(self):
+        # Names in the sandbox that the test wrote, rather than TextTest
         filelist = os.listdir(self.localWriteDirectory)
         filelist.sort()
-        for file in filelist:
-            if file in ["framework_tmp", "file_edits", "traffic_intercepts"] or file.endswith("." + self.app.name):
-                continue
+        return [file for file in filelist if file not in ["framework_tmp", "file_edits", "traffic_intercepts"]
+                and not file.endswith("." + self.app.name)]
+
+    def listUnownedTmpPaths(self):
+        paths, ignoredPaths = [], []
+        for file in self.getUnownedTmpNames():
             fullPath = os.path.join(self.localWriteDirectory, file)
             newPaths, newIgnoredPaths = self.listFiles(fullPath, file, followLinks=False)
             paths += newPaths
@@ -993,20 +1043,41 @@ class TestCase(Test):
 class TestSuiteFileHandler:
     def __init__(self):
         self.cache = {}
+        self.prefetched = {}
 
-    def readWithWarnings(self, fileName, ignoreCache=False, filterMethod=None):
-        items, badTests = self.readFromFileOrCache(fileName, ignoreCache, filterMethod)
+    def readWithWarnings(self, fileName, ignoreCache=False, filterMethod=None, snapshot=None):
+        items, badTests = self.readFromFileOrCache(fileName, ignoreCache, filterMethod, snapshot)
         goodTests = self.getTestWithDescriptions(items)
         self.cache[fileName] = items
         return goodTests, badTests
 
-    def readFromFileOrCache(self, fileName, ignoreCache=False, filterMethod=None):
+    def readFromFileOrCache(self, fileName, ignoreCache=False, filterMethod=None, snapshot=None):
         if not ignoreCache:
             cached = self.cache.get(fileName)
             if cached is not None:
                 return cached, OrderedDict()
+            prefetched = self.prefetched.pop(fileName, None)
+            if prefetched is not None:
+                return prefetched
+            if snapshot:
+                return snapshot.readTestSuiteFile(fileName, self.readFile, filterMethod)
+        return self.readFile(fileName, filterMethod)
+
+    def readFile(self, fileName, filterMethod):
         return plugins.readListWithComments(fileName, plugins.Callable(self.getExclusionReasons, filterMethod))
 
+    def prefetch(self, fileName, filterMethod, snapshot=None):
+        # Called from loader threads, the result is picked up by the next read of the file
+        if snapshot:
+            items, badTests = snapshot.readTestSuiteFile(fileName, self.readFile, filterMethod)
+        else:
+            items, badTests = self.readFile(fileName, filterMethod)
+        self.prefetched[fileName] = items, badTests
+        return self.getTestWithDescriptions(items)
+
+    def discardPrefetched(self, fileName):
+        self.prefetched.pop(fileName, None)
+
     def getTestWithDescriptions(self, tests):
         onlyTest = OrderedDict()
         for key, value in list(tests.items()):
@@ -1169,7 +1240,7 @@ class TestSuite(Test):
             return testNames, OrderedDict()
         fileName = self.getContentFileName()
         if fileName:
-            return self.testSuiteFileHandler.readWithWarnings(fileName, ignoreCache, self.fileExists)
+            return self.testSuiteFileHandler.readWithWarnings(fileName, ignoreCache, self.fileExists, self.app.testTreeSnapshot)
         else:
             return OrderedDict(), OrderedDict()
 
@@ -1329,7 +1400,9 @@ class TestSuite(Test):
 
         for testNameOrPath in self.getOrderedTestNames(list(testNames.keys()), testCaseNames):
             testName = os.path.basename(testNameOrPath)
-            dirCache = testCaches.get(testName, self.createTestCache(testNameOrPath))
+            dirCache = testCaches.get(testName)
+            if dirCache is None:
+                dirCache = self.createTestCache(testNameOrPath)
             desc = testNames.get(testNameOrPath)
             self.createTestOrSuite(testName, desc, dirCache, filters, initial, guideSuite)
 
@@ -1343,7 +1416,7 @@ class TestSuite(Test):
                 subTest.notify("Add", initial)
 
     def createTestCache(self, testName):
-        return DirectoryCache(os.path.join(self.getDirectory(), testName))
+        return self.app.makeTestDirectoryCache(os.path.join(self.getDirectory(), testName))
 
     def getSubtestClass(self, cache):
         return TestSuite if cache.hasStem("testsuite." + self.app.name) else TestCase
@@ -1483,6 +1556,178 @@ class TestSuite(Test):
             self.testSuiteFileHandler.remove(contentFileName, testName)
 
 
+# Reads directory listings, testsuite files and definition files in a thread pool, ahead of the
+# main thread building the test tree. The tree itself is still built in order on the main thread,
+# which just picks up the results from here, so loading in parallel cannot change its order.
+class TestTreePrefetcher:
+    def __init__(self, app, threadCount):
+        self.app = app
+        self.threadCount = threadCount
+        self.executor = ThreadPoolExecutor(max_workers=threadCount)
+        self.lock = Lock()
+        self.cacheFutures = {}
+        self.requestedDirs = set()
+        self.prefetchedTestSuiteFiles = []
+        self.prefetchedConfigFiles = []
+        self.stopped = False
+        self.diag = logging.getLogger("Test Tree Prefetcher")
+
+    def prefetchTree(self, dircache):
+        self.requestedDirs.add(dircache.dir)
+        self.submit(self.prefetchContents, dircache)
+
+    def submit(self, method, *args):
+        with self.lock:
+            if not self.stopped:
+                return self.executor.submit(method, *args)
+
+    def prefetchDirectory(self, dirName):
+        with self.lock:
+            if self.stopped or dirName in self.requestedDirs:
+                return
+            self.requestedDirs.add(dirName)
+            self.cacheFutures[dirName] = self.executor.submit(self.makeDirectoryCache, dirName)
+
+    def makeDirectoryCache(self, dirName):
+        dircache = self.app.createDirectoryCache(dirName)
+        self.submit(self.prefetchContents, dircache)
+        return dircache
+
+    def prefetchContents(self, dircache):
+        if self.stopped:
+            return
+        try:
+            self.prefetchDefinitionFiles(dircache)
+            testSuiteFile = self.app.getFileNameFromCaches([dircache], "testsuite")
+            if testSuiteFile:
+                self.prefetchedTestSuiteFiles.append(testSuiteFile)
+                filterMethod = plugins.Callable(self.testDirExists, dircache)
+                testNames = TestSuite.testSuiteFileHandler.prefetch(testSuiteFile, filterMethod, self.app.testTreeSnapshot)
+                for testName in testNames:
+                    self.prefetchDirectory(os.path.join(dircache.dir, testName))
+        except Exception as e:
+            # Anything that goes wrong here will happen again when the main thread reads it, and be reported then
+            self.diag.info("Failed to prefetch contents of " + dircache.dir + " : " + str(e))
+
+    def prefetchDefinitionFiles(self, dircache):
+        if dircache is self.app.dircache:
+            return  # Already read when setting up the application
+        for envFile in self.app.getAllFileNames([dircache], "environment"):
+            self.app.readEnvironment(envFile)
+        for configFile in self.app.getAllFileNames([dircache], "config"):
+            self.prefetchedConfigFiles.append(configFile)
+            plugins.MultiEntryDictionary.prefetchedLines[configFile] = self.app.readConfigLines(configFile)
+
+    @staticmethod
+    def testDirExists(name, dircache):
+        # Same as TestSuite.fileExists
+        if os.path.isabs(name):
+            return os.path.isdir(name)
+        else:
+            return dircache.exists(name)
+
+    def getDirectoryCache(self, dirName):
+        with self.lock:
+            future = self.cacheFutures.pop(dirName, None)
+        if future is not None:
+            return future.result()
+        else:
+            return self.app.createDirectoryCache(dirName)
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            dirCount = len(self.requestedDirs)
+            self.cacheFutures.clear()
+        # Directories queued but not started are not needed now
+        if sys.version_info >= (3, 9):
+            self.executor.shutdown(wait=True, cancel_futures=True)
+        else:
+            self.executor.shutdown(wait=True)
+        # Drop anything not used by this load, so that later reloads read the files afresh
+        for fileName in self.prefetchedTestSuiteFiles:
+            TestSuite.testSuiteFileHandler.discardPrefetched(fileName)
+        for fileName in self.prefetchedConfigFiles:
+            plugins.MultiEntryDictionary.prefetchedLines.pop(fileName, None)
+        return dirCount
+
+
+# Persistent record of the directory listings and files read when loading the test tree.
+# Each entry is stored along with the status of the path when it was read, so that a later
+# load of an unchanged tree only needs to stat each path. Anything that has changed is read again.
+class TestTreeSnapshot:
+    formatVersion = 1
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.entries = {}
+        self.usedKeys = set()
+        self.reused = 0
+        self.changed = False
+        self.diag = logging.getLogger("Test Tree Snapshot")
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.fileName, "rb") as f:
+                formatVersion, entries = Unpickler(f).load()
+            if formatVersion == self.formatVersion:
+                self.entries = entries
+                self.diag.info("Loaded " + str(len(entries)) + " entries from " + self.fileName)
+        except (OSError, EOFError, UnpicklingError, ValueError, TypeError, AttributeError) as e:
+            self.diag.info("Could not load snapshot from " + self.fileName + " : " + str(e))
+
+    @staticmethod
+    def getStatKey(path):
+        try:
+            statInfo = os.stat(path)
+            return statInfo.st_ino, statInfo.st_mtime_ns, statInfo.st_size
+        except OSError:
+            return None
+
+    def getEntry(self, key, statKey, reader, *args):
+        self.usedKeys.add(key)
+        stored = self.entries.get(key)
+        if stored is not None and stored[0] == statKey:
+            self.reused += 1
+            return stored[1]
+        value = reader(*args)
+        if statKey is not None:
+            self.entries[key] = statKey, value
+            self.changed = True
+        return value
+
+    def listDirectory(self, dirName):
+        return self.getEntry(("dir", dirName), self.getStatKey(dirName), DirectoryCache.readContents, dirName)
+
+    def readFile(self, fileName, reader, *args):
+        return self.getEntry(("file", fileName), self.getStatKey(fileName), reader, fileName, *args)
+
+    def readTestSuiteFile(self, fileName, reader, *args):
+        # Which tests are commented out depends on which test directories exist, so check the directory also
+        statKey = self.getStatKey(fileName), self.getStatKey(os.path.dirname(fileName))
+        if None in statKey:
+            statKey = None
+        return self.getEntry(("testsuite", fileName), statKey, reader, fileName, *args)
+
+    def save(self):
+        for key in list(self.entries.keys()):
+            if key not in self.usedKeys and not os.path.exists(key[1]):
+                del self.entries[key]
+                self.changed = True
+        if not self.changed:
+            return
+        try:
+            plugins.ensureDirectoryExists(os.path.dirname(self.fileName))
+            tmpFileName = self.fileName + "." + str(os.getpid())
+            with open(tmpFileName, "wb") as f:
+                Pickler(f, protocol=2).dump((self.formatVersion, self.entries))
+            os.replace(tmpFileName, self.fileName)
+            self.diag.info("Saved " + str(len(self.entries)) + " entries to " + self.fileName)
+        except OSError as e:
+            plugins.printWarning("Could not save test tree snapshot to " + self.fileName + " : " + str(e))
+
+
 class BadConfigError(RuntimeError):
     pass
 
@@ -1533,15 +1778,24 @@ class Application(object):
         self.inputOptions = inputOptions
         self.configDir = plugins.MultiEntryDictionary(importKey="import_config_file", importFileFinder=self.configPath)
         self.overrideConfigDir = {}
+        self.prefetcher = None
+        self.testTreeSnapshot = None
+        self.startupTimes = OrderedDict()
+        startTime = time.time()
         self.setUpConfiguration(configEntries)
+        self.startupTimes["reading configuration"] = time.time() - startTime
         self.checkSanity()
+        self.setUpWriteDirectories()
+        self.checkout = self.configObject.setUpCheckout(self)
+        self.diag.info("Checkout set to " + self.checkout)
+
+    def setUpWriteDirectories(self):
+        # Named after the process, so called again by processes forked from this one
         self.writeDirectory, self.localWriteDirectory = self.getWriteDirectories()
         self.rootTmpDir = os.path.dirname(self.writeDirectory)
         self.diag.info("Write directory at " + self.writeDirectory)
         if self.writeDirectory != self.localWriteDirectory:
             self.diag.info("Local write directory at " + self.localWriteDirectory)
-        self.checkout = self.configObject.setUpCheckout(self)
-        self.diag.info("Checkout set to " + self.checkout)
 
     def __repr__(self):
         return self.fullName() + self.versionSuffix()
@@ -1760,8 +2014,18 @@ class Application(object):
     def readValues(self, multiEntryDict, stem, dircaches, insert=True, errorOnUnknown=False):
         allFiles = self.getAllFileNames(dircaches, stem)
         self.diag.info("Reading values for " + stem + " from files : " + "\n".join(allFiles))
+        if self.testTreeSnapshot:
+            for fileName in allFiles:
+                if fileName not in plugins.MultiEntryDictionary.prefetchedLines:
+                    plugins.MultiEntryDictionary.prefetchedLines[fileName] = self.readConfigLines(fileName)
         multiEntryDict.readValues(allFiles, insert, errorOnUnknown)
 
+    def readConfigLines(self, fileName):
+        if self.testTreeSnapshot:
+            return self.testTreeSnapshot.readFile(fileName, plugins.readList)
+        else:
+            return plugins.readList(fileName)
+
     def setEnvironment(self, test):
         test.environment.diag.info("Reading environment for " + repr(test))
         envFiles = test.getAllPathNames("environment")
@@ -1780,12 +2044,18 @@ class Application(object):
         if envFile in self.envFiles:
             return self.envFiles[envFile]
 
-        envDir = plugins.MultiEntryDictionary(allowSectionHeaders=False)
-        envDir.readValues([envFile])
-        envVars = list(envDir.items())
+        if self.testTreeSnapshot:
+            envVars = self.testTreeSnapshot.readFile(envFile, self.parseEnvironment)
+        else:
+            envVars = self.parseEnvironment(envFile)
         self.envFiles[envFile] = envVars
         return envVars
 
+    def parseEnvironment(self, envFile):
+        envDir = plugins.MultiEntryDictionary(allowSectionHeaders=False)
+        envDir.readValues([envFile])
+        return list(envDir.items())
+
     def configPath(self, fileName):
         if os.path.isabs(fileName):
             return fileName
@@ -1924,6 +2194,12 @@ class Application(object):
                               "Additional directories to search for TextTest files")
         self.setConfigDefault("filename_convention_scheme", "classic",
                               "Naming scheme to use for files for stdin,stdout and stderr")
+        self.setConfigDefault("test_load_threads", 0,
+                              "Number of threads to use for reading test directories in advance when loading the test suite. 0 means read them as needed")
+        self.setConfigDefault("test_tree_snapshot", "",
+                              "Where to store a snapshot of the test tree for faster loading: 'personal', 'root' or a directory. Empty means don't store one")
+        self.setConfigDefault("report_startup_times", 0,
+                              "Report how long the different phases of loading the test suite took")
         self.setConfigAlias("test_data_searchpath", "extra_search_directory")
         self.setConfigAlias("extra_config_directory", "extra_search_directory")
 
@@ -1974,13 +2250,78 @@ class Application(object):
         suite.setObservers(responders)
         return suite
 
+    def makeTestDirectoryCache(self, dirName):
+        if self.prefetcher:
+            return self.prefetcher.getDirectoryCache(dirName)
+        else:
+            return self.createDirectoryCache(dirName)
+
+    def createDirectoryCache(self, dirName):
+        if self.testTreeSnapshot:
+            return DirectoryCache(dirName, self.testTreeSnapshot.listDirectory(dirName))
+        else:
+            return DirectoryCache(dirName)
+
+    def getTestTreeSnapshotFile(self):
+        location = self.getConfigValue("test_tree_snapshot")
+        if not location:
+            return
+        fileName = "testtree_snapshot." + self.name
+        if location == "root":
+            return os.path.join(self.getDirectory(), "." + fileName)
+        if location == "personal":
+            location = plugins.getPersonalDir("snapshots")
+        # Several test suites can share the same location, so identify which one this is
+        dirHash = hashlib.md5(os.path.abspath(self.getDirectory()).encode()).hexdigest()
+        return os.path.join(location, fileName + "." + dirHash)
+
+    def preloadTestTreeSnapshot(self):
+        # For processes forked from this one, which then don't each need to load it
+        snapshotFile = self.getTestTreeSnapshotFile()
+        if snapshotFile:
+            self.testTreeSnapshot = TestTreeSnapshot(snapshotFile)
+
     def createInitialTestSuite(self, responders):
+        startTime = time.time()
+        snapshotFile = self.getTestTreeSnapshotFile()
+        if snapshotFile and self.testTreeSnapshot is None:
+            self.testTreeSnapshot = TestTreeSnapshot(snapshotFile)
         suite = self.makeTestSuite(responders)
         # allow the configurations to decide whether to accept the application in the presence of
         # the suite's environment
         self.configObject.checkSanity(suite)
+        threadCount = self.getConfigValue("test_load_threads")
+        if threadCount > 0:
+            self.prefetcher = TestTreePrefetcher(self, threadCount)
+            self.prefetcher.prefetchTree(suite.dircache)
+        self.startupTimes["creating root suite"] = time.time() - startTime
         return suite
 
+    def readInitialTestSuiteContents(self, suite, *args, **kw):
+        startTime = time.time()
+        try:
+            return suite.readContents(*args, **kw)
+        finally:
+            if self.prefetcher:
+                dirCount = self.prefetcher.stop()
+                self.startupTimes["prefetched directories"] = dirCount
+                self.prefetcher = None
+            if self.testTreeSnapshot:
+                self.startupTimes["reused from snapshot"] = self.testTreeSnapshot.reused
+                # Later reloads, e.g. from the GUI, should read everything afresh
+                self.testTreeSnapshot.save()
+                self.testTreeSnapshot = None
+            self.startupTimes["reading test tree"] = time.time() - startTime
+
+    def describeStartupTimes(self):
+        parts = []
+        for phase, value in self.startupTimes.items():
+            if isinstance(value, float):
+                parts.append(phase + " " + str(round(value, 2)) + "s")
+            else:
+                parts.append(phase + " " + str(value))
+        return "Startup times for " + self.description() + ": " + ", ".join(parts)
+
     def createExtraTestSuite(self, filters=[], responders=[], otherDir=None):
         suite = self.makeTestSuite(responders, otherDir)
         suite.readContents(filters)